@@ -0,0 +1,273 @@
+"""
+Maintenance commands for the carrier bot DynamoDB table.
+Usage: python admin.py <command> (see python admin.py --help)
+Requires the same environment variables as carrier_bot.py
+"""
+import argparse
+import gzip
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from decimal import Decimal
+from itertools import islice
+
+from botocore.exceptions import ClientError
+
+from carrier_bot import get_table, logger, is_trip_item, EXPIRY_ATTRIBUTE, BATCH_WRITE_SIZE, DIRECTIONS, \
+    ALERT_KEY_PREFIX, MONTH_VIEW_KEY_PREFIX, LEGACY_INDEX_USER_ID, put_month_view, trip_expiry, batch_write, \
+    subscription_key
+from storage import TRIP_FIELDS, LEG_DATE_KEY, legs_from_dates, leg_items, leg_from_item
+
+
+def scan_items(**scan_kwargs):
+    """
+    Scans the whole table page by page
+    :param scan_kwargs: additional arguments for the scan call
+    :return: generator of table items
+    """
+    while True:
+        response = get_table().scan(**scan_kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def migrate_legs():
+    """
+    Converts trips saved with to_belarus_date and to_spain_date into items of their legs and deletes the old items,
+    trips without dates in both directions are just deleted. Month views and subscriptions kept under
+    LEGACY_INDEX_USER_ID, keyed by "b" and "s" directions or by routes, are moved to the partitions of their route
+    and month: views are deleted and rebuilt by the next search, subscriptions rewritten. Safe to re-run.
+    :return: tuple of number of converted trips and moved index items
+    """
+    converted = moved = 0
+    for item in scan_items():
+        key = {'user_id': item['user_id'], 'trip_id': item['trip_id']}
+        if not is_trip_item(item):
+            kind, _, rest = item['trip_id'].partition("#")
+            if item['user_id'] != LEGACY_INDEX_USER_ID or kind not in (MONTH_VIEW_KEY_PREFIX, ALERT_KEY_PREFIX):
+                continue
+            if kind == ALERT_KEY_PREFIX:
+                route, _, rest = rest.partition("#")
+                month, _, subscription = rest.partition("#")
+                route = DIRECTIONS[route][0] if route in ('b', 's') else route
+                get_table().put_item(Item={**item, **subscription_key(route, month, subscription)})
+            get_table().delete_item(Key=key)
+            moved += 1
+            continue
+        if LEG_DATE_KEY in item:
+            continue
+        trip = {field: item[field] for field in TRIP_FIELDS if field in item}
+        trip['legs'] = legs_from_dates(item)
+        if trip['legs']:
+            trip.setdefault(EXPIRY_ATTRIBUTE, trip_expiry(trip))
+            # Legs are written before the trip is deleted, so an interrupted migration loses nothing
+            batch_write({'PutRequest': {'Item': leg}} for leg in leg_items(trip))
+        get_table().delete_item(Key=key)
+        converted += 1
+    logger.info(f"Legs migration: converted {converted} trips, moved {moved} index items")
+    return converted, moved
+
+
+def rebuild_month_views():
+    """
+    Rebuilds all month search views from the legs in the table, to recover from drift between trips and views.
+    Views of months without trips are emptied. Trips written while the rebuild is running
+    may be missing from the views until they are rebuilt again
+    :return: number of rebuilt views
+    """
+    months = {}
+    for item in scan_items():
+        if not is_trip_item(item):
+            if item['trip_id'].startswith(f"{MONTH_VIEW_KEY_PREFIX}#") and item['user_id'] != LEGACY_INDEX_USER_ID:
+                route, yyyy_mm = item['trip_id'].split("#")[1:]
+                months.setdefault((route, yyyy_mm[:4], yyyy_mm[5:]), [])
+            continue
+        if LEG_DATE_KEY not in item:
+            continue
+        leg = leg_from_item(item)
+        months.setdefault((leg['route'], leg['date'][:4], leg['date'][5:7]), []).append(leg)
+    for key, trips in months.items():
+        put_month_view(key, trips, force=True)
+    logger.info(f"Rebuilt {len(months)} month views")
+    return len(months)
+
+
+def enable_ttl():
+    """
+    Turns on DynamoDB TTL on the expiry attribute, so expired trips and month views are deleted automatically
+    """
+    get_table().update_time_to_live(TimeToLiveSpecification={"Enabled": True, "AttributeName": EXPIRY_ATTRIBUTE})
+    logger.info(f"TTL enabled on {EXPIRY_ATTRIBUTE}")
+
+
+def backfill_expiry():
+    """
+    Sets the expiry attribute of trips saved before it was introduced. Safe to re-run.
+    :return: number of updated trips
+    """
+    updated = 0
+    for item in scan_items(FilterExpression="attribute_not_exists(#expires_at)",
+                           ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE}):
+        # Trips saved before legs have only the dates
+        legs = item.get('legs') or legs_from_dates(item)
+        if not is_trip_item(item) or not legs:
+            continue
+        try:
+            get_table().update_item(
+                Key={'user_id': item['user_id'], 'trip_id': item['trip_id']},
+                UpdateExpression="SET #expires_at = :expires_at",
+                ConditionExpression="attribute_exists(trip_id)",
+                ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE},
+                ExpressionAttributeValues={":expires_at": trip_expiry({'legs': legs})}
+            )
+            updated += 1
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    logger.info(f"Expiry backfill: updated {updated} trips")
+    return updated
+
+
+def archive_expired(delete=False, batch_size=1000):
+    """
+    Archives trips that have expired but weren't deleted by TTL yet, for deployments without a DynamoDB stream
+    :param delete: delete the archived trips from the table
+    :param batch_size: number of trips per archive file
+    :return: number of archived trips
+    """
+    from archive import get_archive, archived_trip
+    archive = get_archive()
+    if archive is None:
+        raise SystemExit("ARCHIVE_URL is not set")
+    now = int(time.time())
+    archived = 0
+    batch = []
+    # Keys of every expired leg, the trip is archived from one of them
+    keys = []
+
+    def flush():
+        archive.write(batch)
+        if delete:
+            batch_write({'DeleteRequest': {'Key': key}} for key in keys)
+        batch.clear()
+        keys.clear()
+
+    for item in scan_items(FilterExpression="#expires_at < :now",
+                           ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE},
+                           ExpressionAttributeValues={":now": now}):
+        if not is_trip_item(item):
+            continue
+        keys.append({'user_id': item['user_id'], 'trip_id': item['trip_id']})
+        trip = archived_trip(item)
+        if trip is None:
+            continue
+        batch.append(trip)
+        archived += 1
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    logger.info(f"Archived {archived} expired trips")
+    return archived
+
+
+def open_dump(path, mode):
+    return gzip.open(path, mode + "t", encoding="utf-8") if path.endswith(".gz") else open(path, mode, encoding="utf-8")
+
+
+def export_items(path, segments=4):
+    """
+    Exports the whole table to a JSON lines file (gzipped if the path ends with .gz),
+    scanning table segments in parallel
+    :param path: output file
+    :param segments: number of segments scanned in parallel
+    :return: number of exported items
+    """
+    from archive import json_default
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def export_segment(file, segment):
+        exported = 0
+        for item in scan_items(Segment=segment, TotalSegments=segments):
+            line = json.dumps(item, default=json_default, ensure_ascii=False) + "\n"
+            with lock:
+                file.write(line)
+            exported += 1
+        return exported
+
+    with open_dump(path, "w") as file, ThreadPoolExecutor(max_workers=segments) as executor:
+        exported = sum(executor.map(lambda segment: export_segment(file, segment), range(segments)))
+    elapsed = time.perf_counter() - started
+    logger.info(f"Exported {exported} items in {elapsed:.1f}s, {exported / elapsed:.0f} items/s")
+    return exported
+
+
+def import_items(path, workers=4):
+    """
+    Imports items from a JSON lines file made by export_items with batch writes.
+    Existing items with the same keys are overwritten
+    :param path: input file
+    :param workers: number of batch writes in flight
+    :return: number of imported items
+    """
+    started = time.perf_counter()
+    imported = 0
+    with open_dump(path, "r") as file, ThreadPoolExecutor(max_workers=workers) as executor:
+        # DynamoDB numbers have to be ints or Decimals
+        items = (json.loads(line, parse_float=Decimal) for line in file if line.strip())
+        pending = set()
+        while True:
+            chunk = [{'PutRequest': {'Item': item}} for item in islice(items, BATCH_WRITE_SIZE)]
+            if not chunk:
+                break
+            pending.add(executor.submit(batch_write, chunk))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                imported += sum(future.result() for future in done)
+        imported += sum(future.result() for future in pending)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Imported {imported} items in {elapsed:.1f}s, {imported / elapsed:.0f} items/s")
+    return imported
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Carrier bot maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate-legs", help="convert trips with two dates to items of their legs, "
+                                             "move month views and subscriptions to their partitions")
+    commands.add_parser("rebuild-views", help="rebuild month search views from the trips")
+    commands.add_parser("enable-ttl", help="turn on DynamoDB TTL on the expiry attribute")
+    commands.add_parser("backfill-expiry", help="set the expiry attribute of trips saved without it")
+    archive_parser = commands.add_parser("archive-expired", help="archive expired trips to ARCHIVE_URL")
+    archive_parser.add_argument("--delete", action="store_true", help="delete archived trips from the table")
+    export_parser = commands.add_parser("export", help="export all items to a JSON lines file")
+    export_parser.add_argument("path", help="output file, gzipped if it ends with .gz")
+    export_parser.add_argument("--segments", type=int, default=4, help="number of segments scanned in parallel")
+    import_parser = commands.add_parser("import", help="import items from a file made by export")
+    import_parser.add_argument("path", help="input file, gzipped if it ends with .gz")
+    import_parser.add_argument("--workers", type=int, default=4, help="number of batch writes in flight")
+    args = parser.parse_args()
+
+    if args.command == "migrate-legs":
+        migrate_legs()
+    elif args.command == "rebuild-views":
+        rebuild_month_views()
+    elif args.command == "enable-ttl":
+        enable_ttl()
+    elif args.command == "backfill-expiry":
+        backfill_expiry()
+    elif args.command == "archive-expired":
+        archive_expired(args.delete)
+    elif args.command == "export":
+        export_items(args.path, args.segments)
+    elif args.command == "import":
+        import_items(args.path, args.workers)
+
+
+if __name__ == "__main__":
+    main()
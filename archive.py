@@ -0,0 +1,129 @@
+"""
+Archival of expired trips for statistics.
+Trips are written as gzip-compressed JSON lines files, one file per batch, to ARCHIVE_URL:
+a local directory (/path or file:///path) or an S3-compatible bucket (s3://bucket/prefix,
+ARCHIVE_S3_ENDPOINT_URL points to a non-AWS endpoint).
+stream_handler is a Lambda handler for the table's DynamoDB stream (OLD_IMAGE or NEW_AND_OLD_IMAGES view),
+which archives trips deleted by TTL. Deployments without streams can use "python admin.py archive-expired"
+"""
+import gzip
+import json
+import os
+import urllib.parse
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from carrier_bot import logger, is_trip_item
+from storage import trip_from_item, LEG_DATE_KEY
+
+ARCHIVE_URL = os.environ.get('ARCHIVE_URL')
+ARCHIVE_S3_ENDPOINT_URL = os.environ.get('ARCHIVE_S3_ENDPOINT_URL')
+# TTL deletions are attributed to this principal in stream records
+TTL_PRINCIPAL = 'dynamodb.amazonaws.com'
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class TripArchive:
+    def __init__(self, url):
+        """
+        :param url: local directory, file:// or s3:// URL
+        """
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme or 'file'
+        if self.scheme == 's3':
+            self.bucket, self.prefix = parsed.netloc, parsed.path.strip('/')
+            self._s3 = None
+        elif self.scheme == 'file':
+            self.directory = parsed.path if parsed.scheme else url
+        else:
+            raise ValueError(f"Unsupported archive URL: {url}")
+
+    def _s3_client(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client('s3', endpoint_url=ARCHIVE_S3_ENDPOINT_URL)
+        return self._s3
+
+    def write(self, trips):
+        """
+        Writes trips into a new archive file
+        :param trips: list of trips, see archived_trip
+        :return: location of the file, or None if there were no trips
+        """
+        if not trips:
+            return None
+        lines = "".join(json.dumps(trip, default=json_default, ensure_ascii=False) + "\n" for trip in trips)
+        body = gzip.compress(lines.encode("utf-8"))
+        now = datetime.now(timezone.utc)
+        name = f"{now:%Y/%m/%d}/trips-{now:%H%M%S}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+        if self.scheme == 's3':
+            key = f"{self.prefix}/{name}" if self.prefix else name
+            self._s3_client().put_object(Bucket=self.bucket, Key=key, Body=body, ContentEncoding="gzip",
+                                         ContentType="application/x-ndjson")
+            location = f"s3://{self.bucket}/{key}"
+        else:
+            location = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, "wb") as file:
+                file.write(body)
+        logger.info(f"Archived {len(trips)} trips to {location}")
+        return location
+
+
+_archive = None
+
+
+def get_archive():
+    """
+    :return: TripArchive for ARCHIVE_URL, or None if archival is not configured
+    """
+    global _archive
+    if _archive is None and ARCHIVE_URL:
+        _archive = TripArchive(ARCHIVE_URL)
+    return _archive
+
+
+def archived_trip(item):
+    """
+    Every leg item holds the whole trip, so a trip is archived from the item of its first leg only
+    :param item: expired trip item
+    :return: trip to archive, or None if the item is another leg of the trip
+    """
+    # Trips saved before legs are archived as they are
+    if LEG_DATE_KEY not in item:
+        return item
+    if item['route'] != item['legs'][0]['route']:
+        return None
+    return trip_from_item(item)
+
+
+def stream_handler(event, context):
+    """
+    DynamoDB stream Lambda handler. Archives trips removed by TTL, other records are ignored.
+    Errors are raised, so the batch is retried by the event source mapping
+    """
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    trips = []
+    for record in event.get('Records', []):
+        if record.get('eventName') != 'REMOVE' or record.get('userIdentity', {}).get('principalId') != TTL_PRINCIPAL:
+            continue
+        old_image = record['dynamodb'].get('OldImage')
+        if not old_image:
+            continue
+        item = {key: deserializer.deserialize(value) for key, value in old_image.items()}
+        trip = archived_trip(item) if is_trip_item(item) else None
+        if trip is not None:
+            trips.append(trip)
+    archive = get_archive()
+    if archive is None:
+        if trips:
+            logger.warning(f"ARCHIVE_URL is not set, {len(trips)} expired trips are not archived")
+        return
+    archive.write(trips)
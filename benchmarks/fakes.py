@@ -0,0 +1,495 @@
+"""
+Offline stand-ins for the bot's dependencies:
+InMemoryTable implements the DynamoDBTable methods used by carrier_bot on top of a dict,
+FakeTelegramServer is a local HTTP endpoint answering Bot API calls with configurable latency.
+"""
+import copy
+import http.server
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+from functools import lru_cache
+
+from botocore.exceptions import ClientError
+
+TOKEN_REGEX = re.compile(r"\s*(<>|<=|>=|[=<>(),+\-]|[#:]?[A-Za-z_]\w*(?:\.#?[A-Za-z_]\w*)*)")
+KEYWORDS = ("AND", "OR", "NOT", "BETWEEN", "IN", "SET", "REMOVE", "ADD", "DELETE")
+TRIPS_TABLE_INDEXES = {
+    'route_month-index': ('route_month', 'leg_date'),
+}
+
+
+def tokenize(expression):
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_REGEX.match(expression, position)
+        if not match:
+            raise ValueError(f"Invalid expression: {expression}")
+        token = match.group(1)
+        tokens.append(token.upper() if token.upper() in KEYWORDS else token)
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser of DynamoDB condition and update expressions.
+    Expressions are compiled to functions of (item, names, values), so they can be cached by expression text
+    """
+
+    def __init__(self, expression):
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or expected is not None and token != expected:
+            raise ValueError(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def parse_path(self):
+        segments = self.take().split(".")
+        return lambda names: [names.get(segment, segment) for segment in segments]
+
+    def parse_operand(self):
+        token = self.peek()
+        if token.startswith(":"):
+            self.take()
+            return lambda item, names, values: values[token]
+        if token in ("if_not_exists", "list_append", "size"):
+            self.take()
+            self.take("(")
+            arguments = [self.parse_value()]
+            while self.peek() == ",":
+                self.take(",")
+                arguments.append(self.parse_value())
+            self.take(")")
+            return self.function(token, arguments)
+        path = self.parse_path()
+        return lambda item, names, values: get_path(item, path(names))
+
+    def parse_value(self):
+        operand = self.parse_operand()
+        if self.peek() in ("+", "-"):
+            sign = 1 if self.take() == "+" else -1
+            right = self.parse_operand()
+            return lambda item, names, values: operand(item, names, values) + sign * right(item, names, values)
+        return operand
+
+    @staticmethod
+    def function(name, arguments):
+        if name == "if_not_exists":
+            return lambda item, names, values: (arguments[0](item, names, values)
+                                                if arguments[0](item, names, values) is not None
+                                                else arguments[1](item, names, values))
+        if name == "list_append":
+            return lambda item, names, values: arguments[0](item, names, values) + arguments[1](item, names, values)
+        return lambda item, names, values: len(arguments[0](item, names, values))
+
+    def parse_condition(self):
+        left = self.parse_and()
+        while self.peek() == "OR":
+            self.take()
+            left = (lambda first, second: lambda *args: first(*args) or second(*args))(left, self.parse_and())
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.peek() == "AND":
+            self.take()
+            left = (lambda first, second: lambda *args: first(*args) and second(*args))(left, self.parse_not())
+        return left
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.take()
+            condition = self.parse_not()
+            return lambda *args: not condition(*args)
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        token = self.peek()
+        if token == "(":
+            self.take()
+            condition = self.parse_condition()
+            self.take(")")
+            return condition
+        if token in ("attribute_exists", "attribute_not_exists", "begins_with", "contains"):
+            self.take()
+            self.take("(")
+            path = self.parse_path()
+            argument = None
+            if self.peek() == ",":
+                self.take(",")
+                argument = self.parse_operand()
+            self.take(")")
+            return self.condition_function(token, path, argument)
+        left = self.parse_value()
+        operator = self.take()
+        if operator == "BETWEEN":
+            low = self.parse_value()
+            self.take("AND")
+            high = self.parse_value()
+            return lambda *args: compare(low(*args), "<=", left(*args)) and compare(left(*args), "<=", high(*args))
+        if operator == "IN":
+            self.take("(")
+            candidates = [self.parse_value()]
+            while self.peek() == ",":
+                self.take(",")
+                candidates.append(self.parse_value())
+            self.take(")")
+            return lambda *args: left(*args) in [candidate(*args) for candidate in candidates]
+        right = self.parse_value()
+        return lambda *args: compare(left(*args), operator, right(*args))
+
+    @staticmethod
+    def condition_function(name, path, argument):
+        if name == "attribute_exists":
+            return lambda item, names, values: get_path(item, path(names)) is not None
+        if name == "attribute_not_exists":
+            return lambda item, names, values: get_path(item, path(names)) is None
+
+        def check(item, names, values):
+            value = get_path(item, path(names))
+            if value is None:
+                return False
+            if name == "begins_with":
+                return value.startswith(argument(item, names, values))
+            return argument(item, names, values) in value
+        return check
+
+    def parse_update(self):
+        actions = []
+        while self.peek() is not None:
+            clause = self.take()
+            while True:
+                path = self.parse_path()
+                if clause == "SET":
+                    self.take("=")
+                    actions.append((clause, path, self.parse_value()))
+                elif clause == "REMOVE":
+                    actions.append((clause, path, None))
+                elif clause in ("ADD", "DELETE"):
+                    actions.append((clause, path, self.parse_operand()))
+                else:
+                    raise ValueError(f"Unknown update clause {clause}")
+                if self.peek() != ",":
+                    break
+                self.take(",")
+        return actions
+
+
+def compare(left, operator, right):
+    if left is None or right is None:
+        return operator == "<>" and left != right
+    if operator == "=":
+        return left == right
+    if operator == "<>":
+        return left != right
+    if isinstance(left, (int, Decimal)) != isinstance(right, (int, Decimal)):
+        return False
+    return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[operator]
+
+
+def get_path(item, path):
+    value = item
+    for segment in path:
+        if not isinstance(value, dict) or segment not in value:
+            return None
+        value = value[segment]
+    return value
+
+
+@lru_cache(maxsize=256)
+def compile_condition(expression):
+    parser = Parser(expression)
+    condition = parser.parse_condition()
+    if parser.peek() is not None:
+        raise ValueError(f"Unexpected {parser.peek()} in {expression}")
+    return condition
+
+
+@lru_cache(maxsize=256)
+def compile_update(expression):
+    return Parser(expression).parse_update()
+
+
+def conditional_check_failed(operation):
+    return ClientError({"Error": {"Code": "ConditionalCheckFailedException",
+                                  "Message": "The conditional request failed"}}, operation)
+
+
+class InMemoryTable:
+    """
+    In-memory stand-in for DynamoDBTable. Supports the get_item, put_item, update_item, delete_item,
+    query, scan, batch_write_item and transact_write_items (Put and Delete) parameters used by the bot,
+    including GSI queries, condition, filter and update expressions, Limit/ExclusiveStartKey pagination
+    and ReturnValues.
+    Items are copied in and out like over the wire.
+    """
+
+    def __init__(self, partition_key='user_id', sort_key='trip_id', indexes=None, latency=0.0, unprocessed_rate=0.0):
+        """
+        :param partition_key: Table partition key
+        :param sort_key: Table sort key
+        :param indexes: Dictionary of GSI name to tuple of its partition and sort keys
+        :param latency: Seconds every call sleeps to emulate network round trip
+        :param unprocessed_rate: Share of batch write requests returned as unprocessed, to emulate throttling
+        """
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.indexes = TRIPS_TABLE_INDEXES if indexes is None else indexes
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self._random = random.Random(0)
+        self.items = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _start_call(self, operation):
+        self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, item):
+        return item[self.partition_key], item[self.sort_key]
+
+    @staticmethod
+    def _check(operation, expression, item, names, values):
+        if expression and not compile_condition(expression)(item or {}, names or {}, values or {}):
+            raise conditional_check_failed(operation)
+
+    @staticmethod
+    def _project(item, projection, names):
+        if not projection:
+            return copy.deepcopy(item)
+        attributes = [names.get(name.strip(), name.strip()) for name in projection.split(",")]
+        return {name: copy.deepcopy(item[name]) for name in attributes if name in item}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self._start_call("get_item")
+        with self._lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            return {"Item": self._project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues=None, **kwargs):
+        self._start_call("put_item")
+        with self._lock:
+            key = self._key(Item)
+            old_item = self.items.get(key)
+            self._check("PutItem", ConditionExpression, old_item, ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items[key] = copy.deepcopy(Item)
+            return {"Attributes": copy.deepcopy(old_item)} if ReturnValues == "ALL_OLD" and old_item else {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, **kwargs):
+        self._start_call("delete_item")
+        with self._lock:
+            key = self._key(Key)
+            old_item = self.items.get(key)
+            self._check("DeleteItem", ConditionExpression, old_item, ExpressionAttributeNames,
+                        ExpressionAttributeValues)
+            self.items.pop(key, None)
+            return {"Attributes": old_item} if ReturnValues == "ALL_OLD" and old_item else {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, **kwargs):
+        self._start_call("update_item")
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        with self._lock:
+            key = self._key(Key)
+            old_item = self.items.get(key)
+            self._check("UpdateItem", ConditionExpression, old_item, names, values)
+            item = copy.deepcopy(old_item) if old_item else copy.deepcopy(Key)
+            for action, path, operand in compile_update(UpdateExpression):
+                path = path(names)
+                parent = get_path(item, path[:-1])
+                if not isinstance(parent, dict):
+                    raise ClientError({"Error": {"Code": "ValidationException", "Message":
+                                                 "The document path provided in the update expression is invalid"}},
+                                      "UpdateItem")
+                if action == "SET":
+                    parent[path[-1]] = copy.deepcopy(operand(item, names, values))
+                elif action == "REMOVE":
+                    parent.pop(path[-1], None)
+                elif action == "ADD" and isinstance(operand(item, names, values), set):
+                    parent[path[-1]] = parent.get(path[-1], set()) | operand(item, names, values)
+                elif action == "ADD":
+                    parent[path[-1]] = parent.get(path[-1], 0) + operand(item, names, values)
+                else:
+                    parent[path[-1]] = parent.get(path[-1], set()) - operand(item, names, values)
+            self.items[key] = item
+            if ReturnValues == "ALL_OLD" and old_item:
+                return {"Attributes": old_item}
+            if ReturnValues in ("ALL_NEW", "UPDATED_NEW"):
+                return {"Attributes": copy.deepcopy(item)}
+            return {}
+
+    def batch_write_item(self, requests):
+        self._start_call("batch_write_item")
+        if len(requests) > 25:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message":
+                                         "Too many items requested for the BatchWriteItem call"}}, "BatchWriteItem")
+        unprocessed = []
+        with self._lock:
+            for request in requests:
+                if self.unprocessed_rate and self._random.random() < self.unprocessed_rate:
+                    unprocessed.append(request)
+                elif "PutRequest" in request:
+                    item = request["PutRequest"]["Item"]
+                    self.items[self._key(item)] = copy.deepcopy(item)
+                else:
+                    self.items.pop(self._key(request["DeleteRequest"]["Key"]), None)
+        return unprocessed
+
+    def transact_write_items(self, actions):
+        self._start_call("transact_write_items")
+        if len(actions) > 100:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message":
+                                         "Too many actions requested for the TransactWriteItems call"}},
+                              "TransactWriteItems")
+        with self._lock:
+            # Every condition is checked before any item is written, like the transaction is applied at once
+            reasons = []
+            for action in actions:
+                kind, parameters = next(iter(action.items()))
+                old_item = self.items.get(self._key(parameters.get("Item") or parameters["Key"]))
+                try:
+                    self._check(kind, parameters.get("ConditionExpression"), old_item,
+                                parameters.get("ExpressionAttributeNames"), parameters.get("ExpressionAttributeValues"))
+                except ClientError:
+                    reasons.append({"Code": "ConditionalCheckFailed"})
+                else:
+                    reasons.append({"Code": "None"})
+            if any(reason["Code"] != "None" for reason in reasons):
+                raise ClientError({"Error": {"Code": "TransactionCanceledException",
+                                             "Message": "Transaction cancelled"},
+                                   "CancellationReasons": reasons}, "TransactWriteItems")
+            for action in actions:
+                kind, parameters = next(iter(action.items()))
+                if kind == "Put":
+                    self.items[self._key(parameters["Item"])] = copy.deepcopy(parameters["Item"])
+                else:
+                    self.items.pop(self._key(parameters["Key"]), None)
+        return {}
+
+    def _read(self, operation, items, sort_key, Limit=None, ExclusiveStartKey=None, FilterExpression=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              ScanIndexForward=True, Select=None, **kwargs):
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        order = (lambda item: (item.get(sort_key), self._key(item))) if sort_key else self._key
+        items = sorted(items, key=order, reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = order(ExclusiveStartKey)
+            items = [item for item in items if (order(item) < start if not ScanIndexForward else order(item) > start)]
+        response = {}
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            last_item = items[-1]
+            response["LastEvaluatedKey"] = {name: last_item[name] for name in
+                                            {self.partition_key, self.sort_key, sort_key} if name in last_item}
+        response["ScannedCount"] = len(items)
+        if FilterExpression:
+            condition = compile_condition(FilterExpression)
+            items = [item for item in items if condition(item, names, values)]
+        response["Count"] = len(items)
+        if Select != "COUNT":
+            response["Items"] = [self._project(item, ProjectionExpression, names) for item in items]
+        return response
+
+    def query(self, KeyConditionExpression, IndexName=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, **kwargs):
+        self._start_call("query")
+        partition_key, sort_key = self.indexes[IndexName] if IndexName else (self.partition_key, self.sort_key)
+        condition = compile_condition(KeyConditionExpression)
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        with self._lock:
+            # Like in GSIs, items without the index keys are not in the index
+            items = [item for item in self.items.values()
+                     if partition_key in item and sort_key in item and condition(item, names, values)]
+            return self._read("Query", items, sort_key, ExpressionAttributeNames=names,
+                              ExpressionAttributeValues=values, **kwargs)
+
+    def scan(self, Segment=None, TotalSegments=None, **kwargs):
+        self._start_call("scan")
+        with self._lock:
+            items = list(self.items.values())
+            if TotalSegments:
+                items = [item for item in items if hash(self._key(item)) % TotalSegments == Segment]
+            return self._read("Scan", items, None, **kwargs)
+
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        operation = self.path.rsplit("/", 1)[-1]
+        self.server.record_call(operation, data)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        result = True
+        if "chat_id" in data:
+            result = {"message_id": self.server.calls[operation], "chat": {"id": data["chat_id"]},
+                      "date": int(time.time()), "text": data.get("text", "")}
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTelegramServer(http.server.ThreadingHTTPServer):
+    """
+    Local Bot API endpoint which answers every call successfully after the given latency and counts calls
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: Seconds every call takes
+        """
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.latency = latency
+        self.calls = Counter()
+        self.last_messages = {}
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def record_call(self, operation, data):
+        """
+        Counts the call and remembers the last message sent to each chat
+        :param operation: Bot API method
+        :param data: method parameters
+        """
+        self.calls[operation] += 1
+        if operation in ("sendMessage", "editMessageText"):
+            self.last_messages[data["chat_id"]] = data
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,256 @@
+"""
+Offline load test.
+Replays a synthetic stream of updates from simulated users (/start, /help, menu callbacks, save trip wizards,
+searches, my trips and trip deletions) through lambda_handler, with DynamoDB replaced by InMemoryTable
+(or trips stored in a temporary SQLite database with --storage sqlite) and Telegram by FakeTelegramServer,
+and reports throughput and latency percentiles per handler.
+Usage: python benchmarks/load.py [--updates N] [--users N] [--concurrency N] [--trips N] [--storage ENGINE]
+                                 [--telegram-latency MS] [--dynamodb-latency MS] [--webhook-reply] [--seed N]
+"""
+import argparse
+import html
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_API_KEY", "benchmark")
+
+import carrier_bot  # noqa: E402
+from fakes import FakeTelegramServer, InMemoryTable  # noqa: E402
+from storage import SqliteTripStore  # noqa: E402
+from throttle import TokenBucket  # noqa: E402
+from vars import START_COMMAND, HELP_COMMAND, ROUTE_TO_BELARUS, ROUTE_TO_SPAIN  # noqa: E402
+
+LINK_REGEX = re.compile(r'<a href="([^"]*)">(.*?)</a>', re.S)
+USER_URL = "tg://user?id="
+# Scenario name -> weight in the stream
+SCENARIOS = {"start": 10, "help": 3, "menu": 10, "search": 30, "save": 20, "my_trips": 15, "delete": 12}
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def utf16_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def received_message(sent):
+    """
+    Converts a message sent by the bot with HTML parse mode into the message as Telegram delivers it in replies,
+    i.e. with tags stripped, entities unescaped, user links turned into text_mention entities, other links
+    into text_link entities and trailing whitespace removed
+    :param sent: sendMessage/editMessageText parameters
+    :return: message dict
+    """
+    html_text = sent["text"]
+    message = {"message_id": 1, "chat": {"id": sent["chat_id"]}}
+    if "reply_markup" in sent:
+        message["reply_markup"] = sent["reply_markup"]
+    if sent.get("parse_mode") != "HTML":
+        message["text"] = html_text.rstrip()
+        return message
+    text, entities, position = "", [], 0
+    for match in LINK_REGEX.finditer(html_text):
+        text += html.unescape(html_text[position:match.start()])
+        link_text, url = html.unescape(match.group(2)), html.unescape(match.group(1))
+        # Offsets are in UTF-16 code units
+        entity = {"offset": utf16_length(text), "length": utf16_length(link_text)}
+        if url.startswith(USER_URL):
+            entity.update(type="text_mention", user={"id": int(url[len(USER_URL):]), "is_bot": False,
+                                                     "first_name": link_text})
+        else:
+            entity.update(type="text_link", url=url)
+        entities.append(entity)
+        text += link_text
+        position = match.end()
+    message["text"] = (text + html.unescape(html_text[position:])).rstrip()
+    if entities:
+        message["entities"] = entities
+    return message
+
+
+class SimulatedUser:
+    """
+    Generates the updates of one user. A scenario, e.g. saving a trip, is a sequence of steps,
+    later steps reply to the messages the bot sent in the previous ones
+    """
+
+    def __init__(self, user_id, rng, telegram, table):
+        self.user_id = user_id
+        self.rng = rng
+        self.telegram = telegram
+        self.table = table
+        self.steps = []
+        self.update_id = user_id * 1000000
+
+    def message(self, text, reply_to=None):
+        self.update_id += 1
+        message = {"message_id": self.update_id, "chat": {"id": self.user_id}, "date": int(time.time()),
+                   "text": text, "from": {"id": self.user_id, "first_name": f"User {self.user_id}"}}
+        if reply_to is not None:
+            message["reply_to_message"] = reply_to
+        return {"update_id": self.update_id, "message": message}
+
+    def callback(self, data, message=None):
+        self.update_id += 1
+        return {"update_id": self.update_id,
+                "callback_query": {"id": str(self.update_id), "data": data,
+                                   "from": {"id": self.user_id, "first_name": f"User {self.user_id}"},
+                                   "message": message or {"message_id": 1, "chat": {"id": self.user_id}}}}
+
+    def delete_trip_callback(self):
+        """
+        Presses a random delete button of the "my trips" message the bot sent last
+        """
+        message = self.last_bot_message()
+        buttons = [row[0]["callback_data"] for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                   if row[0]["callback_data"].startswith("/deletetrip_")]
+        if not buttons:
+            return self.callback("/getmytrips", message)
+        return self.callback(self.rng.choice(buttons), message)
+
+    def last_bot_message(self):
+        return received_message(self.telegram.last_messages[self.user_id])
+
+    def random_date(self):
+        return date.today() + timedelta(days=self.rng.randint(1, 365))
+
+    def start_scenario(self):
+        scenario = self.rng.choices(list(SCENARIOS), weights=list(SCENARIOS.values()))[0]
+        if scenario == "start":
+            self.steps = [("message /start", lambda: self.message(START_COMMAND))]
+        elif scenario == "help":
+            self.steps = [("message /help", lambda: self.message(HELP_COMMAND))]
+        elif scenario == "menu":
+            self.steps = [("callback /start", lambda: self.callback(START_COMMAND))]
+        elif scenario == "search":
+            direction = self.rng.choice(["/searchbelarusdate", "/searchspaindate", "/searchanydate"])
+            target = self.random_date()
+            query = self.rng.choice([
+                target.strftime("%m-%Y"),
+                f"{target:%d-%m-%Y}..{target + timedelta(days=self.rng.randint(0, 14)):%d-%m-%Y}",
+                f"{target:%d-%m-%Y} ±{self.rng.randint(0, 7)}",
+            ])
+            self.steps = [
+                ("callback /searchtrips", lambda: self.callback("/searchtrips")),
+                ("callback /search<direction>date", lambda: self.callback(direction)),
+                ("search", lambda: self.message(query, self.last_bot_message())),
+            ]
+        elif scenario == "save":
+            self.steps = [
+                ("callback /savetrip", lambda: self.callback("/savetrip")),
+                ("savetrip step 1", lambda: self.message(self.random_date().strftime("%d-%m-%Y"),
+                                                         self.last_bot_message())),
+                ("savetrip step 2", lambda: self.message(
+                    self.rng.choice(["-", self.random_date().strftime("%d-%m-%Y")]), self.last_bot_message())),
+                ("savetrip step 3", lambda: self.message("Can take documents", self.last_bot_message())),
+            ]
+        elif scenario == "my_trips":
+            self.steps = [("callback /getmytrips", lambda: self.callback("/getmytrips"))]
+        else:
+            self.steps = [("callback /getmytrips", lambda: self.callback("/getmytrips")),
+                          ("callback /deletetrip", self.delete_trip_callback)]
+
+    def next_update(self):
+        if not self.steps:
+            self.start_scenario()
+        label, make_update = self.steps.pop(0)
+        return label, make_update()
+
+
+def seed_trips(count, rng):
+    for index in range(count):
+        legs = [{"route": ROUTE_TO_BELARUS, "date": str(date.today() + timedelta(days=rng.randint(1, 365)))}]
+        if rng.random() < 0.5:
+            legs.append({"route": ROUTE_TO_SPAIN, "date": str(date.today() + timedelta(days=rng.randint(1, 365)))})
+        trip = {"trip_id": f"seed{index}", "first_name": f"Carrier {index}", "note": "Seeded trip", "legs": legs}
+        carrier_bot.save_trip_data(10 ** 9 + index, trip)
+
+
+def run_worker(users, count, telegram, timings, lock):
+    rng = users[0].rng
+    for _ in range(count):
+        user = rng.choice(users)
+        label, update = user.next_update()
+        started = time.perf_counter()
+        response = carrier_bot.lambda_handler({"body": json.dumps(update)}, None)
+        elapsed = time.perf_counter() - started
+        webhook_reply = json.loads(response["body"])
+        if "method" in webhook_reply:
+            telegram.record_call(webhook_reply.pop("method"), webhook_reply)
+        with lock:
+            timings[label].append(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the bot")
+    parser.add_argument("--updates", type=int, default=2000, help="number of updates to replay")
+    parser.add_argument("--users", type=int, default=50, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of concurrent invocations")
+    parser.add_argument("--trips", type=int, default=500, help="number of trips saved before the test")
+    parser.add_argument("--storage", choices=["dynamodb", "sqlite"], default="dynamodb", help="trip storage engine")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="Telegram API latency, ms")
+    parser.add_argument("--dynamodb-latency", type=float, default=0, help="DynamoDB call latency, ms")
+    parser.add_argument("--webhook-reply", action="store_true", help="return API calls in webhook responses")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+
+    table = InMemoryTable(latency=args.dynamodb_latency / 1000)
+    carrier_bot.use_table(table)
+    database = tempfile.TemporaryDirectory()
+    if args.storage == "sqlite":
+        carrier_bot.use_store(SqliteTripStore(os.path.join(database.name, "trips.sqlite3")))
+    carrier_bot.TELEGRAM_WEBHOOK_REPLY = args.webhook_reply
+    # Latencies are reported by the test itself, a metrics record per update would only flood the output
+    carrier_bot.metrics.enabled = False
+    # The fake Telegram API has no rate limits, the test measures the bot's own throughput
+    carrier_bot.telegram_limiter = TokenBucket(float("inf"))
+    seed_trips(args.trips, random.Random(args.seed))
+    table.calls.clear()
+
+    with FakeTelegramServer(latency=args.telegram_latency / 1000) as telegram:
+        carrier_bot.telegram_client = carrier_bot.TelegramApiClient(
+            f"{telegram.url}/botbenchmark/", carrier_bot.TELEGRAM_CONNECT_TIMEOUT, carrier_bot.TELEGRAM_READ_TIMEOUT,
+            carrier_bot.TELEGRAM_POOL_SIZE)
+        timings, lock = defaultdict(list), threading.Lock()
+        # Every worker owns its users, so updates from one chat are never handled concurrently
+        workers = []
+        for worker in range(args.concurrency):
+            rng = random.Random(args.seed + worker)
+            users = [SimulatedUser(user_id, rng, telegram, table)
+                     for user_id in range(worker + 1, args.users + 1, args.concurrency)]
+            count = args.updates // args.concurrency + (worker < args.updates % args.concurrency)
+            workers.append(threading.Thread(target=run_worker, args=(users, count, telegram, timings, lock)))
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in timings.values())
+    print(f"{total} updates in {elapsed:.2f}s, {total / elapsed:.1f} updates/s, concurrency {args.concurrency}\n")
+    print(f"{'handler':<34}{'count':>7}{'mean, ms':>10}{'p50, ms':>10}{'p95, ms':>10}{'p99, ms':>10}")
+    for label, values in sorted(timings.items()):
+        values.sort()
+        print(f"{label:<34}{len(values):>7}{sum(values) / len(values) * 1000:>10.2f}"
+              f"{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.95) * 1000:>10.2f}"
+              f"{percentile(values, 0.99) * 1000:>10.2f}")
+    print(f"\nDynamoDB calls: {dict(table.calls)}")
+    print(f"Telegram calls: {dict(telegram.calls)}")
+    database.cleanup()
+
+
+if __name__ == "__main__":
+    main()
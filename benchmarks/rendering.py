@@ -0,0 +1,129 @@
+"""
+Rendering micro-benchmark.
+Compares CPU time and peak allocated memory of building Telegram API request bodies the way it was done before
+the rendering layer (json.dumps of whole payloads, deepcopy of keyboards, text built with +=)
+with the current render.py path, for a static reply, "my trips" and a search results page.
+Usage: python benchmarks/rendering.py [--iterations N] [--trips N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_API_KEY", "benchmark")
+
+import carrier_bot  # noqa: E402
+from render import encode_json, render_my_trips, render_search_results, search_page_markup  # noqa: E402
+from vars import DUMMY_DATE, GREETING_TEXT, GREETING_INLINE_KEYBOARD, GETMYTRIPS_INLINE_KEYBOARD, \
+    SEARCH_END_KEYBOARD, SEARCH_NEXT_PAGE_TEXT, ROUTE_TO_BELARUS  # noqa: E402
+
+NEXT_PAGE = "/searchpage_b_209901_20990115_1_11"
+
+
+def legacy_static_reply(chat_id):
+    data = carrier_bot.create_data_dictionary(chat_id, GREETING_TEXT, reply_markup=GREETING_INLINE_KEYBOARD)
+    return json.dumps(data).encode("utf-8")
+
+
+def legacy_my_trips(chat_id, trips):
+    trips = deepcopy(trips)  # items were mutated in place, callers got fresh ones from DynamoDB
+    keyboard = deepcopy(GETMYTRIPS_INLINE_KEYBOARD)
+    text = "Вот ваши предстоящие поездки:\n\n"
+    for i, trip in enumerate(trips, start=1):
+        if trip["to_belarus_date"] == DUMMY_DATE:
+            trip["to_belarus_date"] = "-"
+        if trip["to_spain_date"] == DUMMY_DATE:
+            trip["to_spain_date"] = "-"
+        text += f"{i}. " \
+                f"Ваш контакт, как он отобразится в поиске: " \
+                f"<a href=\"tg://user?id={trip['user_id']}\">{trip['first_name']}</a>,\n" \
+                f"Дата поездки в Беларусь: {trip['to_belarus_date']},\n" \
+                f"Дата поездки в Испанию: {trip['to_spain_date']},\n" \
+                f"Примечание: {trip['note']}\n\n"
+        keyboard["inline_keyboard"].insert(i - 1, [{"text": f"Удалить поездку {i}.",
+                                                    "callback_data": f"/deletetrip_{trip['trip_id']}"}])
+    data = carrier_bot.create_data_dictionary(chat_id, text, message_id=1, reply_markup=keyboard, parse_mode="HTML")
+    return json.dumps(data).encode("utf-8")
+
+
+def legacy_search_page(chat_id, trips):
+    text = ''
+    for i, trip in enumerate(trips, start=1):
+        to_belarus_date = "-" if trip["to_belarus_date"] == DUMMY_DATE else trip["to_belarus_date"]
+        to_spain_date = "-" if trip["to_spain_date"] == DUMMY_DATE else trip["to_spain_date"]
+        text += f"{i}. " \
+                f"<a href=\"tg://user?id={trip['user_id']}\">{trip['first_name']}</a>,\n" \
+                f"Дата поездки в Беларусь: {to_belarus_date},\n" \
+                f"Дата поездки в Испанию: {to_spain_date},\n" \
+                f"Примечание: {trip['note']}\n\n"
+    keyboard = {"inline_keyboard": [[{"text": SEARCH_NEXT_PAGE_TEXT, "callback_data": NEXT_PAGE}]]
+                + SEARCH_END_KEYBOARD["inline_keyboard"]}
+    data = carrier_bot.create_data_dictionary(chat_id, text, reply_markup=keyboard, parse_mode="HTML")
+    return json.dumps(data).encode("utf-8")
+
+
+def static_reply(chat_id):
+    return encode_json(carrier_bot.create_data_dictionary(chat_id, carrier_bot.GREETING_REPLY))
+
+
+def my_trips(chat_id, trips):
+    text, keyboard = render_my_trips(trips)
+    return encode_json(carrier_bot.create_data_dictionary(chat_id, text, message_id=1, reply_markup=keyboard,
+                                                          parse_mode="HTML"))
+
+
+def search_page(chat_id, trips):
+    text = render_search_results(trips)
+    keyboard = search_page_markup(NEXT_PAGE)
+    return encode_json(carrier_bot.create_data_dictionary(chat_id, text, reply_markup=keyboard, parse_mode="HTML"))
+
+
+def measure(function, args, iterations):
+    """
+    :return: tuple of CPU microseconds and peak allocated bytes per call
+    """
+    started = time.process_time()
+    for _ in range(iterations):
+        function(*args)
+    cpu = (time.process_time() - started) / iterations * 1e6
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare request rendering before and after the rendering layer")
+    parser.add_argument("--iterations", type=int, default=20000, help="calls per measurement")
+    parser.add_argument("--trips", type=int, default=10, help="trips in my trips and search results")
+    args = parser.parse_args()
+
+    trips = [{"user_id": 1000 + i, "trip_id": f"17100000{i:02}.5", "first_name": f"Перевозчик {i}",
+              "note": "Могу взять документы и мелкие вещи", "to_belarus_date": f"2099-01-{i % 28 + 1:02}",
+              "to_spain_date": DUMMY_DATE, "legs": [{"route": ROUTE_TO_BELARUS, "date": f"2099-01-{i % 28 + 1:02}"}]}
+             for i in range(args.trips)]
+    cases = [
+        ("static reply (/start)", legacy_static_reply, static_reply, (1,)),
+        (f"my trips ({args.trips} trips)", legacy_my_trips, my_trips, (1, trips)),
+        (f"search page ({args.trips} trips)", legacy_search_page, search_page, (1, trips)),
+    ]
+    print(f"{'case':<26}{'before, us':>12}{'after, us':>11}{'before, KB':>12}{'after, KB':>11}"
+          f"{'before, B':>11}{'after, B':>10}")
+    for name, before, after, case_args in cases:
+        before_cpu, before_peak = measure(before, case_args, args.iterations)
+        after_cpu, after_peak = measure(after, case_args, args.iterations)
+        print(f"{name:<26}{before_cpu:>12.2f}{after_cpu:>11.2f}{before_peak / 1024:>12.1f}"
+              f"{after_peak / 1024:>11.1f}{len(before(*case_args)):>11}{len(after(*case_args)):>10}")
+    print("\nKB - peak memory allocated while building one request body, B - request body size")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Cold start benchmark.
+For every command starts a fresh interpreter, which imports carrier_bot and handles a single update,
+and reports import time, first invocation latency and whether boto3 was loaded.
+Telegram API is replaced with a local HTTP server, so only the bot's own startup cost is measured.
+Usage: python benchmarks/startup.py [--runs N] [--dynamodb]
+With --dynamodb commands that query the storage are measured as well, which requires
+DYNAMODB_TABLE_NAME, AWS credentials and region (or AWS_ENDPOINT_URL_DYNAMODB for DynamoDB Local)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vars import START_COMMAND, ABOUT_COMMAND, HELP_COMMAND, SEARCH_BELARUS_TIME_TEXT  # noqa: E402
+from fakes import FakeTelegramServer  # noqa: E402
+
+CHILD_CODE = """
+import json, sys, time
+started = time.perf_counter()
+import carrier_bot
+imported = time.perf_counter()
+carrier_bot.lambda_handler({"body": sys.argv[1]}, None)
+handled = time.perf_counter()
+print(json.dumps({"import": imported - started, "invocation": handled - imported, "boto3": "boto3" in sys.modules}))
+"""
+
+USER = {"id": 1, "first_name": "Benchmark"}
+CHAT = {"id": 1}
+
+
+def message_update(text, reply_to_text=None):
+    message = {"message_id": 1, "chat": CHAT, "from": USER, "text": text}
+    if reply_to_text:
+        message["reply_to_message"] = {"message_id": 2, "chat": CHAT, "text": reply_to_text}
+    return {"update_id": 1, "message": message}
+
+
+def callback_update(data):
+    return {"update_id": 1, "callback_query": {"id": "1", "data": data, "from": USER,
+                                               "message": {"message_id": 1, "chat": CHAT}}}
+
+
+COMMANDS = {
+    START_COMMAND: message_update(START_COMMAND),
+    HELP_COMMAND: message_update(HELP_COMMAND),
+    ABOUT_COMMAND: message_update(ABOUT_COMMAND),
+    "callback /start": callback_update(START_COMMAND),
+    "callback /searchtrips": callback_update("/searchtrips"),
+    "callback /savetrip": callback_update("/savetrip"),
+}
+DYNAMODB_COMMANDS = {
+    "callback /getmytrips": callback_update("/getmytrips"),
+    "search": message_update("03-2024", SEARCH_BELARUS_TIME_TEXT),
+}
+
+
+def run_cold_start(update, env):
+    result = subprocess.run([sys.executable, "-c", CHILD_CODE, json.dumps(update)], env=env, cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure carrier_bot cold start per command")
+    parser.add_argument("--runs", type=int, default=10, help="cold starts per command")
+    parser.add_argument("--dynamodb", action="store_true", help="also measure commands which query DynamoDB")
+    args = parser.parse_args()
+
+    commands = dict(COMMANDS, **DYNAMODB_COMMANDS) if args.dynamodb else COMMANDS
+    with FakeTelegramServer() as telegram:
+        env = dict(os.environ, TELEGRAM_API_KEY="benchmark", TELEGRAM_API_URL=telegram.url,
+                   PYTHONDONTWRITEBYTECODE="1")
+        print(f"{'command':<24}{'import, ms':>12}{'first update, ms':>18}{'boto3 loaded':>14}")
+        for name, update in commands.items():
+            runs = [run_cold_start(update, env) for _ in range(args.runs)]
+            import_time = statistics.median(run["import"] for run in runs) * 1000
+            invocation_time = statistics.median(run["invocation"] for run in runs) * 1000
+            boto3_loaded = any(run["boto3"] for run in runs)
+            print(f"{name:<24}{import_time:>12.1f}{invocation_time:>18.1f}{str(boto3_loaded):>14}")
+
+
+if __name__ == "__main__":
+    main()
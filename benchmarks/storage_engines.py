@@ -0,0 +1,158 @@
+"""
+Storage engine benchmark.
+Loads the same synthetic dataset into each engine and reports bulk load and bulk delete throughput
+and latency percentiles of the operations the bot makes per update: saving and deleting a trip,
+listing the trips of a user, a page of month search results and a date window search.
+Engines: "sqlite" (a new database in a temporary directory, or in --sqlite-dir), "dynamodb" (DYNAMODB_TABLE_NAME,
+AWS_ENDPOINT_URL_DYNAMODB points to DynamoDB Local) and "memory" (InMemoryTable, which scans all items on every
+query, so it only shows the bot's own overhead on small datasets). Loaded trips are deleted at the end.
+Trip owners are synthetic users with IDs from 10^9, five trips each.
+Usage: python benchmarks/storage_engines.py [--engines ENGINE ...] [--sizes N ...] [--queries N] [--sqlite-dir PATH]
+                                            [--seed N]
+e.g. python benchmarks/storage_engines.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from itertools import islice
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_API_KEY", "benchmark")
+
+import carrier_bot  # noqa: E402
+from fakes import InMemoryTable  # noqa: E402
+from storage import DynamoDBTripStore, SqliteTripStore  # noqa: E402
+from vars import ROUTE_TO_BELARUS, ROUTE_TO_SPAIN  # noqa: E402
+
+FIRST_USER_ID = 10 ** 9
+TRIPS_PER_USER = 5
+LOAD_CHUNK_SIZE = 1000
+WINDOW_DAYS = 7
+ROUTES = (ROUTE_TO_BELARUS, ROUTE_TO_SPAIN)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def random_date(rng):
+    return date.today() + timedelta(days=rng.randint(1, 365))
+
+
+def make_trip(index, rng, prefix="bench"):
+    legs = [{"route": ROUTE_TO_BELARUS, "date": str(random_date(rng))}]
+    if rng.random() < 0.5:
+        legs.append({"route": ROUTE_TO_SPAIN, "date": str(random_date(rng))})
+    trip = {"user_id": FIRST_USER_ID + index // TRIPS_PER_USER, "trip_id": f"{prefix}{index}",
+            "first_name": f"Carrier {index}", "note": "Benchmark trip", "legs": legs}
+    trip[carrier_bot.EXPIRY_ATTRIBUTE] = carrier_bot.trip_expiry(trip)
+    return trip
+
+
+def create_store(engine, directory, size):
+    if engine == "sqlite":
+        return SqliteTripStore(os.path.join(directory, f"trips-{size}.sqlite3"))
+    if engine == "memory":
+        carrier_bot.use_table(InMemoryTable())
+    return DynamoDBTripStore()
+
+
+def timed(operation, count):
+    """
+    :param operation: function of the iteration number
+    :return: sorted list of call durations in seconds
+    """
+    timings = []
+    for iteration in range(count):
+        started = time.perf_counter()
+        operation(iteration)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings
+
+
+def run(store, size, queries, seed):
+    """
+    :return: tuple of dict of bulk operation to items per second and dict of operation to sorted durations
+    """
+    throughput, timings = {}, {}
+    rng = random.Random(seed)
+    trips = (make_trip(index, rng) for index in range(size))
+    started = time.perf_counter()
+    while True:
+        chunk = list(islice(trips, LOAD_CHUNK_SIZE))
+        if not chunk:
+            break
+        store.save_trips(chunk)
+    throughput["bulk load"] = size / (time.perf_counter() - started)
+
+    users = size // TRIPS_PER_USER
+    new_trips = [make_trip(size + index, rng, prefix="new") for index in range(queries)]
+    timings["save trip"] = timed(lambda i: store.save_trip(new_trips[i]), queries)
+    timings["user trips"] = timed(
+        lambda i: list(store.user_trips(FIRST_USER_ID + rng.randrange(users))), queries)
+
+    def month_page(_):
+        first_day = random_date(rng).replace(day=1)
+        last_day = (first_day + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+        page_size = carrier_bot.SEARCH_PAGE_SIZE + 1
+        list(islice(store.legs_by_date(rng.choice(ROUTES), str(first_day), str(last_day), page_size), page_size))
+
+    def window(_):
+        first_day = random_date(rng)
+        list(islice(store.legs_by_date(rng.choice(ROUTES), str(first_day), str(first_day + timedelta(WINDOW_DAYS))),
+                    carrier_bot.SEARCH_WINDOW_MAX_TRIPS))
+
+    timings["month page"] = timed(month_page, queries)
+    timings[f"{WINDOW_DAYS}-day window"] = timed(window, queries)
+    timings["delete trip"] = timed(lambda i: store.delete_trip(new_trips[i]["user_id"], new_trips[i]["trip_id"]),
+                                   queries)
+
+    # The loaded trips are generated again, deleting a trip takes its legs
+    rng = random.Random(seed)
+    trips = [make_trip(index, rng) for index in range(size)]
+    started = time.perf_counter()
+    store.delete_trips(trips)
+    throughput["bulk delete"] = size / (time.perf_counter() - started)
+    return throughput, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of trip storage engines")
+    parser.add_argument("--engines", nargs="+", choices=["sqlite", "dynamodb", "memory"],
+                        help="engines to compare, sqlite and dynamodb if DYNAMODB_TABLE_NAME is set by default")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000], help="numbers of trips loaded")
+    parser.add_argument("--queries", type=int, default=200, help="number of calls of every operation")
+    parser.add_argument("--sqlite-dir", help="directory of the SQLite databases, temporary by default")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+    engines = args.engines or (["sqlite", "dynamodb"] if carrier_bot.DYNAMODB_TABLE_NAME else ["sqlite"])
+    if "dynamodb" in engines and not carrier_bot.DYNAMODB_TABLE_NAME:
+        parser.error("DYNAMODB_TABLE_NAME is not set")
+    carrier_bot.metrics.enabled = False
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = args.sqlite_dir or temporary_directory
+        print(f"{'engine':<10}{'trips':>9}  {'operation':<16}{'items/s':>10}{'p50, ms':>10}{'p95, ms':>10}"
+              f"{'p99, ms':>10}")
+        for size in args.sizes:
+            for engine in engines:
+                store = create_store(engine, directory, size)
+                throughput, timings = run(store, size, args.queries, args.seed)
+                for operation, items_per_second in throughput.items():
+                    print(f"{engine:<10}{size:>9}  {operation:<16}{items_per_second:>10.0f}")
+                for operation, values in timings.items():
+                    print(f"{engine:<10}{size:>9}  {operation:<16}{'':>10}{percentile(values, 0.5) * 1000:>10.3f}"
+                          f"{percentile(values, 0.95) * 1000:>10.3f}{percentile(values, 0.99) * 1000:>10.3f}")
+                if engine == "sqlite":
+                    store.close()
+
+
+if __name__ == "__main__":
+    main()
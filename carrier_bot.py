@@ -1,79 +1,921 @@
 import logging
 import json
-import re
 import os
 import time
-import urllib.request
+import random
+import functools
+import math
+import calendar
+import zlib
+import queue
+import http.client
+import threading
 import urllib.parse
-import urllib.error
-from datetime import datetime
-from copy import deepcopy
-
-import boto3
-from boto3.dynamodb.conditions import Key
-from botocore.exceptions import BotoCoreError, ClientError
-
-from vars import START_COMMAND, ABOUT_COMMAND, HELP_COMMAND, DUMMY_DATE, GETMYTRIPS_INLINE_KEYBOARD, GREETING_TEXT, \
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, time as datetime_time, timedelta, timezone
+from itertools import islice
+
+from router import Router, UpdateContext, step_prompt
+from wizard_state import WizardStateCodec
+from throttle import SendThrottle, TokenBucket
+from resilience import Backoff, CircuitBreaker, Deadline
+from storage import SqliteTripStore, DynamoDBTripStore, StorageError, ROUTE_INDEX, ROUTE_MONTH_KEY, LEG_DATE_KEY, \
+    legs_from_dates, trip_leg
+from render import StaticReply, encode_json, render_my_trips, render_my_trips_without, render_search_results, \
+    search_page_markup, unsubscribe_markup, render_trip_alert, DELETE_TRIP_COMMAND
+
+from vars import START_COMMAND, ABOUT_COMMAND, HELP_COMMAND, DUMMY_DATE, GREETING_TEXT, \
     GREETING_INLINE_KEYBOARD, SEARCH_INTRO_TEXT, SEARCH_INTRO_INLINE_KEYBOARD, SEARCH_SPAIN_TIME_TEXT, \
     SEARCH_BELARUS_TIME_TEXT, SAVETRIP_STEP3_TEXT, SAVETRIP_STEP2_TEXT, SAVETRIP_STEP1_TEXT, GENERIC_ERROR_TEXT, \
     SAVE_SUCCESS_INLINE_KEYBOARD, SAVE_SUCCESS_TEXT, INCORRECT_DATE_INLINE_KEYBOARD, INCORRECT_DATE_TEXT, \
-    SEARCH_END_KEYBOARD, INCORRECT_SEARCH_DATE_TEXT, HELP_TEXT, ABOUT_SECOND_MSG_TEXT, ABOUT_TEXT
+    SEARCH_END_KEYBOARD, INCORRECT_SEARCH_DATE_TEXT, HELP_TEXT, ABOUT_SECOND_MSG_TEXT, ABOUT_TEXT, \
+    SEARCH_PAGE_COMMAND, SEARCH_WINDOW_COMMAND, SEARCH_ANY_TIME_TEXT, SEARCH_WINDOW_FORMATS_TEXT, \
+    WIZARD_STATE_ERROR_TEXT, DELETE_ALL_TRIPS_CONFIRM_TEXT, \
+    DELETE_ALL_TRIPS_CONFIRM_INLINE_KEYBOARD, SUBSCRIBE_COMMAND, UNSUBSCRIBE_COMMAND, SUBSCRIBED_TEXT, \
+    UNSUBSCRIBED_TEXT, ROUTE_TO_BELARUS, ROUTE_TO_SPAIN, NO_TRIP_DATES_TEXT
 
 DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME')
+# Trip storage engine, "dynamodb" or "sqlite" (database file SQLITE_PATH), see storage.py.
+# Month views, trip alerts and update markers are only kept with DynamoDB
+STORAGE = os.environ.get('STORAGE', 'dynamodb').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'carrier_bot.sqlite3')
+# Wizard step markers, see router.step_prompt()
+SAVETRIP_STEP1 = 'savetrip1'
+SAVETRIP_STEP2 = 'savetrip2'
+SAVETRIP_STEP3 = 'savetrip3'
+SEARCH_BELARUS_STEP = 'searchb'
+SEARCH_SPAIN_STEP = 'searchs'
+SEARCH_ANY_STEP = 'searcha'
+# Search directions in search steps and paging callbacks and the routes they search: to Belarus, to Spain, either
+DIRECTIONS = {'b': (ROUTE_TO_BELARUS,), 's': (ROUTE_TO_SPAIN,), 'a': (ROUTE_TO_BELARUS, ROUTE_TO_SPAIN)}
+ROUTE_DIRECTIONS = {routes[0]: direction for direction, routes in DIRECTIONS.items() if len(routes) == 1}
+# Worker threads for parallel DynamoDB queries
+DYNAMODB_WORKERS = int(os.environ.get('DYNAMODB_WORKERS', 8))
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 10))
+# Date window searches: days around a date searched if the user didn't give a number,
+# maximum length of a window in days and maximum number of trips ranked per direction
+SEARCH_DEFAULT_WINDOW_DAYS = int(os.environ.get('SEARCH_DEFAULT_WINDOW_DAYS', 3))
+SEARCH_MAX_WINDOW_DAYS = int(os.environ.get('SEARCH_MAX_WINDOW_DAYS', 62))
+SEARCH_WINDOW_MAX_TRIPS = int(os.environ.get('SEARCH_WINDOW_MAX_TRIPS', 500))
+# Month search results are cached in warm containers, months with more trips are paged from the storage directly
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 60))
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+SEARCH_CACHE_MAX_MONTH_TRIPS = int(os.environ.get('SEARCH_CACHE_MAX_MONTH_TRIPS', 1000))
+# Per-month search views are stored in the trips table, every view in its own partition, see index_partition.
+# A view is rebuilt from the date index when it's older than MONTH_VIEW_MAX_AGE seconds. Months whose trips take
+# more than MONTH_VIEW_MAX_BYTES are not materialized, the rest of DynamoDB's 400 KB item limit is left for trips
+# added to the view after it's built
+MONTH_VIEW_KEY_PREFIX = 'month_view'
+MONTH_VIEW_MAX_AGE = int(os.environ.get('MONTH_VIEW_MAX_AGE', 24 * 60 * 60))
+MONTH_VIEW_MAX_BYTES = int(os.environ.get('MONTH_VIEW_MAX_BYTES', 300 * 1024))
+MONTH_VIEW_FIELDS = ('user_id', 'trip_id', 'first_name', 'note', 'legs', 'route', 'date')
+# Attribute with the epoch time DynamoDB TTL deletes the item at. Trips expire this many days after their last leg
+EXPIRY_ATTRIBUTE = 'expires_at'
+TRIP_EXPIRY_DAYS = int(os.environ.get('TRIP_EXPIRY_DAYS', 1))
+# Trip alerts: subscriptions are indexed by route and month, one item per route and month of the window.
+# New trips are handed over to ALERTS_QUEUE_URL (SQS queue consumed by alerts_handler) or, if it's not set,
+# to a background thread. Alerts are sent at ALERT_RATE messages per second, ALERT_CHAT_INTERVAL seconds apart
+# in the same chat, to stay within Telegram limits
+ALERTS_QUEUE_URL = os.environ.get('ALERTS_QUEUE_URL')
+ALERT_RATE = float(os.environ.get('ALERT_RATE', 25))
+ALERT_BURST = int(os.environ.get('ALERT_BURST', 5))
+ALERT_CHAT_INTERVAL = float(os.environ.get('ALERT_CHAT_INTERVAL', 1))
+ALERT_KEY_PREFIX = 'alert'
+# Month views and subscriptions were kept together under this user_id, admin.py migrate-legs moves them
+LEGACY_INDEX_USER_ID = 0
+# Update deduplication: handled update IDs are remembered by warm containers, so updates redelivered by Telegram
+# are not handled again. Updates handled with the table, i.e. all but static replies and the first save trip steps,
+# are also claimed with a marker in the table under user_id -<update ID>: a lease while the update is handled,
+# then a "done" marker kept for UPDATE_DEDUP_TTL seconds, see claimed. 0 turns deduplication off
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', 3600))
+UPDATE_DEDUP_CACHE_SIZE = int(os.environ.get('UPDATE_DEDUP_CACHE_SIZE', 10000))
+# Seconds a lease on an update lasts outside Lambda, in Lambda it lasts until the invocation times out
+UPDATE_LEASE_TIME = int(os.environ.get('UPDATE_LEASE_TIME', 60))
+UPDATE_MARKER_SORT_KEY = 'update'
 TELEGRAM_API_KEY = os.environ['TELEGRAM_API_KEY']
 
-TELEGRAM_BOT_API = f"https://api.telegram.org/bot{TELEGRAM_API_KEY}/"
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_BOT_API = f"{TELEGRAM_API_URL}/bot{TELEGRAM_API_KEY}/"
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 3))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', 10))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 4))
+# Return one of the update's API calls in the webhook response instead of sending it as a separate request
+TELEGRAM_WEBHOOK_REPLY = os.environ.get('TELEGRAM_WEBHOOK_REPLY', '').lower() in ('1', 'true', 'yes')
+# batch_write_item limit, and retries of unprocessed items with exponential backoff starting at the base delay
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = 8
+BATCH_WRITE_BASE_DELAY = 0.05
+# Retries: DynamoDB throttling and server errors are retried with jittered exponential backoff,
+# Telegram 429 responses after retry_after seconds (unless it's longer than TELEGRAM_MAX_RETRY_AFTER)
+# and server errors with backoff
+DYNAMODB_MAX_ATTEMPTS = int(os.environ.get('DYNAMODB_MAX_ATTEMPTS', 5))
+TELEGRAM_MAX_ATTEMPTS = int(os.environ.get('TELEGRAM_MAX_ATTEMPTS', 3))
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', 5))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.05))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 2))
+# Circuit breakers open after this many failed calls in a row and let a probe call through after the timeout
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+# Messages per second sent to all chats by the process, replies to one update may go out together up to the burst
+TELEGRAM_RATE = float(os.environ.get('TELEGRAM_RATE', 30))
+TELEGRAM_BURST = int(os.environ.get('TELEGRAM_BURST', 30))
+# Invocation time budget: Telegram and DynamoDB calls get at most the time left before the Lambda timeout
+# minus DEADLINE_RESERVE, which is kept for returning the response. Optional work, like answering callback queries
+# and refreshing month views, is skipped when less than OPTIONAL_WORK_MIN_TIME is left
+DEADLINE_RESERVE = float(os.environ.get('DEADLINE_RESERVE', 0.5))
+OPTIONAL_WORK_MIN_TIME = float(os.environ.get('OPTIONAL_WORK_MIN_TIME', 1))
+# botocore has no per-call timeouts, so a DynamoDB call is only started if its connect and read timeouts fit
+# in the time left. With Lambda's default 3 s timeout calls can be started during the first second of an invocation
+DYNAMODB_CONNECT_TIMEOUT = float(os.environ.get('DYNAMODB_CONNECT_TIMEOUT', 0.5))
+DYNAMODB_READ_TIMEOUT = float(os.environ.get('DYNAMODB_READ_TIMEOUT', 1))
+DYNAMODB_CALL_TIME = DYNAMODB_CONNECT_TIMEOUT + DYNAMODB_READ_TIMEOUT
+# Number of updates handled concurrently by batch entry points
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+# Timings and counters are printed once per invocation in CloudWatch embedded metric format
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CarrierBot')
+# Share of updates whose payload is logged at debug level
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get('PAYLOAD_LOG_SAMPLE_RATE', 0.01))
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-# Create a DynamoDB resource
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+
+class Metrics:
+    """
+    Collects timings and counters of an invocation and emits them as one CloudWatch embedded metric format record.
+    Shared by all threads, so calls made from worker pools are accounted for too
+    """
+
+    def __init__(self, namespace, enabled=True):
+        self.namespace = namespace
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._timings = {}  # metric name -> list of milliseconds
+        self._counters = {}
+
+    def add_timing(self, name, seconds):
+        with self._lock:
+            self._timings.setdefault(name, []).append(round(seconds * 1000, 2))
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, time.perf_counter() - started)
+
+    def flush(self):
+        """
+        Prints collected metrics to stdout as a single embedded metric format record and resets them
+        """
+        with self._lock:
+            timings, counters = self._timings, self._counters
+            self._timings, self._counters = {}, {}
+        if not self.enabled or not (timings or counters):
+            return
+        definitions = ([{"Name": name, "Unit": "Milliseconds"} for name in timings] +
+                       [{"Name": name, "Unit": "Count"} for name in counters])
+        record = {"_aws": {"Timestamp": int(time.time() * 1000),
+                           "CloudWatchMetrics": [{"Namespace": self.namespace, "Dimensions": [[]],
+                                                  "Metrics": definitions}]},
+                  **timings, **counters}
+        print(json.dumps(record, separators=(",", ":")), flush=True)
+
+
+metrics = Metrics(METRICS_NAMESPACE, METRICS_ENABLED)
+
+
+def instrumented(handler):
+    """
+    Decorator which reports the handler's duration as handler.<name> metric
+    """
+    name = f"handler.{handler.__name__}"
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with metrics.timer(name):
+            return handler(*args, **kwargs)
+    return wrapper
+
+
+def claimed(handler):
+    """
+    Decorator of handlers which read or write the table. The update is claimed before the handler runs,
+    see claim_update, so an update redelivered to another container doesn't query or reply again.
+    The claim is completed once the replies are sent and released if the handler fails or the replies have to be
+    sent again. Handlers which only reply with static text or the wizard state of the update (/start, /help,
+    /about, menu callbacks and the first save trip steps) are not claimed: a duplicate reply costs less than the
+    table writes and, in a cold container, loading boto3. The last save trip step claims its update itself,
+    its marker stays once the trip is saved
+    """
+    @functools.wraps(handler)
+    def wrapper(context, *args):
+        if not claim_update(context.update_id):
+            metrics.increment("updates.duplicates")
+            logger.info(f"Skipping update {context.update_id}, it has already been handled")
+            return
+        try:
+            handler(context, *args)
+        except Exception:
+            release_update(context.update_id)
+            raise
+        batch = getattr(_outbound, "batch", None)
+        if batch is None:
+            complete_update(context.update_id)
+        else:
+            batch.claimed_updates.append(context.update_id)
+    return wrapper
+
+
+def log_update_payload(update):
+    """
+    Logs a sample of update payloads at debug level. Payload is only formatted if it's actually logged
+    """
+    if PAYLOAD_LOG_SAMPLE_RATE and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+        logger.debug("Update payload: %s", update)
+
+
+# Deadline of the invocation being handled. Lambda runs one invocation per container at a time,
+# so it's shared by all threads handling the invocation
+_deadline = None
+
+
+@contextmanager
+def invocation_deadline(context):
+    """
+    Context manager which sets the deadline of calls made within it from the Lambda context.
+    There's no deadline without context, e.g. in the poller
+    :param context: The Lambda context object, or None
+    :return: Deadline, or None
+    """
+    global _deadline
+    _deadline = (Deadline.from_lambda_context(context, DEADLINE_RESERVE)
+                 if hasattr(context, 'get_remaining_time_in_millis') else None)
+    try:
+        yield _deadline
+    finally:
+        if _deadline is not None and _deadline.expired():
+            metrics.increment("deadline.overruns")
+        _deadline = None
+
+
+def call_timeout(timeout):
+    """
+    :param timeout: default timeout of the call in seconds
+    :return: the timeout, cut to the time left before the deadline
+    """
+    return timeout if _deadline is None else min(timeout, _deadline.remaining())
+
+
+def deadline_allows(seconds):
+    """
+    :param seconds: time a call or work may take
+    :return: True if there's at least that much time left before the deadline, or there's no deadline
+    """
+    return _deadline is None or _deadline.remaining() >= seconds
+
+
+def has_time_for(work):
+    """
+    Checks if optional work fits in the time left, skipped work is reported as deadline.skipped.<work> metric
+    :param work: name of the work
+    :return: True if the work can be done
+    """
+    if deadline_allows(OPTIONAL_WORK_MIN_TIME):
+        return True
+    metrics.increment(f"deadline.skipped.{work}")
+    logger.warning(f"Skipping {work}, {_deadline.remaining():.3f}s left")
+    return False
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of a DynamoDB call which can't finish before the invocation deadline
+    """
+
+
+# Error codes of DynamoDB requests which can succeed if repeated
+DYNAMODB_THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                              'RequestLimitExceeded')
+DYNAMODB_SERVER_ERRORS = ('InternalServerError', 'ServiceUnavailable')
+# Reasons a transaction is canceled with which it can succeed if repeated
+DYNAMODB_TRANSACTION_CONFLICTS = ('TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded')
+
+dynamodb_backoff = Backoff(RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+dynamodb_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+
+class DynamoDBUnavailable(Exception):
+    """
+    Raised instead of a DynamoDB call while the circuit breaker is open
+    """
+
+
+_dynamodb_errors = None
+
+
+def dynamodb_errors():
+    """
+    Errors of DynamoDB calls, for except clauses. botocore is imported when the first error is handled,
+    so updates which don't use the table don't load it
+    :return: tuple of BotoCoreError, ClientError, DeadlineExceeded and DynamoDBUnavailable
+    """
+    global _dynamodb_errors
+    if _dynamodb_errors is None:
+        from botocore.exceptions import BotoCoreError, ClientError
+        _dynamodb_errors = (BotoCoreError, ClientError, DeadlineExceeded, DynamoDBUnavailable)
+    return _dynamodb_errors
+
+
+def storage_errors():
+    """
+    :return: tuple of errors raised by trip storage engines
+    """
+    return (*dynamodb_errors(), StorageError)
+
+
+def error_code(error):
+    """
+    :return: error code of a ClientError, None for other errors
+    """
+    response = getattr(error, 'response', None)
+    return response.get('Error', {}).get('Code') if isinstance(response, dict) else None
+
+
+def classify_dynamodb_error(error):
+    """
+    :param error: BotoCoreError or ClientError
+    :return: "throttling", "failure" (DynamoDB is unavailable or unreachable) or None if retrying won't help
+    """
+    code = error_code(error)
+    if code is not None:
+        if code in DYNAMODB_THROTTLING_ERRORS:
+            return "throttling"
+        if code == 'TransactionCanceledException' and any(
+                reason.get('Code') in DYNAMODB_TRANSACTION_CONFLICTS
+                for reason in error.response.get('CancellationReasons', [])):
+            return "throttling"
+        return "failure" if code in DYNAMODB_SERVER_ERRORS else None
+    from botocore.exceptions import ConnectionError as BotoCoreConnectionError, HTTPClientError
+    # Connection errors and timeouts, other errors are raised before the request is sent
+    return "failure" if isinstance(error, (BotoCoreConnectionError, HTTPClientError)) else None
+
+
+class UnprocessedWritesError(RuntimeError):
+    """
+    Raised by batch_write when DynamoDB keeps returning some of the requests unprocessed
+    """
+
+
+class RetryableError(Exception):
+    """
+    Raised when an update can't be handled because of a failure which may go away, e.g. DynamoDB or Telegram
+    being unavailable, so batch entry points report the update for retry instead of handling it partially
+    """
+
+
+def is_retryable(error):
+    """
+    :param error: error raised by a storage engine or DynamoDB call
+    :return: True if the call may succeed when the update is handled again
+    """
+    if isinstance(error, (RetryableError, StorageError, DeadlineExceeded, DynamoDBUnavailable, UnprocessedWritesError)):
+        return True
+    return isinstance(error, dynamodb_errors()) and classify_dynamodb_error(error) is not None
+
+
+def raise_if_retryable(error):
+    """
+    Raises failures which may go away as RetryableError, other failures are left to the caller
+    :param error: error raised by a storage engine or DynamoDB call
+    :raises RetryableError: If the call may succeed when the update is handled again
+    """
+    if is_retryable(error):
+        raise RetryableError(str(error)) from error
+
+
+class DynamoDBTable:
+    """
+    Thin wrapper around the low-level DynamoDB client with the same methods as boto3 Table resource.
+    Items, keys and expression values are plain Python values (de)serialized here, so resource models
+    don't have to be loaded on cold start. Expressions must be passed as strings.
+    """
+    SERIALIZED_PARAMETERS = ('Item', 'Key', 'ExpressionAttributeValues', 'ExclusiveStartKey')
+
+    def __init__(self, client, table_name):
+        from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+        self.client = client
+        self.table_name = table_name
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def _serialize(self, values):
+        return {name: self._serializer.serialize(value) for name, value in values.items()}
+
+    def _deserialize(self, item):
+        return {name: self._deserializer.deserialize(value) for name, value in item.items()}
+
+    def _request(self, operation, **kwargs):
+        """
+        Calls the client operation. Throttled requests and DynamoDB failures are retried with backoff,
+        while DynamoDB keeps failing calls fail fast with DynamoDBUnavailable.
+        botocore has no per-call timeouts, so calls are bounded by the connect and read timeouts of the client
+        and aren't made or retried when the invocation deadline is closer than that
+        :raises BotoCoreError, ClientError: If the request fails
+        :raises DeadlineExceeded, DynamoDBUnavailable: If the request is not made
+        """
+        attempt = 0
+        while True:
+            if not deadline_allows(DYNAMODB_CALL_TIME):
+                metrics.increment("deadline.exceeded")
+                raise DeadlineExceeded("Invocation deadline is exceeded")
+            if not dynamodb_breaker.allow():
+                metrics.increment("dynamodb.circuit_open")
+                raise DynamoDBUnavailable("DynamoDB calls are suspended after repeated failures")
+            try:
+                with metrics.timer(f"dynamodb.{operation}"):
+                    response = getattr(self.client, operation)(**kwargs)
+            except dynamodb_errors() as error:
+                metrics.increment(f"dynamodb.{operation}.errors")
+                kind = classify_dynamodb_error(error)
+                if kind == "failure":
+                    dynamodb_breaker.record_failure()
+                else:
+                    # Throttling and client errors mean DynamoDB is up
+                    dynamodb_breaker.record_success()
+                attempt += 1
+                delay = dynamodb_backoff.delay(attempt - 1)
+                if kind is None or attempt >= DYNAMODB_MAX_ATTEMPTS or not deadline_allows(delay + DYNAMODB_CALL_TIME):
+                    raise
+                metrics.increment(f"dynamodb.{operation}.retries")
+                metrics.add_timing("dynamodb.retry_wait", delay)
+                logger.warning(f"Retrying {operation} in {delay:.3f}s after {kind}: {error}")
+                time.sleep(delay)
+                continue
+            dynamodb_breaker.record_success()
+            return response
+
+    def _call(self, operation, kwargs):
+        for parameter in self.SERIALIZED_PARAMETERS:
+            if parameter in kwargs:
+                kwargs[parameter] = self._serialize(kwargs[parameter])
+        response = self._request(operation, TableName=self.table_name, **kwargs)
+        for attribute in ('Item', 'Attributes', 'LastEvaluatedKey'):
+            if attribute in response:
+                response[attribute] = self._deserialize(response[attribute])
+        if 'Items' in response:
+            response['Items'] = [self._deserialize(item) for item in response['Items']]
+        return response
+
+    def get_item(self, **kwargs):
+        return self._call('get_item', kwargs)
+
+    def put_item(self, **kwargs):
+        return self._call('put_item', kwargs)
+
+    def update_item(self, **kwargs):
+        return self._call('update_item', kwargs)
+
+    def delete_item(self, **kwargs):
+        return self._call('delete_item', kwargs)
+
+    def query(self, **kwargs):
+        return self._call('query', kwargs)
+
+    def scan(self, **kwargs):
+        return self._call('scan', kwargs)
+
+    def update_time_to_live(self, **kwargs):
+        return self._call('update_time_to_live', kwargs)
+
+    def batch_write_item(self, requests):
+        """
+        Writes up to 25 items of the table in one call
+        :param requests: list of {'PutRequest': {'Item': item}} and {'DeleteRequest': {'Key': key}}
+        :return: list of requests DynamoDB didn't process, in the same form
+        """
+        serialized = [{kind: {name: self._serialize(value) for name, value in request[kind].items()}}
+                      for request in requests for kind in request]
+        response = self._request('batch_write_item', RequestItems={self.table_name: serialized})
+        return [{kind: {name: self._deserialize(value) for name, value in request[kind].items()}}
+                for request in response.get('UnprocessedItems', {}).get(self.table_name, []) for kind in request]
+
+    def transact_write_items(self, actions):
+        """
+        Writes up to 100 items of the table in one call, all of them or none
+        :param actions: list of {'Put': {'Item': item, ...}} and {'Delete': {'Key': key, ...}} with the parameters
+            of put_item and delete_item
+        :raises ClientError: TransactionCanceledException if a condition fails or the items are being written
+        """
+        serialized = [{kind: dict({name: self._serialize(value) if name in self.SERIALIZED_PARAMETERS else value
+                                   for name, value in action[kind].items()}, TableName=self.table_name)}
+                      for action in actions for kind in action]
+        return self._request('transact_write_items', TransactItems=serialized)
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_table():
+    """
+    Returns the trips table, creating DynamoDB client on first use and reusing it in warm invocations.
+    boto3 is imported here too, so updates which don't touch the storage don't pay for it on cold start
+    :return: DynamoDBTable
+    """
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                import boto3
+                from botocore.config import Config
+                # Retries are made by DynamoDBTable, so they are counted and the circuit breaker sees every failure
+                client = boto3.client('dynamodb', config=Config(max_pool_connections=max(10, DYNAMODB_WORKERS * 2),
+                                                                retries={'total_max_attempts': 1},
+                                                                connect_timeout=DYNAMODB_CONNECT_TIMEOUT,
+                                                                read_timeout=DYNAMODB_READ_TIMEOUT))
+                _table = DynamoDBTable(client, DYNAMODB_TABLE_NAME)
+    return _table
+
+
+def use_table(table):
+    """
+    Replaces the trips table, e.g. with an in-memory stand-in for offline runs
+    :param table: object with the methods of DynamoDBTable
+    """
+    global _table
+    _table = table
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the trip storage engine selected with STORAGE, created on first use and reused in warm invocations
+    :return: DynamoDBTripStore or SqliteTripStore
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if STORAGE == 'sqlite':
+                    _store = SqliteTripStore(SQLITE_PATH)
+                elif STORAGE == 'dynamodb':
+                    _store = DynamoDBTripStore()
+                else:
+                    raise ValueError(f"Unsupported storage: {STORAGE}")
+    return _store
+
+
+def use_store(store):
+    """
+    Replaces the trip storage engine
+    :param store: object with the methods described in storage.py
+    """
+    global _store
+    _store = store
+
+
+def uses_dynamodb():
+    """
+    :return: True if trips are kept in the DynamoDB table, which also holds month views, subscriptions
+        and update markers
+    """
+    return isinstance(get_store(), DynamoDBTripStore)
+
+
+def is_trip_item(item):
+    """
+    :return: True if the table item is a trip, not a month view, subscription or update marker.
+        Telegram user IDs are positive, the other items are kept under user_id 0 or below
+    """
+    return item['user_id'] > 0
+
+
+def index_partition(kind, route, month):
+    """
+    Month views and subscriptions of every route and month have their own partition, so rebuilding a view or
+    looking up subscriptions doesn't contend with other months. A hash collision puts two of them into one
+    partition, which their sort keys tell apart
+    :param kind: MONTH_VIEW_KEY_PREFIX or ALERT_KEY_PREFIX
+    :param route: route of the legs
+    :param month: YYYY-MM
+    :return: negative user_id of the partition
+    """
+    return -1 - zlib.crc32(f"{kind}#{route}#{month}".encode("utf-8"))
+
+
+# Worker threads for queries of several index partitions at once and month view updates
+dynamodb_executor = ThreadPoolExecutor(max_workers=DYNAMODB_WORKERS, thread_name_prefix="dynamodb")
+
+
+class TelegramApiClient:
+    """
+    Keep-alive HTTP client for the Telegram Bot API.
+    Lives at module level, so connections opened by one invocation are reused by the next warm one.
+    """
+
+    def __init__(self, base_url, connect_timeout, read_timeout, pool_size):
+        """
+        :param base_url: Bot API url including the bot token, e.g. https://api.telegram.org/bot<token>/
+        :param connect_timeout: Seconds to wait for TCP/TLS connection to be established
+        :param read_timeout: Seconds to wait for each read from an established connection
+        :param pool_size: Maximum number of idle connections kept open
+        """
+        url = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self, timeout):
+        connection = self.connection_class(self.host, self.port, timeout=min(self.connect_timeout, timeout))
+        connection.connect()
+        return connection
+
+    def _acquire(self, timeout):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._connect(timeout), False
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(self, operation, body, headers, timeout=None):
+        """
+        Sends POST request to the API operation endpoint over a pooled connection
+        :param operation: API operation endpoint
+        :param body: Encoded request body
+        :param headers: Request headers
+        :param timeout: Optional seconds to wait for connection and each read, if shorter than the client's timeouts
+        :return: Tuple of HTTP status code and parsed JSON response. Error responses which are not JSON objects,
+            e.g. HTML pages of a proxy, are returned as {"ok": false} with the HTTP status as the description
+        :raises http.client.HTTPException, OSError: On connection errors and timeouts
+        :raises ValueError: If a successful response is not a valid JSON
+        """
+        timeout = self.read_timeout if timeout is None else min(self.read_timeout, timeout)
+        while True:
+            connection, reused = self._acquire(timeout)
+            try:
+                connection.sock.settimeout(timeout)
+                connection.request("POST", self.path + operation, body, headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    # Idle keep-alive connection was closed by the server between invocations, take another one
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            if response.status == 200:
+                return response.status, json.loads(payload)
+            try:
+                error = json.loads(payload)
+            except ValueError:
+                error = None
+            if not isinstance(error, dict):
+                error = {"ok": False, "description": f"HTTP {response.status} {response.reason}"}
+            return response.status, error
+
+
+telegram_client = TelegramApiClient(TELEGRAM_BOT_API, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT,
+                                    TELEGRAM_POOL_SIZE)
+
+
+telegram_backoff = Backoff(RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+telegram_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+telegram_limiter = TokenBucket(TELEGRAM_RATE, TELEGRAM_BURST)
 
 
 def send_telegram_api_request(operation, data, headers=None):
     """
-    Function to send HTTP request to Telegram API
+    Function to send HTTP request to Telegram API.
+    Messages to chats are rate limited. 429 and 5xx responses are retried, timeouts and connection errors are not,
+    as the call may have been executed. While Telegram keeps failing, calls fail fast
     :param operation: API operation endpoint
     :param data: Data to send in the body of the request, in dictionary form
     :param headers: Any headers to include in the request, in dictionary form
-    :returns: Dictionary containing server's response
-    :raises Exception: If any errors occur during the HTTP request
+    :returns: Dictionary containing server's response, or dictionary with "error" key if request failed.
+        "retryable" key is set if the call wasn't made or failed in a way that may go away: the circuit is open,
+        the deadline is exceeded, or Telegram kept responding with 429 or 5xx
     """
-    url = f"{TELEGRAM_BOT_API}{operation}"
-    data = json.dumps(data).encode("utf-8")
+    if not telegram_breaker.allow():
+        metrics.increment("telegram.circuit_open")
+        logger.error(f"{operation} is not sent, Telegram API calls are suspended after repeated failures")
+        return {"error": "Telegram API is unavailable", "retryable": True}
+    if "chat_id" in data:
+        wait_time = telegram_limiter.reserve()
+        if wait_time:
+            metrics.add_timing("telegram.throttle_wait", wait_time)
+            time.sleep(wait_time)
+    data = encode_json(data)
     if not headers:
         headers = {"Content-Type": "application/json"}
+    for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+        timeout = call_timeout(TELEGRAM_READ_TIMEOUT)
+        if timeout <= 0:
+            metrics.increment("deadline.exceeded")
+            logger.error(f"{operation} is not sent, invocation deadline is exceeded")
+            return {"error": "Deadline exceeded", "retryable": True}
+        try:
+            with metrics.timer(f"telegram.{operation}"):
+                status, response = telegram_client.request(operation, data, headers, timeout)
+        except TimeoutError:
+            metrics.increment(f"telegram.{operation}.errors")
+            telegram_breaker.record_failure()
+            logger.error("Request timed out")
+            return {"error": "Request timed out"}
+        except (http.client.HTTPException, OSError, ValueError) as error:
+            metrics.increment(f"telegram.{operation}.errors")
+            telegram_breaker.record_failure()
+            logger.error(error)
+            return {"error": str(error)}
+        if status == 200 and response.get("ok"):
+            telegram_breaker.record_success()
+            return response
+        metrics.increment(f"telegram.{operation}.errors")
+        if status >= 500:
+            telegram_breaker.record_failure()
+            delay = telegram_backoff.delay(attempt)
+        else:
+            telegram_breaker.record_success()
+            # Flood control tells how long to wait, other client errors won't go away on retry
+            delay = response.get("parameters", {}).get("retry_after") if status == 429 else None
+            if delay is None or delay > TELEGRAM_MAX_RETRY_AFTER:
+                break
+        if attempt + 1 == TELEGRAM_MAX_ATTEMPTS or delay >= call_timeout(TELEGRAM_READ_TIMEOUT):
+            break
+        metrics.increment(f"telegram.{operation}.retries")
+        metrics.add_timing("telegram.retry_wait", delay)
+        logger.warning(f"Retrying {operation} in {delay}s after status {status}: {response.get('description')}")
+        time.sleep(delay)
+    logger.error(f"{operation} failed with status {status}: {response.get('description')}")
+    return {"error": str(response.get("description")), "retryable": status == 429 or status >= 500}
+
+
+# Worker threads for flushing outbound batches, sized to match the connection pool
+outbound_executor = ThreadPoolExecutor(max_workers=TELEGRAM_POOL_SIZE, thread_name_prefix="telegram")
+_outbound = threading.local()
+
+
+class OutboundBatch:
+    """
+    Collects Telegram API calls made while an update is handled and sends them all at once.
+    Calls to the same chat are sent one after another in the order they were queued,
+    calls to different chats (and callback query answers) are sent concurrently.
+    """
+
+    def __init__(self):
+        self.calls = []
+        # Number of flushed calls which failed and may succeed if the update is handled again
+        self.retryable_failures = 0
+        # Updates claimed by the handlers, settled once the calls are sent
+        self.claimed_updates = []
+
+    def add(self, operation, data):
+        """
+        Queues API call
+        :param operation: API operation endpoint
+        :param data: Data to send in the body of the request, in dictionary form
+        :return: Future resolved with server's response when the batch is flushed
+        """
+        future = Future()
+        self.calls.append((operation, data, future))
+        return future
+
+    def pop_webhook_reply(self):
+        """
+        Takes out a call that can be returned in the webhook response instead of being sent.
+        Telegram executes it only after the response is returned, i.e. after the rest of the batch is flushed,
+        so the last call queued to the chat of the first call is taken to keep the order of messages in that chat.
+        :return: Tuple of operation and data, or None if nothing is queued
+        """
+        if not self.calls:
+            return None
+        chat_id = self.calls[0][1].get("chat_id")
+        index = 0
+        if chat_id is not None:
+            index = max(i for i, call in enumerate(self.calls) if call[1].get("chat_id") == chat_id)
+        operation, data, future = self.calls.pop(index)
+        future.set_result(None)
+        return operation, data
+
+    def flush(self):
+        """
+        Sends all queued calls and waits for them to complete
+        """
+        calls, self.calls = self.calls, []
+        chains = {}
+        for call in calls:
+            chat_id = call[1].get("chat_id")
+            chains.setdefault(id(call) if chat_id is None else chat_id, []).append(call)
+        chains = list(chains.values())
+        if not chains:
+            return
+        pending = [outbound_executor.submit(_send_chain, chain) for chain in chains[1:]]
+        _send_chain(chains[0])
+        wait(pending)
+        self.retryable_failures += sum(1 for _, _, future in calls
+                                       if future.exception() is None and future.result().get("retryable"))
+
+    def settle_claims(self):
+        """
+        Completes the claimed updates, or releases them if some calls have to be sent again on redelivery
+        """
+        for update_id in self.claimed_updates:
+            if self.retryable_failures:
+                release_update(update_id)
+            else:
+                complete_update(update_id)
+        self.claimed_updates = []
+
+
+def _send_chain(chain):
+    for operation, data, future in chain:
+        try:
+            future.set_result(send_telegram_api_request(operation, data))
+        except Exception as error:
+            logger.error(f"Failed to send {operation}: {error}")
+            future.set_exception(error)
+
+
+@contextmanager
+def outbound_batch():
+    """
+    Context manager which batches all Telegram API calls made within it and flushes them on exit
+    :return: OutboundBatch with queued calls
+    """
+    batch = OutboundBatch()
+    _outbound.batch = batch
     try:
-        request = urllib.request.Request(url, data, headers)
-        with urllib.request.urlopen(request).read().decode("utf-8") as response:
-            return json.loads(response)
-    except urllib.error.HTTPError as error:
-        logger.error(error.reason)
-        return {"error": str(error.reason)}
-    except urllib.error.URLError as error:
-        logger.error(error.reason)
-        return {"error": str(error.reason)}
-    except TimeoutError:
-        logger.error("Request timed out")
-        return {"error": "Request timed out"}
+        yield batch
+    finally:
+        _outbound.batch = None
+        batch.flush()
+        batch.settle_claims()
+
+
+def dispatch_telegram_api_request(operation, data):
+    """
+    Sends API call, or queues it if there is an outbound batch active in the current thread
+    :param operation: API operation endpoint
+    :param data: Data to send in the body of the request, in dictionary form
+    :return: Server's response, or Future resolved with it when the call is queued
+    """
+    batch = getattr(_outbound, "batch", None)
+    if batch is None:
+        return send_telegram_api_request(operation, data)
+    return batch.add(operation, data)
 
 
 def create_data_dictionary(chat_id, text, message_id=None, reply_markup=None, parse_mode=None):
     """
     Create a dictionary for data to be sent in a request.
     :param chat_id: ID of chat
-    :param text: The text to be sent
+    :param text: The text to be sent, or StaticReply with pre-encoded text, markup and parse mode
     :param message_id: Optional ID of the message. Default is None.
     :param reply_markup: Optional markup settings. Default is None.
     :param parse_mode: Optional parse mode settings. Default is None.
     :return: Dictionary containing the data
     """
-    data = {
-        "chat_id": chat_id,
-        "text": text
-    }
+    if isinstance(text, StaticReply):
+        data = {"chat_id": chat_id, **text.fields}
+    else:
+        data = {
+            "chat_id": chat_id,
+            "text": text
+        }
     if message_id:
         data["message_id"] = message_id
     if reply_markup:
@@ -85,13 +927,13 @@ def create_data_dictionary(chat_id, text, message_id=None, reply_markup=None, pa
 
 def send_message(chat_id, text, reply_markup=None, parse_mode=None):
     data = create_data_dictionary(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
-    return send_telegram_api_request("sendMessage", data)
+    return dispatch_telegram_api_request("sendMessage", data)
 
 
 def send_edit_message_text(chat_id, message_id, text, reply_markup=None, parse_mode=None):
     data = create_data_dictionary(chat_id, text, message_id=message_id, reply_markup=reply_markup,
                                   parse_mode=parse_mode)
-    return send_telegram_api_request("editMessageText", data)
+    return dispatch_telegram_api_request("editMessageText", data)
 
 
 def send_answer_callback_query(callback_query_id, text=None, show_alert=False):
@@ -100,7 +942,7 @@ def send_answer_callback_query(callback_query_id, text=None, show_alert=False):
     :param callback_query_id: The ID of the callback query to answer.
     :param text: Optional; the text to send in the answer. Defaults to None.
     :param show_alert: Optional; determines whether an alert will be shown. Defaults to False.
-    :return: Response from the sendRequest function
+    :return: Response from the dispatch_telegram_api_request function
     """
     data = {
         "callback_query_id": callback_query_id
@@ -108,118 +950,732 @@ def send_answer_callback_query(callback_query_id, text=None, show_alert=False):
     if text:
         data["text"] = text
         data["show_alert"] = show_alert
-    return send_telegram_api_request("answerCallbackQuery", data)
+    return dispatch_telegram_api_request("answerCallbackQuery", data)
+
+
+class SearchCache:
+    """
+    LRU cache of month search results with TTL and memory cap.
+    Lives at module level, so it's shared by warm invocations of the same Lambda container.
+    Writes invalidate only the local copy, other containers see the change once their entry expires.
+    Hits, misses, evictions, expirations and invalidations are counted as search_cache.* metrics
+    """
+
+    def __init__(self, ttl, max_bytes):
+        """
+        :param ttl: Seconds an entry stays valid
+        :param max_bytes: Approximate maximum size of all cached trips
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, trips)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_size(trips):
+        return sum(64 + sum(len(str(value)) for value in trip.values()) for trip in trips)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """
+        :param key: Tuple of direction, year and month
+        :return: Cached list of trips, or None if there is no valid entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics.increment("search_cache.misses")
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                metrics.increment("search_cache.expirations")
+                metrics.increment("search_cache.misses")
+                return None
+            self._entries.move_to_end(key)
+            metrics.increment("search_cache.hits")
+            return entry[2]
+
+    def put(self, key, trips):
+        """
+        Caches trips, evicting least recently used entries to stay within the memory cap
+        :param key: Tuple of direction, year and month
+        :param trips: List of trips
+        """
+        size = self.estimate_size(trips)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                metrics.increment("search_cache.evictions")
+            self._entries[key] = (time.monotonic() + self.ttl, size, trips)
+            self._bytes += size
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                metrics.increment("search_cache.invalidations")
+
+
+search_cache = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_BYTES)
+
+
+def trip_search_months(trip):
+    """
+    Returns the months whose search results contain the trip, one per leg
+    :param trip: trip data
+    :return: list of search cache keys
+    """
+    return [(leg['route'], leg['date'][:4], leg['date'][5:7]) for leg in trip['legs']]
+
+
+def invalidate_search_cache(trip):
+    for key in trip_search_months(trip):
+        search_cache.invalidate(key)
+
+
+def month_view_key(route, yyyy, mm):
+    """
+    :return: primary key of the month view item
+    """
+    month = f"{yyyy}-{mm}"
+    return {'user_id': index_partition(MONTH_VIEW_KEY_PREFIX, route, month),
+            'trip_id': f"{MONTH_VIEW_KEY_PREFIX}#{route}#{month}"}
+
+
+def month_view_expiry(route, yyyy, mm):
+    """
+    :return: the time the month view expires at, together with the trips of the last day of its month
+    """
+    return trip_expiry({'legs': [{'route': route, 'date': month_date_range(yyyy, mm)[1]}]})
+
+
+def estimate_item_size(value):
+    """
+    Estimates the size DynamoDB counts for an attribute value towards the item size limit.
+    Numbers are counted at their maximum size
+    :param value: deserialized attribute value
+    :return: size in bytes
+    """
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, dict):
+        return 3 + sum(len(name.encode('utf-8')) + 1 + estimate_item_size(element) for name, element in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(1 + estimate_item_size(element) for element in value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    return 21
+
+
+def is_month_view_fresh(view):
+    return view is not None and time.time() - int(view.get('built_at', 0)) < MONTH_VIEW_MAX_AGE
+
+
+def get_month_view(route, yyyy, mm):
+    """
+    Reads the month view item
+    :return: view item, or None if it doesn't exist
+    :raises BotoCoreError, ClientError: If the request fails
+    """
+    response = get_table().get_item(Key=month_view_key(route, yyyy, mm), ConsistentRead=True)
+    return response.get('Item')
+
+
+def put_month_view(key, trips, writes=None, force=False):
+    """
+    Stores the month view built from the date index query results.
+    Unless forced, the view is stored only if no trip of the month was written since its writes counter was read,
+    otherwise the view could miss that trip
+    :param key: tuple of route, year and month
+    :param trips: all legs of the month
+    :param writes: writes counter of the view read before the trips were queried, None if the view didn't exist
+    :param force: overwrite the view regardless of concurrent writes
+    :return: True if the view was stored
+    :raises BotoCoreError, ClientError: If the request fails
+    """
+    item = {**month_view_key(*key), 'built_at': int(time.time()), 'writes': writes or 0,
+            EXPIRY_ATTRIBUTE: month_view_expiry(*key)}
+    view_trips = {trip['trip_id']: {field: trip[field] for field in MONTH_VIEW_FIELDS} for trip in trips}
+    if estimate_item_size(view_trips) > MONTH_VIEW_MAX_BYTES:
+        item['overflow'] = True
+    else:
+        item['trips'] = view_trips
+    kwargs = {}
+    if not force and writes is None:
+        kwargs = {'ConditionExpression': "attribute_not_exists(writes)"}
+    elif not force:
+        kwargs = {'ConditionExpression': "writes = :writes", 'ExpressionAttributeValues': {":writes": writes}}
+    try:
+        get_table().put_item(Item=item, **kwargs)
+        return True
+    except dynamodb_errors() as error:
+        if error_code(error) != 'ConditionalCheckFailedException':
+            raise
+        return False
 
 
-def message_data_encode(text, data_to_encode):
+def update_month_view(key, trip, deleted=False):
     """
-    Encodes data into a message using zero-space link method from stateless-question library.
-    :param text: The original text of the message.
-    :param data_to_encode: The data to encode into the text.
-    :return: An encoded message string.
+    Adds the trip's leg to the month view or removes it from there.
+    Views that are not built only get their writes counter bumped, so concurrent view builds know they are outdated.
+    If the view can't be updated, e.g. it would exceed the item size limit, it's marked as stale,
+    so the next search rebuilds it instead of serving it without the change
+    :param key: tuple of route, year and month
+    :param trip: trip data
+    :param deleted: True if the trip was deleted
+    :raises BotoCoreError, ClientError: If the request fails
     """
-    zero_width_character = "\u200C"
-    base_url = "https://t.me/?encoded="
-    encoded_url = base_url + urllib.parse.quote_plus(data_to_encode)
-    html_markup = f"<a href=\"{encoded_url}\">{zero_width_character}</a>"
-    text = str(text) + html_markup
-    return text
+    view_key = month_view_key(*key)
+    if deleted:
+        update_kwargs = {'UpdateExpression': "REMOVE trips.#trip_id ADD writes :one",
+                         'ExpressionAttributeValues': {":one": 1}}
+    else:
+        leg = trip_leg(trip, next(leg for leg in trip['legs'] if leg['route'] == key[0]))
+        update_kwargs = {'UpdateExpression': "SET trips.#trip_id = :trip ADD writes :one",
+                         'ExpressionAttributeValues': {":one": 1,
+                                                       ":trip": {field: leg[field] for field in MONTH_VIEW_FIELDS}}}
+    try:
+        get_table().update_item(Key=view_key, ConditionExpression="attribute_exists(trips)",
+                                ExpressionAttributeNames={"#trip_id": trip['trip_id']}, **update_kwargs)
+    except dynamodb_errors() as error:
+        if error_code(error) == 'ConditionalCheckFailedException':
+            # Creates the view item if there's none, it has to expire like a built view
+            get_table().update_item(Key=view_key, UpdateExpression="SET #expires_at = :expires_at ADD writes :one",
+                                    ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE},
+                                    ExpressionAttributeValues={":one": 1, ":expires_at": month_view_expiry(*key)})
+            return
+        logger.error(f"Failed to update month view {view_key['trip_id']}, marking it stale: {error}")
+        invalidate_month_view(key)
+
+
+def invalidate_month_view(key):
+    """
+    Marks the month view as stale, so it's rebuilt by the next search.
+    Its writes counter is bumped too, so a rebuild that is already running doesn't store an outdated view
+    :param key: tuple of route, year and month
+    :raises BotoCoreError, ClientError: If the request fails
+    """
+    get_table().update_item(Key=month_view_key(*key),
+                            UpdateExpression="SET built_at = :stale, #expires_at = :expires_at ADD writes :one",
+                            ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE},
+                            ExpressionAttributeValues={":stale": 0, ":one": 1, ":expires_at": month_view_expiry(*key)})
 
 
-def message_data_decode(text):
+def update_month_views(trip, deleted=False):
     """
-    Decodes data from a message.
-    :param text: The text of the message.
-    :return: Decoded data from the input message.
+    Updates all month views the trip belongs to in parallel.
+    Failures are logged, views that couldn't be updated nor marked stale are fixed when they are rebuilt
+    after MONTH_VIEW_MAX_AGE
+    :param trip: trip data
+    :param deleted: True if the trip was deleted
     """
-    regex = r"https\:\/\/t\.me\/\?encoded\=(.*)"
-    result = re.findall(regex, text)
-    if result and result[0]:
-        return urllib.parse.unquote_plus(result[0])
-    return None
+    if not uses_dynamodb():
+        return
+    updates = [dynamodb_executor.submit(update_month_view, key, trip, deleted) for key in trip_search_months(trip)]
+    for update in updates:
+        try:
+            update.result()
+        except dynamodb_errors() as error:
+            logger.error(f"Failed to update month view: {error}")
 
 
 def delete_trip(user_id, trip_id):
     """
-    Deletes a trip for a user from the DynamoDB table
+    Deletes a trip of a user. The key includes user_id, so users can only delete their own trips
     :param user_id: the ID of the user
     :param trip_id: the ID of the trip
-    :return: response from DynamoDB
+    :return: the deleted trip, or None if there was no such trip or deletion failed
+    :raises RetryableError: If deletion failed and may succeed on retry
     """
     try:
-        response = table.delete_item(Key={'user_id': user_id, 'trip_id': trip_id})
-        return response
-    except (BotoCoreError, ClientError) as error:
+        trip = get_store().delete_trip(user_id, trip_id)
+    except storage_errors() as error:
         logger.error(f"Failed to delete trip: {error}")
+        raise_if_retryable(error)
         return None
+    if trip is None:
+        logger.info(f"Trip {trip_id} of user {user_id} is already deleted")
+        return None
+    invalidate_search_cache(trip)
+    update_month_views(trip, deleted=True)
+    return trip
+
+
+def trip_expiry(trip):
+    """
+    Returns the time the trip expires at, TRIP_EXPIRY_DAYS after the date of its last leg (midnight UTC)
+    :param trip: trip data
+    :return: epoch seconds
+    """
+    last_date = date.fromisoformat(max(leg['date'] for leg in trip['legs']))
+    # Trips at the end of the calendar expire on its last day
+    expiry_date = min(last_date, date.max - timedelta(days=TRIP_EXPIRY_DAYS)) + timedelta(days=TRIP_EXPIRY_DAYS)
+    expires_at = datetime.combine(expiry_date, datetime_time(), timezone.utc)
+    return int(expires_at.timestamp())
+
+
+def today():
+    return str(datetime.now(timezone.utc).date())
+
+
+batch_write_backoff = Backoff(BATCH_WRITE_BASE_DELAY, RETRY_MAX_DELAY)
+
+
+def batch_write(requests):
+    """
+    Writes items in batch_write_item calls of BATCH_WRITE_SIZE requests.
+    Unprocessed requests are retried with jittered exponential backoff
+    :param requests: iterable of {'PutRequest': {'Item': item}} and {'DeleteRequest': {'Key': key}}
+    :return: number of written requests
+    :raises BotoCoreError, ClientError: If a request fails
+    :raises UnprocessedWritesError: If some requests are still unprocessed after BATCH_WRITE_MAX_ATTEMPTS
+    """
+    written = 0
+    requests = iter(requests)
+    while True:
+        chunk = list(islice(requests, BATCH_WRITE_SIZE))
+        if not chunk:
+            return written
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            unprocessed = get_table().batch_write_item(chunk)
+            written += len(chunk) - len(unprocessed)
+            if not unprocessed:
+                break
+            metrics.increment("dynamodb.batch_write_item.unprocessed", len(unprocessed))
+            chunk = unprocessed
+            delay = batch_write_backoff.delay(attempt)
+            metrics.add_timing("dynamodb.retry_wait", delay)
+            time.sleep(delay)
+        else:
+            raise UnprocessedWritesError(f"{len(chunk)} batch write requests are unprocessed after {attempt + 1} "
+                                         f"attempts")
+
+
+def delete_all_trips(user_id):
+    """
+    Deletes all trips of a user, expired ones included
+    :param user_id: the ID of the user
+    :return: number of deleted trips, or None if deletion failed
+    :raises RetryableError: If deletion failed and may succeed on retry
+    """
+    store = get_store()
+    try:
+        trips = list(store.user_trips(user_id, include_expired=True))
+        deleted = store.delete_trips(trips)
+    except (*storage_errors(), UnprocessedWritesError) as error:
+        logger.error(f"Failed to delete trips: {error}")
+        raise_if_retryable(error)
+        return None
+    for trip in trips:
+        invalidate_search_cache(trip)
+        update_month_views(trip, deleted=True)
+    return deleted
 
 
 def save_trip_data(user_id, trip_data):
     """
-    Saves trip data for a user into DynamoDB table
+    Saves trip data for a user
     :param user_id: the ID of the user
     :param trip_data: the data of the trip
-    :return: response from DynamoDB
+    :return: the saved trip, or None if saving failed
+    :raises RetryableError: If saving failed and may succeed on retry
     """
     trip_data['user_id'] = user_id
-    trip_data["dummy_partition_key"] = "constant"
+    trip_data[EXPIRY_ATTRIBUTE] = trip_expiry(trip_data)
     try:
-        response = table.put_item(Item=trip_data)
-        return response
+        get_store().save_trip(trip_data)
+        invalidate_search_cache(trip_data)
+        update_month_views(trip_data)
+        return trip_data
     except Exception as e:
-        logger.error(f'Failed to save item to DynamoDB: {str(e)}')
+        logger.error(f'Failed to save trip: {str(e)}')
+        raise_if_retryable(e)
         return None
 
 
+def paginate_query(limit=None, prefetch=False, **query_kwargs):
+    """
+    Lazily queries DynamoDB page by page, following LastEvaluatedKey
+    :param limit: optional maximum number of items read per request
+    :param prefetch: if True, the first page is requested in background right away
+    :param query_kwargs: arguments for the query call
+    :return: generator of items
+    """
+    if limit:
+        query_kwargs['Limit'] = limit
+    first_page = dynamodb_executor.submit(get_table().query, **query_kwargs) if prefetch else None
+    return _query_pages(first_page, query_kwargs)
+
+
+def _query_pages(first_page, query_kwargs):
+    response = first_page.result() if first_page else get_table().query(**query_kwargs)
+    while True:
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        response = get_table().query(**query_kwargs)
+
+
 def get_my_trips(user_id):
     """
-    Queries DynamoDB for the trips of a specific user
+    Queries the upcoming trips of a specific user
     :param user_id: the ID of the user
-    :return: list of trips of the user
+    :return: generator of trips of the user
+    :raises RetryableError: If the query failed and may succeed on retry
     """
     try:
-        response = table.query(
-            KeyConditionExpression=Key('user_id').eq(int(user_id))
-        )
-        return response['Items']
-    except (BotoCoreError, ClientError) as error:
+        yield from get_store().user_trips(user_id)
+    except storage_errors() as error:
         logger.error(f"Failed to query trips: {error}")
-        return None
+        raise_if_retryable(error)
+
+
+def query_route_month(route, month, from_date, to_date, limit=None):
+    """
+    Queries legs of one route in one month of the route index. The first page is requested in background right away
+    :param route: route of the legs
+    :param month: YYYY-MM
+    :param from_date: start of the date range, inclusive
+    :param to_date: end of the date range, inclusive
+    :param limit: optional maximum number of items read per request
+    :return: generator of leg items, sorted by date
+    """
+    return paginate_query(limit, prefetch=True, IndexName=ROUTE_INDEX,
+                          KeyConditionExpression="#month = :route_month AND #date BETWEEN :from_date AND :to_date",
+                          ExpressionAttributeNames={"#month": ROUTE_MONTH_KEY, "#date": LEG_DATE_KEY},
+                          ExpressionAttributeValues={":route_month": f"{route}#{month}", ":from_date": str(from_date),
+                                                     ":to_date": str(to_date)})
+
+
+def month_date_range(yyyy, mm):
+    """
+    :return: tuple of the first and the last day of the month as YYYY-MM-DD
+    :raises ValueError: If year or month are invalid
+    """
+    first_day = date(int(yyyy), int(mm), 1)
+    # Month length from the calendar, date arithmetic overflows in December 9999
+    last_day = first_day.replace(day=calendar.monthrange(first_day.year, first_day.month)[1])
+    return str(first_day), str(last_day)
+
+
+def range_months(from_date, to_date):
+    """
+    :param from_date: first date (YYYY-MM-DD)
+    :param to_date: last date (YYYY-MM-DD)
+    :return: list of months of the range as YYYY-MM
+    """
+    months = []
+    month = date.fromisoformat(from_date).replace(day=1)
+    while str(month) <= to_date:
+        months.append(f"{month:%Y-%m}")
+        if month.year == date.max.year and month.month == 12:
+            break
+        month = (month + timedelta(days=31)).replace(day=1)
+    return months
+
+
+def query_date_range(route, from_date, to_date, limit=None):
+    """
+    Queries upcoming legs of a route with the date between from_date and to_date.
+    Past dates are cut off the queried range, so past trips are not read at all
+    :param route: route of the legs
+    :param from_date: first date (YYYY-MM-DD), inclusive
+    :param to_date: last date (YYYY-MM-DD), inclusive
+    :param limit: optional maximum number of legs read per request
+    :return: generator of legs sorted by date
+    :raises BotoCoreError, ClientError, StorageError: If the query fails
+    """
+    from_date = max(from_date, today())
+    if from_date > to_date:
+        return iter(())
+    return get_store().legs_by_date(route, from_date, to_date, limit)
 
 
-def get_trips(is_to_belarus, yyyy, mm):
+def query_trips(route, yyyy, mm, start_date=None, limit=None):
     """
-    Queries DynamoDB for trips during a specific month and year
-    :param is_to_belarus: boolean if trips are to Belarus
+    Queries upcoming legs of a route during a specific month and year, see query_date_range
+    :param route: route of the legs
     :param yyyy: the year of the trip
     :param mm: the month of the trip
-    :return: list of trips during the specific month
+    :param start_date: optional date (YYYY-MM-DD) to start from if it's later than the month's beginning
+    :param limit: optional maximum number of legs read per request
+    :return: generator of legs during the specific month, sorted by date
+    :raises BotoCoreError, ClientError, StorageError: If the query fails
+    :raises ValueError: If year or month are invalid
+    """
+    from_date, to_date = month_date_range(yyyy, mm)
+    return query_date_range(route, max(from_date, start_date or ""), to_date, limit)
+
+
+def get_trips(route, yyyy, mm, start_date=None, limit=None):
+    """
+    Queries legs of a route during a specific month and year, see query_trips.
+    Errors are logged and end the results
+    :return: generator of legs during the specific month, sorted by date
+    :raises RetryableError: If the query failed and may succeed on retry
     """
-    # Convert the user-provided year and month to a timestamp range.
-    from_date = datetime.strptime(f"{yyyy}-{mm}-01", "%Y-%m-%d")
     try:
-        if mm == 12:
-            to_date = datetime.strptime(f"{str(int(yyyy) + 1)}-01-01", "%Y-%m-%d")
-        else:
-            to_date = datetime.strptime(f"{yyyy}-{str(int(mm) + 1)}-01", "%Y-%m-%d")
-        # Define the key condition expression for querying DynamoDB.
-        if is_to_belarus:  # If interested in trip to Belarus
-            index_name = 'to_belarus_date-index'
-            key_condition = (Key('dummy_partition_key').eq('constant') &
-                             Key('to_belarus_date').between(str(from_date), str(to_date)))
-        else:  # If interested in trip to Spain
-            index_name = 'to_spain_date-index'
-            key_condition = (Key('dummy_partition_key').eq('constant') &
-                             Key('to_spain_date').between(str(from_date), str(to_date)))
-        # Query DynamoDB.
-        response = table.query(
-            IndexName=index_name,
-            KeyConditionExpression=key_condition
-        )
-        return response['Items']
-    except (BotoCoreError, ClientError, ValueError) as error:
+        yield from query_trips(route, yyyy, mm, start_date, limit)
+    except (*storage_errors(), ValueError) as error:
         logger.error(f"Failed to get trips: {error}")
+        raise_if_retryable(error)
+
+
+def get_month_trips(route, yyyy, mm):
+    """
+    Returns all legs of a route during a specific month and year.
+    Legs are taken from the search cache, then from the month view, and queried from the route index
+    if the view is missing or stale. In the latter case the view is rebuilt from the query results.
+    Month views are only kept with DynamoDB, other engines are queried directly
+    :param route: route of the legs
+    :param yyyy: the year of the trip
+    :param mm: the month of the trip
+    :return: list of legs sorted by date, or None if the month has too many legs to be cached
+    :raises BotoCoreError, ClientError, StorageError, ValueError: If the query fails
+    """
+    key = (route, yyyy, mm)
+    trips = search_cache.get(key)
+    if trips is None:
+        use_views = uses_dynamodb()
+        view = None
+        try:
+            if use_views:
+                view = get_month_view(*key)
+        except dynamodb_errors() as error:
+            logger.error(f"Failed to get month view: {error}")
+        if is_month_view_fresh(view) and 'trips' in view:
+            trips = list(view['trips'].values())
+        else:
+            trips = list(islice(query_trips(route, yyyy, mm), SEARCH_CACHE_MAX_MONTH_TRIPS + 1))
+            if len(trips) > SEARCH_CACHE_MAX_MONTH_TRIPS:
+                return None
+            if use_views and not is_month_view_fresh(view) and has_time_for("month_view_refresh"):
+                try:
+                    put_month_view(key, trips, view.get('writes') if view else None)
+                except dynamodb_errors() as error:
+                    logger.error(f"Failed to put month view: {error}")
+        # Same order for legs from the view and from the index, search pages rely on it
+        trips.sort(key=lambda trip: (trip['date'], trip['trip_id']))
+        search_cache.put(key, trips)
+    return trips
+
+
+def subscription_key(route, month, subscription):
+    """
+    :param route: route of the subscription
+    :param month: YYYY-MM
+    :param subscription: "<user_id>#<from><to>"
+    :return: primary key of the subscription index item
+    """
+    return {'user_id': index_partition(ALERT_KEY_PREFIX, route, month),
+            'trip_id': f"{ALERT_KEY_PREFIX}#{route}#{month}#{subscription}"}
+
+
+def subscription_keys(user_id, direction, from_date, to_date):
+    """
+    Returns keys of the subscription index items, one per route and month of the window.
+    Keys are "alert#<route>#<YYYY-MM>#<user_id>#<from><to>" in the partition of the route and month,
+    so subscriptions a leg may match are read with one begins_with query
+    :param user_id: ID of the subscriber
+    :param direction: key of DIRECTIONS
+    :param from_date: first date of the window
+    :param to_date: last date of the window
+    :return: list of keys
+    """
+    window = f"{from_date:%Y%m%d}{to_date:%Y%m%d}"
+    return [subscription_key(route, month, f"{user_id}#{window}")
+            for route in DIRECTIONS[direction] for month in range_months(str(from_date), str(to_date))]
+
+
+def subscribe(user_id, direction, from_date, to_date):
+    """
+    Subscribes a user to new trips in a date window. The subscription expires with the window
+    :return: True if subscribed
+    :raises RetryableError: If subscribing failed and may succeed on retry
+    """
+    item = {'subscriber_id': user_id, 'direction': direction, 'from_date': str(from_date), 'to_date': str(to_date),
+            EXPIRY_ATTRIBUTE: trip_expiry({'legs': [{'date': str(to_date)}]})}
+    try:
+        batch_write({'PutRequest': {'Item': {**key, **item}}}
+                    for key in subscription_keys(user_id, direction, from_date, to_date))
+    except (*dynamodb_errors(), UnprocessedWritesError) as error:
+        logger.error(f"Failed to subscribe: {error}")
+        raise_if_retryable(error)
+        return False
+    return True
+
+
+def unsubscribe(user_id, direction, from_date, to_date):
+    """
+    :return: True if unsubscribed
+    :raises RetryableError: If unsubscribing failed and may succeed on retry
+    """
+    try:
+        batch_write({'DeleteRequest': {'Key': key}}
+                    for key in subscription_keys(user_id, direction, from_date, to_date))
+    except (*dynamodb_errors(), UnprocessedWritesError) as error:
+        logger.error(f"Failed to unsubscribe: {error}")
+        raise_if_retryable(error)
+        return False
+    return True
+
+
+def match_subscriptions(trip):
+    """
+    Finds subscriptions matching a new trip, with one query of the subscription index per leg
+    :param trip: the new trip
+    :return: dict of subscriber ID to the first matching subscription, the trip's owner excluded
+    :raises BotoCoreError, ClientError: If a query fails
+    """
+    matched = {}
+    for leg in trip['legs']:
+        trip_date = leg['date']
+        if trip_date < today():
+            continue
+        key = subscription_key(leg['route'], trip_date[:7], "")
+        subscriptions = paginate_query(KeyConditionExpression="user_id = :user_id AND begins_with(trip_id, :prefix)",
+                                       FilterExpression="from_date <= :date AND to_date >= :date",
+                                       ExpressionAttributeValues={":user_id": key['user_id'],
+                                                                  ":prefix": key['trip_id'], ":date": trip_date})
+        for subscription in subscriptions:
+            subscriber_id = int(subscription['subscriber_id'])
+            if subscriber_id != trip['user_id']:
+                matched.setdefault(subscriber_id, subscription)
+    return matched
+
+
+def subscription_callback_data(command, direction, from_date, to_date):
+    return f"{command}_{direction}_{from_date:%Y%m%d}_{to_date:%Y%m%d}"
+
+
+def parse_subscription(data):
+    """
+    :param data: callback data "<command>_<direction>_<from>_<to>", dates as YYYYMMDD
+    :return: tuple of direction, first and last date, or None if the data is invalid
+    """
+    try:
+        direction, from_date, to_date = data.split("_")[1:]
+        from_date, to_date = (datetime.strptime(day, "%Y%m%d").date() for day in (from_date, to_date))
+    except ValueError:
         return None
+    if direction not in DIRECTIONS or not 0 <= (to_date - from_date).days < SEARCH_MAX_WINDOW_DAYS:
+        return None
+    return direction, from_date, to_date
+
+
+def subscribe_button_data(direction, from_date, to_date):
+    """
+    :return: callback data of the "subscribe" button under results of a search, None if the window is over
+        or subscriptions are not available with the storage engine
+    """
+    first_day = date.fromisoformat(today())
+    if to_date < first_day or not uses_dynamodb():
+        return None
+    return subscription_callback_data(SUBSCRIBE_COMMAND, direction, max(from_date, first_day), to_date)
+
+
+alert_throttle = SendThrottle(ALERT_RATE, ALERT_BURST, ALERT_CHAT_INTERVAL)
+
+
+def send_trip_alerts(trip):
+    """
+    Notifies subscribers matching a new trip. Sends are throttled, so it blocks for about a second
+    per ALERT_RATE matched subscribers
+    :param trip: the new trip
+    :return: number of sent alerts
+    """
+    with metrics.timer("alerts.fanout"):
+        try:
+            matched = match_subscriptions(trip)
+        except dynamodb_errors() as error:
+            metrics.increment("alerts.errors")
+            logger.error(f"Failed to match subscriptions: {error}")
+            return 0
+        sent = 0
+        for subscriber_id, subscription in matched.items():
+            text, inline_keyboard = render_trip_alert(trip, subscription_callback_data(
+                UNSUBSCRIBE_COMMAND, subscription['direction'], date.fromisoformat(subscription['from_date']),
+                date.fromisoformat(subscription['to_date'])))
+            metrics.add_timing("alerts.throttle_wait", alert_throttle.acquire(subscriber_id))
+            # Sent right away, alerts are never part of an outbound batch
+            response = send_telegram_api_request("sendMessage", create_data_dictionary(
+                subscriber_id, text, reply_markup=inline_keyboard, parse_mode="HTML"))
+            if "error" in response:
+                metrics.increment("alerts.errors")
+            else:
+                sent += 1
+    metrics.increment("alerts.matched", len(matched))
+    metrics.increment("alerts.sent", sent)
+    return sent
+
+
+class AlertDispatcher:
+    """
+    Sends trip alerts from a background thread, so saving a trip doesn't wait for the fan-out.
+    Lambda freezes the thread between invocations, so deployments there should set ALERTS_QUEUE_URL
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, trip):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="alerts", daemon=True)
+                self._thread.start()
+        self._queue.put(trip)
+
+    def _run(self):
+        while True:
+            trip = self._queue.get()
+            try:
+                send_trip_alerts(trip)
+            except Exception as error:
+                logger.error(f"Failed to send trip alerts: {error}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Waits until all submitted alerts are sent
+        """
+        self._queue.join()
+
+
+alert_dispatcher = AlertDispatcher()
+_sqs_client = None
+
+
+def queue_trip_alerts(trip):
+    """
+    Hands a new trip over to alert fan-out, off the request path. Subscriptions are only kept with DynamoDB
+    :param trip: the saved trip
+    """
+    global _sqs_client
+    if not uses_dynamodb():
+        return
+    if not ALERTS_QUEUE_URL:
+        alert_dispatcher.submit(trip)
+        return
+    try:
+        if _sqs_client is None:
+            import boto3
+            _sqs_client = boto3.client('sqs')
+        _sqs_client.send_message(QueueUrl=ALERTS_QUEUE_URL, MessageBody=json.dumps({'trip': trip}))
+    except dynamodb_errors() as error:
+        metrics.increment("alerts.errors")
+        logger.error(f"Failed to queue trip alerts: {error}")
 
 
 def parse_date(date_string):
@@ -243,228 +1699,706 @@ def parse_date_to_ym(date_string):
         return None
 
 
-def generate_get_trips_msg(user_id):
+def parse_search_window(text):
     """
-    Generates a message for user's trips. It fetches user trips and formats a message with trip details.
-    It also appends a delete button to the inline keyboard object for each trip.
-
-    :param user_id: the ID of the user
-    :return: List with message text and inline keyboard dict
+    Parses a date range "DD-MM-YYYY..DD-MM-YYYY", or a date with the number of days before and after it
+    the user is fine with, "DD-MM-YYYY ±N" ("+-N" and "+/-N" work too, without it SEARCH_DEFAULT_WINDOW_DAYS is used)
+    :param text: user input
+    :return: tuple of the first date, the last date and the target date (None for ranges),
+        or None if the input is invalid or the window is longer than SEARCH_MAX_WINDOW_DAYS
     """
-    trips = get_my_trips(user_id)
-    local_getmytrips_inline_keyboard = deepcopy(GETMYTRIPS_INLINE_KEYBOARD)
-    if not trips:
-        getmytrips_text = "У вас нет предстоящих поездок"
+    if ".." in text:
+        first, _, last = text.partition("..")
+        from_date, to_date, target = parse_date(first.strip()), parse_date(last.strip()), None
+        if not from_date or not to_date or from_date > to_date:
+            return None
     else:
-        getmytrips_text = "Вот ваши предстоящие поездки:\n\n"
-        for i, trip in enumerate(trips, start=1):
-            if trip["to_belarus_date"] == DUMMY_DATE:
-                trip["to_belarus_date"] = "-"
-            if trip["to_spain_date"] == DUMMY_DATE:
-                trip["to_spain_date"] = "-"
-            getmytrips_text += f"{i}. " \
-                               f"Ваш контакт, как он отобразится в поиске: " \
-                               f"<a href=\"tg://user?id={trip['user_id']}\">{trip['first_name']}</a>,\n" \
-                               f"Дата поездки в Беларусь: {trip['to_belarus_date']},\n" \
-                               f"Дата поездки в Испанию: {trip['to_spain_date']},\n" \
-                               f"Примечание: {trip['note']}\n\n"
-            button = [{"text": f"Удалить поездку {i}.", "callback_data": f"/deletetrip_{trip['trip_id']}"}]
-            local_getmytrips_inline_keyboard["inline_keyboard"].insert(i - 1, button)
-    return getmytrips_text, local_getmytrips_inline_keyboard
-
+        date_text, days = text, str(SEARCH_DEFAULT_WINDOW_DAYS)
+        for separator in ("±", "+/-", "+-"):
+            if separator in text:
+                date_text, _, days = text.partition(separator)
+                break
+        target = parse_date(date_text.strip())
+        days = days.strip()
+        if not target or not days.isdigit():
+            return None
+        # Longer windows are refused below, the clamp keeps the timedelta in range
+        days = timedelta(days=min(int(days), SEARCH_MAX_WINDOW_DAYS))
+        try:
+            from_date, to_date = target - days, target + days
+        except OverflowError:
+            # The window goes past the first or the last date of the calendar
+            return None
+    if (to_date - from_date).days >= SEARCH_MAX_WINDOW_DAYS:
+        return None
+    return from_date, to_date, target
 
-def handle_startcallback(chat_id, message_id):
-    send_edit_message_text(chat_id, message_id, GREETING_TEXT, reply_markup=GREETING_INLINE_KEYBOARD)
 
+def generate_get_trips_msg(user_id):
+    """
+    Generates a message for user's trips. It fetches user trips and formats a message with trip details
+    and an inline keyboard with a delete button for each trip.
 
-def handle_searchtrips(chat_id, message_id):
-    send_edit_message_text(chat_id, message_id, SEARCH_INTRO_TEXT, reply_markup=SEARCH_INTRO_INLINE_KEYBOARD)
+    :param user_id: the ID of the user
+    :return: List with message text and inline keyboard
+    """
+    return render_my_trips(list(get_my_trips(user_id)))
+
+
+router = Router()
+
+GREETING_REPLY = StaticReply(GREETING_TEXT, GREETING_INLINE_KEYBOARD)
+SEARCH_INTRO_REPLY = StaticReply(SEARCH_INTRO_TEXT, SEARCH_INTRO_INLINE_KEYBOARD)
+SEARCH_BELARUS_PROMPT = StaticReply(step_prompt(SEARCH_BELARUS_TIME_TEXT + SEARCH_WINDOW_FORMATS_TEXT,
+                                                SEARCH_BELARUS_STEP), {"force_reply": True}, "HTML")
+SEARCH_SPAIN_PROMPT = StaticReply(step_prompt(SEARCH_SPAIN_TIME_TEXT + SEARCH_WINDOW_FORMATS_TEXT, SEARCH_SPAIN_STEP),
+                                  {"force_reply": True}, "HTML")
+SEARCH_ANY_PROMPT = StaticReply(step_prompt(SEARCH_ANY_TIME_TEXT + SEARCH_WINDOW_FORMATS_TEXT, SEARCH_ANY_STEP),
+                                {"force_reply": True}, "HTML")
+SAVETRIP_STEP1_PROMPT = StaticReply(step_prompt(SAVETRIP_STEP1_TEXT, SAVETRIP_STEP1), {"force_reply": True}, "HTML")
+ABOUT_REPLY = StaticReply(ABOUT_TEXT)
+ABOUT_SECOND_MSG_REPLY = StaticReply(ABOUT_SECOND_MSG_TEXT)
+HELP_REPLY = StaticReply(HELP_TEXT)
+INCORRECT_SEARCH_DATE_REPLY = StaticReply(INCORRECT_SEARCH_DATE_TEXT, SEARCH_END_KEYBOARD)
+INCORRECT_DATE_REPLY = StaticReply(INCORRECT_DATE_TEXT, INCORRECT_DATE_INLINE_KEYBOARD)
+NO_TRIP_DATES_REPLY = StaticReply(NO_TRIP_DATES_TEXT, INCORRECT_DATE_INLINE_KEYBOARD)
+WIZARD_STATE_ERROR_REPLY = StaticReply(WIZARD_STATE_ERROR_TEXT, INCORRECT_DATE_INLINE_KEYBOARD)
+SAVE_SUCCESS_REPLY = StaticReply(SAVE_SUCCESS_TEXT, SAVE_SUCCESS_INLINE_KEYBOARD)
+GENERIC_ERROR_REPLY = StaticReply(GENERIC_ERROR_TEXT)
+DELETE_ALL_TRIPS_CONFIRM_REPLY = StaticReply(DELETE_ALL_TRIPS_CONFIRM_TEXT, DELETE_ALL_TRIPS_CONFIRM_INLINE_KEYBOARD)
+
+
+@router.callback(START_COMMAND)
+@instrumented
+def handle_startcallback(context):
+    send_edit_message_text(context.chat_id, context.message_id, GREETING_REPLY)
+
+
+@router.callback("/searchtrips")
+@instrumented
+def handle_searchtrips(context):
+    send_edit_message_text(context.chat_id, context.message_id, SEARCH_INTRO_REPLY)
+
+
+@router.callback("/searchbelarusdate")
+@instrumented
+def handle_searchbelarusdate(context):
+    send_message(context.chat_id, SEARCH_BELARUS_PROMPT)
+
+
+@router.callback("/searchspaindate")
+@instrumented
+def handle_searchspaindate(context):
+    send_message(context.chat_id, SEARCH_SPAIN_PROMPT)
+
+
+@router.callback("/searchanydate")
+@instrumented
+def handle_searchanydate(context):
+    send_message(context.chat_id, SEARCH_ANY_PROMPT)
+
+
+@router.callback("/savetrip")
+@instrumented
+def handle_savetrip(context):
+    send_message(context.chat_id, SAVETRIP_STEP1_PROMPT)
+
+
+@router.callback("/getmytrips")
+@claimed
+@instrumented
+def handle_getmytrips(context):
+    text, inline_keyboard = generate_get_trips_msg(context.user_id)
+    send_edit_message_text(context.chat_id, context.message_id, text, reply_markup=inline_keyboard,
+                           parse_mode="HTML")
+
+
+@router.callback_prefix(DELETE_TRIP_COMMAND)
+@claimed
+@instrumented
+def handle_deletetrip(context):
+    trip_id = context.text.partition("_")[2]
+    delete_trip(context.user_id, trip_id)
+    # The list is rebuilt from the message with the delete button, a query right after deletion could still
+    # return the deleted trip. Messages that can't be rebuilt, e.g. sent before the list format changed, are queried
+    text, inline_keyboard = render_my_trips_without(context.message, trip_id) or generate_get_trips_msg(context.user_id)
+    send_edit_message_text(context.chat_id, context.message_id, text, reply_markup=inline_keyboard,
+                           parse_mode="HTML")
+
+
+@router.callback("/deletealltrips")
+@instrumented
+def handle_deletealltrips(context):
+    send_edit_message_text(context.chat_id, context.message_id, DELETE_ALL_TRIPS_CONFIRM_REPLY)
+
+
+@router.callback("/deletealltripsconfirm")
+@claimed
+@instrumented
+def handle_deletealltripsconfirm(context):
+    # A query right after deletion could still return the deleted trips, the list is only queried if deletion failed
+    if delete_all_trips(context.user_id) is None:
+        text, inline_keyboard = generate_get_trips_msg(context.user_id)
+    else:
+        text, inline_keyboard = render_my_trips([])
+    send_edit_message_text(context.chat_id, context.message_id, text, reply_markup=inline_keyboard,
+                           parse_mode="HTML")
 
 
-def handle_searchbelarusdate(chat_id):
-    send_message(chat_id, SEARCH_BELARUS_TIME_TEXT, reply_markup={"force_reply": True})
+class InvalidCallback(Exception):
+    """
+    Raised by callback handlers when callback data can't be parsed, e.g. it's from a keyboard of an older version
+    """
 
 
-def handle_searchspaindate(chat_id):
-    send_message(chat_id, SEARCH_SPAIN_TIME_TEXT, reply_markup={"force_reply": True})
+def handle_callback_query(update):
+    """
+    Unknown and malformed callbacks are answered with an error alert and are not raised, handling them again
+    would fail the same way
+    """
+    context = UpdateContext.from_callback_query(update['callback_query'], update.get('update_id'))
+    handler = router.callback_handler(context.text)
+    try:
+        if handler is None:
+            raise InvalidCallback("Unknown callback")
+        handler(context)
+    except InvalidCallback as error:
+        metrics.increment("updates.invalid_callbacks")
+        logger.error(f"{error}: {context.text}")
+        send_answer_callback_query(context.callback_query_id, text="Something went wrong", show_alert=True)
+        return
+    # Telegram stops showing the progress indicator by itself after a while
+    if has_time_for("answer_callback_query"):
+        send_answer_callback_query(context.callback_query_id)
 
 
-def handle_savetrip(chat_id):
-    send_message(chat_id, SAVETRIP_STEP1_TEXT, reply_markup={"force_reply": True})
+@router.command(START_COMMAND)
+@instrumented
+def handle_start(context):
+    send_message(context.chat_id, GREETING_REPLY)
 
 
-def handle_getmytrips(chat_id, user_id, message_id):
-    text, inline_keyboard = generate_get_trips_msg(user_id)
-    send_edit_message_text(chat_id, message_id, text, reply_markup=inline_keyboard, parse_mode="HTML")
+@router.command(ABOUT_COMMAND)
+@instrumented
+def handle_about(context):
+    send_message(context.chat_id, ABOUT_REPLY)
+    send_message(context.chat_id, ABOUT_SECOND_MSG_REPLY)
 
 
-def handle_deletetrip(callback_query_data, chat_id, user_id, message_id):
-    trip_id = callback_query_data.split("_")[1]
-    delete_trip(user_id, trip_id)
-    text, inline_keyboard = generate_get_trips_msg(user_id)
-    send_edit_message_text(chat_id, message_id, text, reply_markup=inline_keyboard, parse_mode="HTML")
+@router.command(HELP_COMMAND)
+@instrumented
+def handle_help(context):
+    send_message(context.chat_id, HELP_REPLY)
 
 
-def handle_callback_query(update):
-    callback_query = update['callback_query']
-    callback_query_id = callback_query['id']
-    callback_query_data = callback_query['data']
-    message = callback_query['message']
-    message_id = message['message_id']
-    chat_id = message['chat']['id']
-    user_id = callback_query['from']['id']
-
-    logger.debug("callback update fields:")
-    for key in update.keys():
-        logger.debug(f"{key}: {update[key]}\n")
-    logger.debug("callback_query fields:")
-    for key in callback_query.keys():
-        logger.debug(f"{key}: {callback_query[key]}\n")
-
-    if callback_query_data == START_COMMAND:
-        handle_startcallback(chat_id, message_id)
-    elif callback_query_data == "/searchtrips":
-        handle_searchtrips(chat_id, message_id)
-    elif callback_query_data == "/searchbelarusdate":
-        handle_searchbelarusdate(chat_id)
-    elif callback_query_data == "/searchspaindate":
-        handle_searchspaindate(chat_id)
-    elif callback_query_data == "/savetrip":
-        handle_savetrip(chat_id)
-    elif callback_query_data == "/getmytrips":
-        handle_getmytrips(chat_id, user_id, message_id)
-    elif callback_query_data.startswith("/deletetrip_"):
-        handle_deletetrip(callback_query_data, chat_id, user_id, message_id)
+def get_search_page(route, yyyy, mm, start_date=None, skip=0, start=1):
+    """
+    Fetches one page of search results and builds the keyboard for it.
+    Position of the next page is packed into callback data of the "next page" button as
+    "/searchpage_<b|s>_<yyyymm>_<date>_<skip>_<start>", where date is the date of the last trip on the page
+    and skip is the number of trips with that date already shown.
+    :param route: route of the trips, one of ROUTE_DIRECTIONS
+    :param yyyy: the year of the trip
+    :param mm: the month of the trip
+    :param start_date: optional date (YYYY-MM-DD) to start the page from
+    :param skip: number of trips with start_date to skip as they were shown on the previous pages
+    :param start: number of the first trip on the page
+    :return: List with message text and inline keyboard
+    :raises RetryableError: If the trips can't be read now
+    """
+    direction = ROUTE_DIRECTIONS[route]
+    limit = skip + SEARCH_PAGE_SIZE + 1
+    try:
+        month_trips = get_month_trips(route, yyyy, mm)
+    except (*storage_errors(), ValueError) as error:
+        logger.error(f"Failed to get trips: {error}")
+        raise_if_retryable(error)
+        month_trips = []
+    if start_date is None or start_date < today():
+        # Pages of a search started before midnight continue from today
+        start_date, skip = today(), 0
+        limit = SEARCH_PAGE_SIZE + 1
+    if month_trips is None:
+        trips = get_trips(route, yyyy, mm, start_date, limit)
     else:
-        send_answer_callback_query(callback_query_id, text="Something went wrong", show_alert=True)
-        logger.error("Unknown callback")
-        raise RuntimeError
-    send_answer_callback_query(callback_query_id)
+        trips = (trip for trip in month_trips if trip['date'] >= start_date)
+    trips = list(islice(trips, skip, limit))
+    subscribe = subscribe_button_data(direction, *(date.fromisoformat(day) for day in month_date_range(yyyy, mm)))
+    if not trips:
+        return "К сожалению, в этом месяце никто не едет.", search_page_markup(subscribe=subscribe)
+    if len(trips) <= SEARCH_PAGE_SIZE:
+        return render_search_results(trips, start), search_page_markup(subscribe=subscribe)
+    trips = trips[:SEARCH_PAGE_SIZE]
+    last_date = trips[-1]['date']
+    shown_on_last_date = sum(1 for trip in trips if trip['date'] == last_date)
+    if last_date == start_date:
+        shown_on_last_date += skip
+    next_page = (f"{SEARCH_PAGE_COMMAND}_{direction}_{yyyy}{mm}_{last_date.replace('-', '')}_"
+                 f"{shown_on_last_date}_{start + SEARCH_PAGE_SIZE}")
+    return render_search_results(trips, start), search_page_markup(next_page, subscribe)
+
+
+def get_window_trips(routes, from_date, to_date, target=None):
+    """
+    Finds trips in a date window, each route with range queries of the route index, run in parallel.
+    Trips are ranked by the distance of their date from the target date, then by date.
+    A trip with several legs within the window is listed once, by its closest leg
+    :param routes: tuple of routes to search
+    :param from_date: first date of the window
+    :param to_date: last date of the window
+    :param target: optional date the user wants the trip around
+    :return: list of at most SEARCH_WINDOW_MAX_TRIPS legs per route
+    :raises BotoCoreError, ClientError, StorageError: If a query fails
+    """
+    # Query generators request their first pages in background, so the routes are queried concurrently
+    queries = [query_date_range(route, str(from_date), str(to_date)) for route in routes]
+    ranked = {}
+    for trips in queries:
+        for trip in islice(trips, SEARCH_WINDOW_MAX_TRIPS):
+            trip_date = date.fromisoformat(trip['date'])
+            rank = (abs((trip_date - target).days) if target else 0, trip_date, trip['trip_id'])
+            key = (trip['user_id'], trip['trip_id'])
+            if key not in ranked or rank < ranked[key][0]:
+                ranked[key] = (rank, trip)
+    return [trip for rank, trip in sorted(ranked.values(), key=lambda entry: entry[0])]
+
+
+def get_window_page(direction, from_date, to_date, target=None, offset=0):
+    """
+    Builds one page of date window search results.
+    The page is packed into callback data of the "next page" button as
+    "/searchwindow_<direction>_<from>_<to>_<target or 0>_<offset>", dates as YYYYMMDD
+    :param direction: key of DIRECTIONS
+    :param from_date: first date of the window
+    :param to_date: last date of the window
+    :param target: optional date the results are ranked around
+    :param offset: number of trips shown on the previous pages
+    :return: List with message text and inline keyboard
+    :raises RetryableError: If the trips can't be read now
+    """
+    try:
+        trips = get_window_trips(DIRECTIONS[direction], from_date, to_date, target)
+    except storage_errors() as error:
+        logger.error(f"Failed to get trips: {error}")
+        raise_if_retryable(error)
+        trips = []
+    page = trips[offset:offset + SEARCH_PAGE_SIZE]
+    subscribe = subscribe_button_data(direction, from_date, to_date)
+    if not page:
+        return "К сожалению, в этот период никто не едет.", search_page_markup(subscribe=subscribe)
+    next_page = None
+    if len(trips) > offset + SEARCH_PAGE_SIZE:
+        next_page = (f"{SEARCH_WINDOW_COMMAND}_{direction}_{from_date:%Y%m%d}_{to_date:%Y%m%d}_"
+                     f"{f'{target:%Y%m%d}' if target else 0}_{offset + SEARCH_PAGE_SIZE}")
+    return render_search_results(page, offset + 1), search_page_markup(next_page, subscribe)
+
+
+def handle_search(context, direction):
+    """
+    Searches by month (MM-YYYY) or by date window, see parse_search_window.
+    Month searches in one direction are served from the month views, other searches query the date index
+    :param direction: key of DIRECTIONS
+    """
+    yyyy_mm = parse_date_to_ym(context.text.strip())
+    if yyyy_mm and len(DIRECTIONS[direction]) == 1:
+        text, inline_keyboard = get_search_page(DIRECTIONS[direction][0], yyyy_mm[0], yyyy_mm[1])
+    else:
+        if yyyy_mm:
+            window = (*(date.fromisoformat(day) for day in month_date_range(*yyyy_mm)), None)
+        else:
+            window = parse_search_window(context.text.strip())
+        if window is None:
+            send_message(context.chat_id, INCORRECT_SEARCH_DATE_REPLY)
+            return
+        text, inline_keyboard = get_window_page(direction, *window)
+    send_message(context.chat_id, text, reply_markup=inline_keyboard, parse_mode="HTML")
 
 
-def handle_start(chat_id):
-    send_message(chat_id, GREETING_TEXT, reply_markup=GREETING_INLINE_KEYBOARD)
+@router.step(SEARCH_BELARUS_STEP, legacy_prompt=SEARCH_BELARUS_TIME_TEXT)
+@claimed
+@instrumented
+def handle_search_belarus(context, state):
+    handle_search(context, 'b')
 
 
-def handle_about(chat_id):
-    send_message(chat_id, ABOUT_TEXT)
-    send_message(chat_id, ABOUT_SECOND_MSG_TEXT)
+@router.step(SEARCH_SPAIN_STEP, legacy_prompt=SEARCH_SPAIN_TIME_TEXT)
+@claimed
+@instrumented
+def handle_search_spain(context, state):
+    handle_search(context, 's')
 
 
-def handle_help(chat_id):
-    send_message(chat_id, HELP_TEXT)
+@router.step(SEARCH_ANY_STEP)
+@claimed
+@instrumented
+def handle_search_any(context, state):
+    handle_search(context, 'a')
 
 
-def generate_search_results_text(search_results):
-    search_results_formatted = ''
-    for i, trip in enumerate(search_results, start=1):
-        if trip["to_belarus_date"] == DUMMY_DATE:
-            trip["to_belarus_date"] = "-"
-        if trip["to_spain_date"] == DUMMY_DATE:
-            trip["to_spain_date"] = "-"
-        search_results_formatted += f"{i}. " \
-                                    f"<a href=\"tg://user?id={trip['user_id']}\">{trip['first_name']}</a>,\n" \
-                                    f"Дата поездки в Беларусь: {trip['to_belarus_date']},\n" \
-                                    f"Дата поездки в Испанию: {trip['to_spain_date']},\n" \
-                                    f"Примечание: {trip['note']}\n\n"
-    return search_results_formatted
+@router.callback_prefix(SEARCH_WINDOW_COMMAND)
+@claimed
+@instrumented
+def handle_searchwindow(context):
+    try:
+        direction, from_date, to_date, target, offset = context.text.split("_")[1:]
+        from_date, to_date = (datetime.strptime(from_date, "%Y%m%d").date(),
+                              datetime.strptime(to_date, "%Y%m%d").date())
+        target = datetime.strptime(target, "%Y%m%d").date() if target != "0" else None
+        offset = int(offset)
+    except ValueError:
+        raise InvalidCallback("Malformed search window page")
+    if direction not in DIRECTIONS:
+        raise InvalidCallback("Malformed search window page")
+    text, inline_keyboard = get_window_page(direction, from_date, to_date, target, offset)
+    send_edit_message_text(context.chat_id, context.message_id, text, reply_markup=inline_keyboard,
+                           parse_mode="HTML")
+
+
+@router.callback_prefix(SEARCH_PAGE_COMMAND)
+@claimed
+@instrumented
+def handle_searchpage(context):
+    try:
+        direction, yyyymm, last_date, skip, start = context.text.split("_")[1:]
+        datetime.strptime(yyyymm, "%Y%m")
+        start_date = str(datetime.strptime(last_date, "%Y%m%d").date())
+        skip, start = int(skip), int(start)
+    except ValueError:
+        raise InvalidCallback("Malformed search page")
+    if direction not in ROUTE_DIRECTIONS.values():
+        raise InvalidCallback("Malformed search page")
+    text, inline_keyboard = get_search_page(DIRECTIONS[direction][0], yyyymm[:4], yyyymm[4:], start_date, skip, start)
+    send_edit_message_text(context.chat_id, context.message_id, text, reply_markup=inline_keyboard,
+                           parse_mode="HTML")
+
+
+@router.callback_prefix(SUBSCRIBE_COMMAND)
+@claimed
+@instrumented
+def handle_subscribe(context):
+    subscription = parse_subscription(context.text)
+    if subscription is None or not subscribe(context.user_id, *subscription):
+        send_message(context.chat_id, GENERIC_ERROR_REPLY)
+        return
+    _, from_date, to_date = subscription
+    send_message(context.chat_id, SUBSCRIBED_TEXT.format(from_date=from_date, to_date=to_date),
+                 reply_markup=unsubscribe_markup(subscription_callback_data(UNSUBSCRIBE_COMMAND, *subscription)))
+
+
+@router.callback_prefix(UNSUBSCRIBE_COMMAND)
+@claimed
+@instrumented
+def handle_unsubscribe(context):
+    subscription = parse_subscription(context.text)
+    if subscription is None or not unsubscribe(context.user_id, *subscription):
+        send_message(context.chat_id, GENERIC_ERROR_REPLY)
+        return
+    _, from_date, to_date = subscription
+    send_message(context.chat_id, UNSUBSCRIBED_TEXT.format(from_date=from_date, to_date=to_date),
+                 reply_markup=SEARCH_END_KEYBOARD)
+
+
+wizard_state_codec = WizardStateCodec(TELEGRAM_API_KEY)
+
+
+def decode_wizard_state(state):
+    """
+    Decodes save trip wizard state. Prompts sent before the compact codec carry the state as JSON
+    :param state: state string from the prompt the user replied to
+    :return: state dict, or None if the state is missing or corrupted
+    """
+    if state and state.startswith("{"):
+        try:
+            trip_data = json.loads(state)
+        except ValueError:
+            return None
+        return trip_data if isinstance(trip_data, dict) else None
+    return wizard_state_codec.decode(state)
 
 
-def handle_search(message, chat_id, is_to_belarus=True):
-    user_input = message["text"]
-    yyyy_mm = parse_date_to_ym(user_input)
-    if yyyy_mm:
-        search_results = get_trips(is_to_belarus, yyyy_mm[0], yyyy_mm[1])
-        if search_results:
-            search_results = generate_search_results_text(search_results)
-        else:
-            search_results = "К сожалению, в этом месяце никто не едет."
-        send_message(chat_id, search_results, reply_markup=SEARCH_END_KEYBOARD, parse_mode="HTML")
-    else:
-        send_message(chat_id, INCORRECT_SEARCH_DATE_TEXT, reply_markup=SEARCH_END_KEYBOARD)
+def reject_wizard_state(context):
+    logger.warning(f"Rejected corrupted save trip state in chat {context.chat_id}")
+    send_message(context.chat_id, WIZARD_STATE_ERROR_REPLY)
 
 
-def handle_savetrip_first_step(chat_id, user_input):
+@router.step(SAVETRIP_STEP1, legacy_prompt=SAVETRIP_STEP1_TEXT)
+@instrumented
+def handle_savetrip_first_step(context, state):
+    user_input = context.text
     if user_input == "-" or parse_date(user_input):
         to_belarus_date = DUMMY_DATE if user_input == "-" else str(parse_date(user_input))
-        trip_data = json.dumps({"to_belarus_date": to_belarus_date})
-        savetrip_step2_text_encoded = message_data_encode(SAVETRIP_STEP2_TEXT, trip_data)
-        send_message(chat_id, savetrip_step2_text_encoded, reply_markup={"force_reply": True},
-                     parse_mode="HTML")
+        trip_data = wizard_state_codec.encode({"to_belarus_date": to_belarus_date})
+        send_message(context.chat_id, step_prompt(SAVETRIP_STEP2_TEXT, SAVETRIP_STEP2, trip_data),
+                     reply_markup={"force_reply": True}, parse_mode="HTML")
     else:
-        send_message(chat_id, INCORRECT_DATE_TEXT, reply_markup=INCORRECT_DATE_INLINE_KEYBOARD)
-
-
-def handle_savetrip_second_step(chat_id, message, user_input):
-    trip_data = json.loads(message_data_decode(message["reply_to_message"]["entities"][0]["url"]))
-    if user_input == "-" or parse_date(user_input):
+        send_message(context.chat_id, INCORRECT_DATE_REPLY)
+
+
+@router.step(SAVETRIP_STEP2, legacy_prompt=SAVETRIP_STEP2_TEXT)
+@instrumented
+def handle_savetrip_second_step(context, state):
+    trip_data = decode_wizard_state(state)
+    if trip_data is None or "to_belarus_date" not in trip_data:
+        reject_wizard_state(context)
+        return
+    user_input = context.text
+    if user_input == "-" and trip_data["to_belarus_date"] == DUMMY_DATE:
+        send_message(context.chat_id, NO_TRIP_DATES_REPLY)
+    elif user_input == "-" or parse_date(user_input):
         to_spain_date = DUMMY_DATE if user_input == "-" else str(parse_date(user_input))
         trip_data["to_spain_date"] = to_spain_date
-        trip_data = json.dumps(trip_data)
-        savetrip_step3_text_encoded = message_data_encode(SAVETRIP_STEP3_TEXT, trip_data)
-        send_message(chat_id, savetrip_step3_text_encoded, reply_markup={"force_reply": True},
-                     parse_mode="HTML")
+        trip_data = wizard_state_codec.encode(trip_data)
+        send_message(context.chat_id, step_prompt(SAVETRIP_STEP3_TEXT, SAVETRIP_STEP3, trip_data),
+                     reply_markup={"force_reply": True}, parse_mode="HTML")
     else:
-        send_message(chat_id, INCORRECT_DATE_TEXT, reply_markup=INCORRECT_DATE_INLINE_KEYBOARD)
+        send_message(context.chat_id, INCORRECT_DATE_REPLY)
 
 
-def handle_savetrip_third_step(chat_id, message, user_id, first_name, user_input):
-    trip_data = json.loads(message_data_decode(message["reply_to_message"]["entities"][0]["url"]))
-    trip_data["note"] = user_input
-    trip_data["first_name"] = first_name
-    trip_data["trip_id"] = str(time.time())
-    save_trip_data(user_id, trip_data)
-    send_message(chat_id, SAVE_SUCCESS_TEXT, reply_markup=SAVE_SUCCESS_INLINE_KEYBOARD)
+def update_trip_id(context):
+    """
+    Derives the ID of a trip saved by the update, so the trip is saved once however many times the update is handled.
+    Message time goes first to keep trips of a user in order, update ID makes it unique.
+    Callback data is split by "_" and leg items are keyed "<trip ID>#<route>", so the ID must not have either
+    :return: "<message unix time>.<update ID>"
+    """
+    return f"{context.message['date']}.{context.update_id}"
+
+
+@router.step(SAVETRIP_STEP3, legacy_prompt=SAVETRIP_STEP3_TEXT)
+@instrumented
+def handle_savetrip_third_step(context, state):
+    state = decode_wizard_state(state)
+    # Directions skipped in the wizard have no legs, prompts sent before they were required may have none
+    if state is None or "to_spain_date" not in state or not legs_from_dates(state):
+        reject_wizard_state(context)
+        return
+    trip_data = {"legs": legs_from_dates(state)}
+    trip_data["note"] = context.text
+    trip_data["first_name"] = context.first_name
+    trip_data["trip_id"] = update_trip_id(context)
+    # The trip is saved once however many times the update is handled, the claim keeps subscribers
+    # from being alerted again
+    if not claim_update(context.update_id):
+        metrics.increment("updates.duplicates")
+        logger.info(f"Skipping update {context.update_id}, it has already been handled")
+        return
+    try:
+        saved = save_trip_data(context.user_id, trip_data)
+    except Exception:
+        release_update(context.update_id)
+        raise
+    if saved is None:
+        release_update(context.update_id)
+    else:
+        queue_trip_alerts(trip_data)
+        complete_update(context.update_id)
+    send_message(context.chat_id, SAVE_SUCCESS_REPLY)
 
 
-def generic_error_response(chat_id):
-    send_message(chat_id, GENERIC_ERROR_TEXT)
+@instrumented
+def generic_error_response(context):
+    send_message(context.chat_id, GENERIC_ERROR_REPLY)
 
 
 def handle_text_message(update):
     message = update['message']
-    chat_id = message['chat']['id']
-    user_input = message['text']
-    user_id = message['from']['id']
-    first_name = message['from']['first_name']
-
-    logger.debug("Message Fields:")
-    for key in message.keys():
-        logger.debug(f"{key}: {message[key]}\n")
-    logger.debug("Update Fields:")
-    for key in update.keys():
-        logger.debug(f"{key}: {update[key]}\n")
-
-    commands = {
-        START_COMMAND: handle_start,
-        ABOUT_COMMAND: handle_about,
-        HELP_COMMAND: handle_help
-    }
-    if user_input.lower() in commands:
-        commands[user_input.lower()](chat_id)
+    context = UpdateContext.from_message(message, update.get('update_id'))
+    handler = router.command_handler(context.text)
+    if handler is not None:
+        handler(context)
+    elif "reply_to_message" in message:
+        handler, state = router.step_handler(message["reply_to_message"])
+        if handler is not None:
+            handler(context, state)
     else:
-        if "reply_to_message" in message:
-            reply_message_text = message["reply_to_message"]["text"]
-            if reply_message_text == SAVETRIP_STEP1_TEXT:
-                handle_savetrip_first_step(chat_id, user_input)
-            elif reply_message_text.startswith(SAVETRIP_STEP2_TEXT):
-                handle_savetrip_second_step(chat_id, message, user_input)
-            elif reply_message_text.startswith(SAVETRIP_STEP3_TEXT):
-                handle_savetrip_third_step(chat_id, message, user_id, first_name, user_input)
-            elif reply_message_text == SEARCH_BELARUS_TIME_TEXT:
-                handle_search(message, chat_id, is_to_belarus=True)
-            elif reply_message_text == SEARCH_SPAIN_TIME_TEXT:
-                handle_search(message, chat_id, is_to_belarus=False)
-        else:
-            logger.info('Incorrect input')
-            generic_error_response(chat_id)
+        logger.info('Incorrect input')
+        generic_error_response(context)
+
+
+class SeenUpdates:
+    """
+    LRU set of update IDs handled by this container
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        """
+        :return: True if the update wasn't seen before
+        """
+        with self._lock:
+            if update_id in self._ids:
+                self._ids.move_to_end(update_id)
+                return False
+            self._ids[update_id] = None
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, update_id):
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+
+seen_updates = SeenUpdates(UPDATE_DEDUP_CACHE_SIZE)
+
+
+def update_marker_key(update_id):
+    """
+    :return: primary key of the update marker. Update IDs are positive, so every marker has its own partition
+        apart from trips. A month view or subscriptions may share it, the sort key tells them apart
+    """
+    return {'user_id': -update_id, 'trip_id': UPDATE_MARKER_SORT_KEY}
+
+
+_update_markers = True
+
+
+def use_update_markers(enabled):
+    """
+    Turns update markers in the table on or off, e.g. off in the poller, where getUpdates offsets already keep
+    updates from being delivered twice
+    :param enabled: False to handle updates with side effects without claiming them
+    """
+    global _update_markers
+    _update_markers = enabled
+
+
+def uses_update_markers(update_id):
+    return update_id is not None and UPDATE_DEDUP_TTL > 0 and _update_markers and uses_dynamodb()
+
+
+def claim_update(update_id):
+    """
+    Takes a lease on handling an update, with a conditional write of the update marker.
+    The lease lasts until the invocation times out (UPDATE_LEASE_TIME outside Lambda), so an update whose handling
+    was cut short by a timeout or a crash is handled when it's redelivered after that.
+    If the marker can't be written, the update is handled
+    :param update_id: Telegram update ID
+    :return: True if the update has to be handled, False if it's handled already or is being handled
+    """
+    if not uses_update_markers(update_id):
+        return True
+    now = int(time.time())
+    lease_time = UPDATE_LEASE_TIME if _deadline is None else math.ceil(_deadline.remaining() + DEADLINE_RESERVE)
+    try:
+        get_table().put_item(Item={**update_marker_key(update_id), 'state': 'in_progress',
+                                   EXPIRY_ATTRIBUTE: now + lease_time},
+                             # Both expired leases and expired "done" markers, which TTL deletes only eventually
+                             ConditionExpression="attribute_not_exists(trip_id) OR #expires_at < :now",
+                             ExpressionAttributeNames={"#expires_at": EXPIRY_ATTRIBUTE},
+                             ExpressionAttributeValues={":now": now})
+    except dynamodb_errors() as error:
+        if error_code(error) == 'ConditionalCheckFailedException':
+            return False
+        logger.error(f"Failed to claim update {update_id}: {error}")
+    return True
+
+
+def complete_update(update_id):
+    """
+    Replaces the lease on a handled update with a marker kept for UPDATE_DEDUP_TTL seconds
+    :param update_id: Telegram update ID
+    """
+    if not uses_update_markers(update_id):
+        return
+    try:
+        get_table().put_item(Item={**update_marker_key(update_id), 'state': 'done',
+                                   EXPIRY_ATTRIBUTE: int(time.time()) + UPDATE_DEDUP_TTL})
+    except dynamodb_errors() as error:
+        logger.error(f"Failed to complete update {update_id}: {error}")
+
+
+def release_update(update_id):
+    """
+    Gives up the lease on an update, so it's handled again when it's redelivered, e.g. after it failed
+    :param update_id: Telegram update ID
+    """
+    if not uses_update_markers(update_id):
+        return
+    try:
+        get_table().delete_item(Key=update_marker_key(update_id))
+    except dynamodb_errors() as error:
+        logger.error(f"Failed to release update {update_id}: {error}")
 
 
 def process_update(update):
-    if 'callback_query' in update:
-        handle_callback_query(update)
-    else:
-        handle_text_message(update)
+    """
+    Handles the update unless this container has already handled it.
+    Handlers which use the table claim the update in the table as well, see claimed
+    :param update: Telegram update
+    """
+    log_update_payload(update)
+    update_id = update.get('update_id') if UPDATE_DEDUP_TTL > 0 else None
+    if update_id is not None and not seen_updates.add(update_id):
+        metrics.increment("updates.duplicates")
+        logger.info(f"Skipping update {update_id}, it has already been handled")
+        return
+    try:
+        if 'callback_query' in update:
+            handle_callback_query(update)
+        else:
+            handle_text_message(update)
+    except Exception:
+        if update_id is not None:
+            seen_updates.discard(update_id)
+        raise
+
+
+# Worker threads for handling batches of updates
+update_executor = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update")
+
+
+def update_chat_id(update):
+    """
+    Returns ID of the chat the update came from. Updates from the same chat have to be handled in order
+    :param update: Telegram update
+    :return: chat ID, or None if the update is not bound to a chat
+    """
+    message = update['callback_query'].get('message') if 'callback_query' in update else update.get('message')
+    return message['chat']['id'] if message else None
+
+
+def process_updates(updates):
+    """
+    Handles updates concurrently, each one with its outbound calls batched.
+    Updates from the same chat are handled one after another in the given order.
+    An update fails if it raises RetryableError or some of its Telegram API calls failed in a way that may go away.
+    Once an update fails, the following updates from its chat are not handled, so they can be retried in order.
+    Updates raising other errors would fail again on retry, they are logged and skipped
+    :param updates: list of Telegram updates
+    :return: set of indexes of updates that failed or were not handled
+    """
+    chains = {}
+    for index, update in enumerate(updates):
+        chat_id = update_chat_id(update)
+        chains.setdefault(("update", index) if chat_id is None else chat_id, []).append(index)
+
+    def process_chain(chain):
+        for position, index in enumerate(chain):
+            update_id = updates[index].get('update_id')
+            try:
+                with outbound_batch() as batch:
+                    process_update(updates[index])
+                if batch.retryable_failures:
+                    # The update has to be handled again when it's redelivered
+                    seen_updates.discard(update_id)
+                    raise RetryableError(f"{batch.retryable_failures} Telegram API calls failed")
+            except RetryableError as error:
+                logger.error(f"Failed to process update {update_id}, it will be retried: {error}")
+                return chain[position:]
+            except Exception as error:
+                metrics.increment("updates.dropped")
+                logger.error(f"Failed to process update {update_id}, dropping it: {error}")
+        return []
+
+    failed = set()
+    for chain_failed in update_executor.map(process_chain, chains.values()):
+        failed.update(chain_failed)
+    return failed
 
 
 def lambda_handler(event, context):
@@ -474,14 +2408,78 @@ def lambda_handler(event, context):
     :param event: The incoming event data
     :param context: The Lambda context object.
     :return: dict: A dictionary containing HTTP response code and body.
-        Always returns 200 to make sure that agent won't spam to server
+        Always returns 200 to make sure that agent won't spam to server.
+        If TELEGRAM_WEBHOOK_REPLY is enabled, body contains one of the API calls for Telegram to execute
     """
     event_processed = {"statusCode": 200, "body": json.dumps({})}
     try:
         update = json.loads(event['body'])
-        process_update(update)
+        with invocation_deadline(context), metrics.timer("invocation"), outbound_batch() as batch:
+            process_update(update)
+            webhook_reply = batch.pop_webhook_reply() if TELEGRAM_WEBHOOK_REPLY else None
+        if webhook_reply:
+            operation, data = webhook_reply
+            metrics.increment(f"telegram.{operation}.webhook_reply")
+            return {"statusCode": 200, "headers": {"Content-Type": "application/json"},
+                    "body": encode_json({"method": operation, **data}).decode("utf-8")}
         return event_processed
     except Exception as error:
+        metrics.increment("invocation.errors")
         logger.error("Something went terribly wrong. Bot crashed")
         logger.error(error)
         return event_processed
+    finally:
+        metrics.flush()
+
+
+def sqs_handler(event, context):
+    """
+    The Lambda function handler for batches of updates, e.g. when updates are put into SQS queue by the webhook.
+    Every record body is a Telegram update. Malformed records are logged and dropped, as are updates which fail
+    for reasons retrying won't fix, see process_updates. Requires ReportBatchItemFailures to be enabled
+    for the event source mapping
+
+    :param event: The incoming event data with "Records" list
+    :param context: The Lambda context object.
+    :return: dict: Partial batch response with message IDs of records which have to be retried
+    """
+    records, updates = [], []
+    for record in event['Records']:
+        try:
+            updates.append(json.loads(record['body']))
+            records.append(record)
+        except ValueError as error:
+            logger.error(f"Dropping malformed update {record['messageId']}: {error}")
+    with invocation_deadline(context), metrics.timer("invocation"):
+        failed = process_updates(updates)
+    metrics.increment("invocation.updates", len(updates))
+    metrics.increment("invocation.failed_updates", len(failed))
+    metrics.flush()
+    return {"batchItemFailures": [{"itemIdentifier": records[index]['messageId']} for index in sorted(failed)]}
+
+
+def alerts_handler(event, context):
+    """
+    The Lambda function handler for the ALERTS_QUEUE_URL queue, every record body has a new trip to notify
+    subscribers of. Telegram limits are kept per process, so the function should have reserved concurrency of 1.
+    Failed alerts are logged and not retried, retrying the record would repeat the alerts already sent.
+    Records which are not started before the deadline are returned for retry (ReportBatchItemFailures)
+
+    :param event: The incoming event data with "Records" list
+    :param context: The Lambda context object.
+    :return: dict: Partial batch response with message IDs of records which have to be retried
+    """
+    postponed = []
+    with invocation_deadline(context):
+        for record in event['Records']:
+            if postponed or not has_time_for("trip_alerts"):
+                postponed.append(record['messageId'])
+                continue
+            try:
+                trip = json.loads(record['body'])['trip']
+            except (ValueError, KeyError) as error:
+                logger.error(f"Dropping malformed alert {record['messageId']}: {error}")
+                continue
+            send_trip_alerts(trip)
+    metrics.flush()
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in postponed]}
@@ -0,0 +1,225 @@
+"""
+Long polling runner for deployments outside of AWS Lambda.
+Fetches updates with getUpdates and handles them on a bounded worker pool, updates from the same chat in order.
+Updates are confirmed to Telegram and the offset is persisted in a file only once they are handled, so updates
+a stopped or crashed runner didn't finish are fetched again by the next one.
+On SIGINT/SIGTERM the runner stops polling and waits for updates in flight to be handled.
+Usage: python poller.py [--offset-file PATH] [--workers N] [--poll-timeout SECONDS]
+Requires the same environment variables as carrier_bot.py. The webhook has to be removed for getUpdates to work
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from carrier_bot import logger, TelegramApiClient, TELEGRAM_BOT_API, TELEGRAM_CONNECT_TIMEOUT, \
+    TELEGRAM_READ_TIMEOUT, UPDATE_WORKERS, metrics, outbound_batch, process_update, update_chat_id, alert_dispatcher, \
+    use_update_markers
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+MAX_ERROR_DELAY = 30
+# Maximum seconds to wait for an update in progress to be handled before polling again
+PROGRESS_WAIT = 1
+
+
+class PollerStopped(Exception):
+    pass
+
+
+class ChatDispatcher:
+    """
+    Handles updates on a bounded worker pool, updates from the same chat one after another in arrival order
+    """
+
+    def __init__(self, workers, max_pending):
+        """
+        :param workers: Number of worker threads
+        :param max_pending: Maximum number of updates queued or in progress, submit blocks when it's reached
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._chats = {}  # chat key -> deque of updates, present while the chat has updates in progress
+        self._pending = 0
+        self._unfinished = set()  # IDs of updates queued or in progress
+        self._finished = 0
+
+    def submit(self, update):
+        self._slots.acquire()
+        chat_id = update_chat_id(update)
+        key = ("update", update['update_id']) if chat_id is None else chat_id
+        with self._lock:
+            self._pending += 1
+            self._unfinished.add(update['update_id'])
+            chat_updates = self._chats.get(key)
+            if chat_updates is not None:
+                chat_updates.append(update)
+                return
+            self._chats[key] = deque([update])
+        self._executor.submit(self._run_chat, key)
+
+    def _run_chat(self, key):
+        while True:
+            with self._lock:
+                chat_updates = self._chats[key]
+                if not chat_updates:
+                    del self._chats[key]
+                    return
+                update = chat_updates[0]
+            try:
+                with outbound_batch():
+                    process_update(update)
+            except Exception as error:
+                logger.error(f"Failed to process update {update['update_id']}: {error}")
+            with self._lock:
+                chat_updates.popleft()
+                self._pending -= 1
+                self._unfinished.discard(update['update_id'])
+                self._finished += 1
+                self._idle.notify_all()
+            self._slots.release()
+
+    def first_unfinished(self):
+        """
+        :return: the lowest ID of the updates queued or in progress, or None if all submitted updates are handled
+        """
+        with self._lock:
+            return min(self._unfinished, default=None)
+
+    def wait_for_progress(self, timeout):
+        """
+        Waits until one more update is handled
+        :param timeout: maximum seconds to wait
+        """
+        with self._lock:
+            finished = self._finished
+            self._idle.wait_for(lambda: self._finished != finished or not self._pending, timeout)
+
+    def join(self):
+        """
+        Waits until all submitted updates are handled
+        """
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+        self._executor.shutdown()
+
+
+def load_offset(offset_file):
+    try:
+        with open(offset_file) as file:
+            return int(file.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def save_offset(offset_file, offset):
+    temporary_file = f"{offset_file}.tmp"
+    with open(temporary_file, "w") as file:
+        file.write(str(offset))
+    os.replace(temporary_file, offset_file)
+
+
+def get_updates(client, offset, poll_timeout):
+    """
+    Long polls Telegram for new updates. Updates with ID lower than offset are confirmed and won't be returned again
+    :param client: TelegramApiClient with read timeout longer than poll_timeout
+    :param offset: ID of the first update to return
+    :param poll_timeout: Seconds Telegram waits for new updates before returning empty list
+    :return: list of updates
+    :raises RuntimeError: If Telegram returned an error
+    """
+    data = {"timeout": poll_timeout, "allowed_updates": ALLOWED_UPDATES}
+    if offset is not None:
+        data["offset"] = offset
+    status, response = client.request("getUpdates", json.dumps(data).encode("utf-8"),
+                                      {"Content-Type": "application/json"})
+    if status != 200 or not response.get("ok"):
+        raise RuntimeError(f"getUpdates failed with status {status}: {response.get('description')}")
+    return response["result"]
+
+
+def run(offset_file, workers, poll_timeout):
+    client = TelegramApiClient(TELEGRAM_BOT_API, TELEGRAM_CONNECT_TIMEOUT, poll_timeout + TELEGRAM_READ_TIMEOUT, 1)
+    dispatcher = ChatDispatcher(workers, max_pending=workers * 4)
+    # getUpdates offsets already keep updates from being delivered twice
+    use_update_markers(False)
+    stopping = threading.Event()
+    polling = threading.Event()
+
+    def stop(signum, frame):
+        logger.info(f"Received signal {signum}, stopping")
+        stopping.set()
+        if polling.is_set():
+            raise PollerStopped
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # ID of the first update which is not submitted yet
+    next_offset = saved_offset = load_offset(offset_file)
+    logger.info(f"Polling for updates from offset {next_offset}")
+    errors = 0
+    while not stopping.is_set():
+        # Updates are confirmed by polling with a higher offset, so the ones still in progress are not confirmed
+        # and come again in the response, where they are skipped
+        offset = dispatcher.first_unfinished()
+        if offset is None:
+            offset = next_offset
+        try:
+            polling.set()
+            updates = get_updates(client, offset, poll_timeout)
+            errors = 0
+        except PollerStopped:
+            break
+        except (http.client.HTTPException, OSError, ValueError, RuntimeError) as error:
+            errors += 1
+            delay = min(2 ** errors, MAX_ERROR_DELAY)
+            logger.error(f"Failed to get updates, retrying in {delay}s: {error}")
+            stopping.wait(delay)
+            continue
+        finally:
+            polling.clear()
+        new_updates = [update for update in updates if next_offset is None or update['update_id'] >= next_offset]
+        for update in new_updates:
+            dispatcher.submit(update)
+        if new_updates:
+            next_offset = new_updates[-1]['update_id'] + 1
+        if offset != saved_offset:
+            save_offset(offset_file, offset)
+            saved_offset = offset
+        # Metrics of the updates handled since the previous poll
+        metrics.flush()
+        if updates and not new_updates:
+            # Telegram returns updates in progress right away, so the next poll waits until one of them is handled
+            dispatcher.wait_for_progress(PROGRESS_WAIT)
+
+    logger.info("Waiting for updates in progress")
+    dispatcher.join()
+    if next_offset is not None and next_offset != saved_offset:
+        save_offset(offset_file, next_offset)
+    logger.info("Waiting for trip alerts to be sent")
+    alert_dispatcher.join()
+    metrics.flush()
+    client.close()
+    logger.info("Stopped")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+    parser = argparse.ArgumentParser(description="Run the bot with long polling")
+    parser.add_argument("--offset-file", default="poller_offset", help="file the update offset is stored in")
+    parser.add_argument("--workers", type=int, default=UPDATE_WORKERS, help="number of worker threads")
+    parser.add_argument("--poll-timeout", type=int, default=30, help="long polling timeout in seconds")
+    args = parser.parse_args()
+    run(args.offset_file, args.workers, args.poll_timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Rendering of bot replies.
+Static replies and keyboards are serialized to JSON once at import, dynamic keyboards are joined from
+pre-encoded button fragments and message lists are rendered with a single join.
+Telegram API request bodies are assembled from the pre-encoded parts by encode_json()
+"""
+import json
+from html import escape
+
+from vars import DESTINATION_TEXTS, GETMYTRIPS_INLINE_KEYBOARD, SEARCH_END_KEYBOARD, SEARCH_NEXT_PAGE_TEXT, \
+    DELETE_ALL_TRIPS_BUTTON_TEXT, SUBSCRIBE_BUTTON_TEXT, UNSUBSCRIBE_BUTTON_TEXT, TRIP_ALERT_TEXT
+
+
+# json.dumps builds a new encoder on every call with non-default options
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps(value):
+    return _encoder.encode(value).encode("utf-8")
+
+
+class Encoded:
+    """
+    JSON value serialized once, inserted into request bodies as is
+    """
+    __slots__ = ("json",)
+
+    def __init__(self, value):
+        self.json = dumps(value)
+
+    @classmethod
+    def raw(cls, json_bytes):
+        encoded = cls.__new__(cls)
+        encoded.json = json_bytes
+        return encoded
+
+
+_encoded_keys = {}
+
+
+def encode_json(data):
+    """
+    Serializes API call parameters, values may be Encoded
+    :param data: dict of parameters
+    :return: JSON bytes
+    """
+    parts = []
+    for key, value in data.items():
+        encoded_key = _encoded_keys.get(key)
+        if encoded_key is None:
+            encoded_key = _encoded_keys[key] = dumps(key) + b":"
+        parts.append(encoded_key + (value.json if type(value) is Encoded else dumps(value)))
+    return b"{" + b",".join(parts) + b"}"
+
+
+class StaticReply:
+    """
+    Text, keyboard and parse mode of a message that never changes, serialized once
+    """
+
+    def __init__(self, text, reply_markup=None, parse_mode=None):
+        self.fields = {"text": Encoded(text)}
+        if reply_markup:
+            self.fields["reply_markup"] = Encoded(reply_markup)
+        if parse_mode:
+            self.fields["parse_mode"] = Encoded(parse_mode)
+
+
+def button_row(text, callback_data):
+    return b'[{"text":' + dumps(text) + b',"callback_data":' + dumps(callback_data) + b"}]"
+
+
+def keyboard_rows(keyboard):
+    return [dumps(row) for row in keyboard["inline_keyboard"]]
+
+
+def inline_keyboard(rows):
+    """
+    :param rows: list of encoded keyboard rows
+    :return: Encoded inline keyboard markup
+    """
+    return Encoded.raw(b'{"inline_keyboard":[' + b",".join(rows) + b"]}")
+
+
+SEARCH_END_ROWS = keyboard_rows(SEARCH_END_KEYBOARD)
+GETMYTRIPS_ROWS = keyboard_rows(GETMYTRIPS_INLINE_KEYBOARD)
+DELETE_ALL_TRIPS_ROW = button_row(DELETE_ALL_TRIPS_BUTTON_TEXT, "/deletealltrips")
+SEARCH_END_MARKUP = inline_keyboard(SEARCH_END_ROWS)
+
+
+def escape_text(text):
+    """
+    Escapes user input for HTML parse mode. Most names and notes have nothing to escape, so they are returned as is
+    """
+    if "&" in text or "<" in text or ">" in text:
+        return escape(text, quote=False)
+    return text
+
+
+def render_legs(legs):
+    """
+    :param legs: list of trip legs
+    :return: a line with the destination and the date of every leg
+    """
+    lines = []
+    for leg in legs:
+        destination = leg['route'].rsplit("-", 1)[-1]
+        lines.append(f"Дата поездки {DESTINATION_TEXTS.get(destination, destination)}: {leg['date']},\n")
+    return "".join(lines)
+
+
+# Telegram accepts up to 4096 characters of text after entities parsing, counted in UTF-16 code units
+MESSAGE_TEXT_LIMIT = 4000
+NOTE_LABEL = "Примечание: "
+
+
+def text_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def truncate(text, length):
+    """
+    :return: text cut to at most length UTF-16 code units, ending with an ellipsis if it's cut
+    """
+    if text_length(text) <= length:
+        return text
+    if length < 1:
+        return ""
+    # A surrogate pair split by the cut is dropped
+    return text.encode("utf-16-le")[:(length - 1) * 2].decode("utf-16-le", errors="ignore") + "…"
+
+
+def fit_notes(notes, room):
+    """
+    Cuts the longest notes to the same length, so that short notes are shown whole
+    :param notes: list of notes
+    :param room: UTF-16 code units the notes may take together
+    :return: list of notes
+    """
+    lengths = sorted(text_length(note) for note in notes)
+    count = len(lengths)
+    for length in lengths:
+        if length * count > room:
+            break
+        room -= length
+        count -= 1
+    else:
+        return notes
+    return [truncate(note, max(room, 0) // count) for note in notes]
+
+
+def render_trips(header, prefixes, trips):
+    """
+    Renders a message with a list of trips, notes are shortened if the message is longer than MESSAGE_TEXT_LIMIT
+    :param header: text before the trips
+    :param prefixes: list of text before the contact link of every trip
+    :param trips: list of trips
+    :return: message text in HTML
+    """
+    def render(notes):
+        return header + "".join([
+            f"{prefix}<a href=\"tg://user?id={trip['user_id']}\">{escape_text(trip['first_name'])}</a>,\n"
+            f"{render_legs(trip['legs'])}"
+            f"{NOTE_LABEL}{escape_text(note)}\n\n"
+            for prefix, trip, note in zip(prefixes, trips, notes)])
+
+    notes = [trip['note'] for trip in trips]
+    text = render(notes)
+    # Tags and escapes are not counted by Telegram, so text which fits with them fits anyway.
+    # A character takes at most two code units, most pages are checked without encoding
+    if len(text) <= MESSAGE_TEXT_LIMIT // 2 or text_length(text) <= MESSAGE_TEXT_LIMIT:
+        return text
+    fixed = text_length(header) + sum(
+        text_length(f"{prefix}{trip['first_name']},\n{render_legs(trip['legs'])}{NOTE_LABEL}\n\n")
+        for prefix, trip in zip(prefixes, trips))
+    return render(fit_notes(notes, MESSAGE_TEXT_LIMIT - fixed))
+
+
+def render_search_results(trips, start=1, header=""):
+    """
+    :param trips: list of trips of a search results page
+    :param start: number of the first trip
+    :param header: text before the trips
+    :return: message text in HTML
+    """
+    return render_trips(header, [f"{i}. " for i in range(start, start + len(trips))], trips)
+
+
+def search_page_markup(next_page=None, subscribe=None):
+    """
+    :param next_page: callback data of the "next page" button, None if it's the last page
+    :param subscribe: callback data of the "subscribe" button, None if subscription is not offered
+    :return: Encoded inline keyboard of a search results page
+    """
+    if next_page is None and subscribe is None:
+        return SEARCH_END_MARKUP
+    rows = [button_row(SEARCH_NEXT_PAGE_TEXT, next_page)] if next_page else []
+    if subscribe:
+        rows.append(button_row(SUBSCRIBE_BUTTON_TEXT, subscribe))
+    return inline_keyboard([*rows, *SEARCH_END_ROWS])
+
+
+def unsubscribe_markup(unsubscribe):
+    """
+    :param unsubscribe: callback data of the "unsubscribe" button
+    :return: Encoded inline keyboard
+    """
+    return inline_keyboard([button_row(UNSUBSCRIBE_BUTTON_TEXT, unsubscribe), *SEARCH_END_ROWS])
+
+
+def render_trip_alert(trip, unsubscribe):
+    """
+    Renders a notification about a new trip matching a subscription
+    :param trip: the new trip
+    :param unsubscribe: callback data of the "unsubscribe" button
+    :return: tuple of message text and Encoded inline keyboard
+    """
+    return render_search_results([trip], header=TRIP_ALERT_TEXT), unsubscribe_markup(unsubscribe)
+
+
+MY_TRIPS_HEADER = "Вот ваши предстоящие поездки:\n\n"
+NO_TRIPS_TEXT = "У вас нет предстоящих поездок"
+DELETE_TRIP_COMMAND = "/deletetrip"
+
+
+def my_trip_prefix(number):
+    return f"{number}. Ваш контакт, как он отобразится в поиске: "
+
+
+def delete_trip_row(number, trip_id):
+    return button_row(f"Удалить поездку {number}.", f"{DELETE_TRIP_COMMAND}_{trip_id}")
+
+
+def my_trips_markup(trip_ids):
+    if not trip_ids:
+        return inline_keyboard(GETMYTRIPS_ROWS)
+    return inline_keyboard([*(delete_trip_row(i, trip_id) for i, trip_id in enumerate(trip_ids, start=1)),
+                            DELETE_ALL_TRIPS_ROW, *GETMYTRIPS_ROWS])
+
+
+def render_my_trips(trips):
+    """
+    Renders user's trips with a delete button for each trip
+    :param trips: list of trips
+    :return: tuple of message text and Encoded inline keyboard
+    """
+    if not trips:
+        return NO_TRIPS_TEXT, my_trips_markup([])
+    text = render_trips(MY_TRIPS_HEADER, [my_trip_prefix(i) for i in range(1, len(trips) + 1)], trips)
+    return text, my_trips_markup([trip['trip_id'] for trip in trips])
+
+
+def render_my_trips_without(message, trip_id):
+    """
+    Re-renders "my trips" message as received in a callback query, without one of the trips.
+    Trips are taken from the message itself: IDs from the delete buttons, contact links from their entities
+    and the rest of every trip from the text between them, so nothing has to be queried.
+    Telegram returns tg://user links as text_mention entities with the user, other links as text_link entities
+    :param message: "my trips" message with text, entities and reply_markup
+    :param trip_id: ID of the trip to remove
+    :return: tuple of message text and Encoded inline keyboard, or None if the message doesn't have the trip
+        or is not a "my trips" message
+    """
+    prefix = f"{DELETE_TRIP_COMMAND}_"
+    trip_ids = [row[0]["callback_data"][len(prefix):]
+                for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+                if row and row[0].get("callback_data", "").startswith(prefix)]
+    links = [entity for entity in message.get("entities", []) if entity.get("type") in ("text_link", "text_mention")]
+    if trip_id not in trip_ids or len(links) != len(trip_ids):
+        return None
+    # Entity offsets are in UTF-16 code units
+    text = message.get("text", "").encode("utf-16-le")
+
+    def text_slice(start, end=None):
+        return text[start * 2:None if end is None else end * 2].decode("utf-16-le")
+
+    starts = [link["offset"] - len(my_trip_prefix(i).encode("utf-16-le")) // 2 for i, link in enumerate(links, 1)]
+    if any(text_slice(start, link["offset"]) != my_trip_prefix(i)
+           for i, (start, link) in enumerate(zip(starts, links), start=1)):
+        return None
+    remaining_ids, blocks = [], []
+    for index, (current_id, link) in enumerate(zip(trip_ids, links)):
+        if current_id == trip_id:
+            continue
+        remaining_ids.append(current_id)
+        link_end = link["offset"] + link["length"]
+        # Telegram strips trailing newlines of the message, so the last trip is ended again
+        rest = text_slice(link_end, starts[index + 1] if index + 1 < len(starts) else None).rstrip("\n")
+        url = link["url"] if link["type"] == "text_link" else f"tg://user?id={link['user']['id']}"
+        blocks.append(f"{my_trip_prefix(len(remaining_ids))}<a href=\"{escape(url)}\">"
+                      f"{escape(text_slice(link['offset'], link_end), quote=False)}</a>"
+                      f"{escape(rest, quote=False)}\n\n")
+    if not remaining_ids:
+        return NO_TRIPS_TEXT, my_trips_markup([])
+    return MY_TRIPS_HEADER + "".join(blocks), my_trips_markup(remaining_ids)
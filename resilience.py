@@ -0,0 +1,102 @@
+"""
+Retries and failure isolation for calls to Telegram and DynamoDB.
+Backoff spreads retries of concurrent callers with full jitter, so throttled requests are not retried in lockstep.
+CircuitBreaker stops calling a dependency which keeps failing and lets one probe call through after a pause,
+so updates fail fast instead of waiting for timeouts while the dependency is down.
+Deadline is the time budget of an invocation, calls take their timeouts from what is left of it
+"""
+import random
+import threading
+import time
+
+
+class Backoff:
+    def __init__(self, base_delay, max_delay, rng=random.random):
+        """
+        :param base_delay: seconds the delay is drawn from before the first retry
+        :param max_delay: upper bound of the delay in seconds
+        :param rng: function returning a random float in [0, 1)
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = rng
+
+    def delay(self, attempt):
+        """
+        :param attempt: number of the failed attempt, starting from 0
+        :return: seconds to wait before the next attempt
+        """
+        return self._rng() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        """
+        :param failure_threshold: number of failures in a row which opens the circuit
+        :param reset_timeout: seconds the circuit stays open before a probe call is let through
+        :param clock: function returning current time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow(self):
+        """
+        :return: True if the call can be made, False if it has to fail fast
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = self._clock()
+            if now - self._opened_at >= self.reset_timeout:
+                # Only the probe call goes through until its result is recorded,
+                # another one is let through if it's not recorded within reset_timeout
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class Deadline:
+    def __init__(self, seconds, clock=time.monotonic):
+        """
+        :param seconds: time budget from now
+        :param clock: function returning current time in seconds
+        """
+        self._clock = clock
+        self.expires_at = clock() + seconds
+
+    @classmethod
+    def from_lambda_context(cls, context, reserve):
+        """
+        :param context: Lambda context object
+        :param reserve: seconds kept for finishing the invocation after the deadline
+        """
+        return cls(context.get_remaining_time_in_millis() / 1000 - reserve)
+
+    def remaining(self):
+        """
+        :return: seconds left, 0 if the deadline has passed
+        """
+        return max(0.0, self.expires_at - self._clock())
+
+    def expired(self):
+        return self.remaining() == 0
@@ -0,0 +1,165 @@
+"""
+Update router for carrier_bot.py.
+Handlers register with decorators and are looked up in dicts, so routing cost doesn't grow with the number of commands:
+- text commands (/start) by the lowercased message text
+- callbacks by exact callback data ("/getmytrips")
+- parameterized callbacks ("/deletetrip_<trip_id>") by the part of callback data before the first "_"
+- wizard steps by the step marker hidden in the prompt message the user replies to
+"""
+import urllib.parse
+
+# Wizard prompts end with a zero-width link to this URL, which carries the step marker and the wizard state
+STEP_URL = "https://t.me/?step="
+# State link of prompts sent before step markers were introduced
+LEGACY_STATE_URL = "https://t.me/?encoded="
+ZERO_WIDTH_CHARACTER = "\u200C"
+
+
+class UpdateContext:
+    """
+    Fields of an update the handlers need
+    """
+
+    def __init__(self, chat_id, message_id, user_id, first_name, message, text=None, callback_query_id=None,
+                 update_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.first_name = first_name
+        # For callbacks it's the message the inline keyboard is attached to
+        self.message = message
+        # Message text or callback data
+        self.text = text
+        self.callback_query_id = callback_query_id
+        self.update_id = update_id
+
+    @classmethod
+    def from_message(cls, message, update_id=None):
+        return cls(message['chat']['id'], message['message_id'], message['from']['id'],
+                   message['from']['first_name'], message, message['text'], update_id=update_id)
+
+    @classmethod
+    def from_callback_query(cls, callback_query, update_id=None):
+        message = callback_query['message']
+        return cls(message['chat']['id'], message['message_id'], callback_query['from']['id'],
+                   callback_query['from'].get('first_name'), message, callback_query['data'], callback_query['id'],
+                   update_id)
+
+
+def step_prompt(text, step, data=None):
+    """
+    Appends a hidden link with the wizard step marker and optional state to the prompt.
+    Telegram returns the link as text_link entity of reply_to_message when the user replies to the prompt.
+    The prompt has to be sent with HTML parse mode
+    :param text: prompt text
+    :param step: short marker of the step the reply is handled by
+    :param data: optional state string passed to the step handler
+    :return: prompt text with the link
+    """
+    url = STEP_URL + step
+    if data is not None:
+        url += "&encoded=" + urllib.parse.quote_plus(data)
+    return f"{text}<a href=\"{url}\">{ZERO_WIDTH_CHARACTER}</a>"
+
+
+def step_link(message):
+    """
+    Finds the wizard step link of a prompt message
+    :param message: prompt message as returned by Telegram
+    :return: tuple of step marker and state string (None if there is no state), or None if it's not a wizard prompt
+    """
+    for entity in message.get("entities", ()):
+        url = entity.get("url", "")
+        if entity.get("type") == "text_link" and url.startswith(STEP_URL):
+            step, _, data = url[len(STEP_URL):].partition("&encoded=")
+            return step, urllib.parse.unquote_plus(data) if data else None
+    return None
+
+
+def legacy_state(message):
+    for entity in message.get("entities", ()):
+        url = entity.get("url", "")
+        if url.startswith(LEGACY_STATE_URL):
+            return urllib.parse.unquote_plus(url[len(LEGACY_STATE_URL):])
+    return None
+
+
+class Router:
+    def __init__(self):
+        self.commands = {}
+        self.callbacks = {}
+        self.callback_prefixes = {}
+        self.steps = {}
+        # Prompts sent before they had step markers, checked in order with startswith
+        self.legacy_prompts = []
+
+    @staticmethod
+    def _register(table, key, handler):
+        if key in table:
+            raise ValueError(f"Handler for {key} is already registered")
+        table[key] = handler
+
+    def command(self, *commands):
+        """
+        Registers handler(context) of text commands
+        """
+        def decorator(handler):
+            for command in commands:
+                self._register(self.commands, command.lower(), handler)
+            return handler
+        return decorator
+
+    def callback(self, data):
+        """
+        Registers handler(context) of callbacks with exactly this data
+        """
+        def decorator(handler):
+            self._register(self.callbacks, data, handler)
+            return handler
+        return decorator
+
+    def callback_prefix(self, prefix):
+        """
+        Registers handler(context) of callbacks with data "<prefix>_<parameters>"
+        """
+        def decorator(handler):
+            self._register(self.callback_prefixes, prefix, handler)
+            return handler
+        return decorator
+
+    def step(self, step, legacy_prompt=None):
+        """
+        Registers handler(context, state) of replies to wizard prompts with this step marker
+        :param step: step marker, see step_prompt()
+        :param legacy_prompt: prompt text the step was recognized by before markers, for prompts still in chats
+        """
+        def decorator(handler):
+            self._register(self.steps, step, handler)
+            if legacy_prompt is not None:
+                self.legacy_prompts.append((legacy_prompt, step))
+            return handler
+        return decorator
+
+    def callback_handler(self, data):
+        handler = self.callbacks.get(data)
+        if handler is None and "_" in data:
+            handler = self.callback_prefixes.get(data.partition("_")[0])
+        return handler
+
+    def command_handler(self, text):
+        return self.commands.get(text.lower())
+
+    def step_handler(self, prompt_message):
+        """
+        :param prompt_message: message the user replied to
+        :return: tuple of the step handler and state string, or (None, None) if the message is not a known prompt
+        """
+        link = step_link(prompt_message)
+        if link is None:
+            prompt_text = prompt_message.get("text", "")
+            step = next((step for prompt, step in self.legacy_prompts if prompt_text.startswith(prompt)), None)
+            if step is None:
+                return None, None
+            link = step, legacy_state(prompt_message)
+        step, data = link
+        return self.steps.get(step), data
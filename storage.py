@@ -0,0 +1,312 @@
+"""
+Trip storage engines for carrier_bot.py, chosen with the STORAGE environment variable.
+A trip is a dict with user_id, trip_id, first_name, note, expires_at and legs: list of {'route', 'date'} in travel
+order, route is "<origin>-<destination>" and date is YYYY-MM-DD. Trips are stored as one record per leg,
+date searches read the legs of one route, so a trip has at most one leg per route.
+A leg found by a search is its trip with the route and date of the leg.
+An engine implements:
+- save_trip(trip), save_trips(trips) -> number of saved legs, save_trip saves all legs of the trip or none
+- delete_trip(user_id, trip_id) -> the deleted trip, or None if there was no such trip
+- delete_trips(trips) -> number of deleted legs
+- user_trips(user_id, include_expired=False) -> iterable of trips of the user ordered by trip_id
+- legs_by_date(route, from_date, to_date, limit=None) -> iterable of legs on the route with the date between
+  from_date and to_date (inclusive) ordered by date, limit is a hint of how many legs are needed
+Failures are raised as StorageError, or by the DynamoDB engine as one of carrier_bot.dynamodb_errors().
+DynamoDBTripStore keeps trips in the DynamoDB table of carrier_bot.py, which also holds month views, subscriptions
+and update markers. SqliteTripStore keeps trips in a local SQLite database for self-hosted and offline runs
+"""
+import json
+import threading
+import time
+from itertools import chain
+
+from vars import DUMMY_DATE, ROUTE_TO_BELARUS, ROUTE_TO_SPAIN
+
+# Date attributes of trips saved before legs, by route
+LEGACY_DATE_ATTRIBUTES = (('to_belarus_date', ROUTE_TO_BELARUS), ('to_spain_date', ROUTE_TO_SPAIN))
+TRIP_FIELDS = ('user_id', 'trip_id', 'first_name', 'note', 'legs', 'expires_at')
+# Every leg of a trip is a separate item with trip_id "<trip ID>#<route>". Legs are indexed by ROUTE_INDEX,
+# partitioned by "<route>#<YYYY-MM>" and sorted by date, so a search reads only the months of its route.
+# Trips saved with to_belarus_date and to_spain_date are converted by admin.py migrate-legs
+ROUTE_INDEX = 'route_month-index'
+ROUTE_MONTH_KEY = 'route_month'
+LEG_DATE_KEY = 'leg_date'
+
+
+def legs_from_dates(dates):
+    """
+    :param dates: dict with to_belarus_date and to_spain_date, DUMMY_DATE if the trip doesn't go that way,
+        like trips saved before legs and the save trip wizard state
+    :return: list of legs
+    """
+    return [{'route': route, 'date': dates[attribute]} for attribute, route in LEGACY_DATE_ATTRIBUTES
+            if dates.get(attribute) and dates[attribute] != DUMMY_DATE]
+
+
+def trip_leg(trip, leg):
+    """
+    :return: leg as it's found by searches
+    """
+    return {**{field: trip[field] for field in TRIP_FIELDS if field in trip}, 'route': leg['route'],
+            'date': leg['date']}
+
+
+LEG_COLUMNS = ('user_id', 'trip_id', 'route', 'date', 'first_name', 'note', 'legs', 'expires_at')
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS legs (user_id INTEGER NOT NULL, trip_id TEXT NOT NULL, route TEXT NOT NULL, "
+    "date TEXT NOT NULL, first_name TEXT, note TEXT, legs TEXT NOT NULL, expires_at INTEGER, "
+    "PRIMARY KEY (user_id, trip_id, route)) WITHOUT ROWID",
+    # Legs of a route are found by this index, the trips of a user by the primary key
+    "CREATE INDEX IF NOT EXISTS legs_route_date ON legs (route, date, trip_id)",
+)
+# Statements are compiled once per connection and reused from its statement cache
+SELECT = f"SELECT {', '.join(LEG_COLUMNS)} FROM legs"
+INSERT_LEG = f"INSERT OR REPLACE INTO legs ({', '.join(LEG_COLUMNS)}) VALUES ({', '.join('?' * len(LEG_COLUMNS))})"
+DELETE_TRIP = f"DELETE FROM legs WHERE user_id = ? AND trip_id = ? RETURNING {', '.join(LEG_COLUMNS)}"
+SELECT_USER_TRIPS = f"{SELECT} WHERE user_id = ? AND (expires_at IS NULL OR expires_at > ?) ORDER BY trip_id"
+SELECT_ALL_USER_TRIPS = f"{SELECT} WHERE user_id = ? ORDER BY trip_id"
+SELECT_BY_DATE = f"{SELECT} WHERE route = ? AND date BETWEEN ? AND ? ORDER BY date, trip_id"
+
+
+class StorageError(Exception):
+    pass
+
+
+class SqliteTripStore:
+    """
+    Trips in a SQLite database in WAL mode, so searches are not blocked by writes.
+    Every thread opens its own connection once and reuses it for all later calls
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        """
+        :param path: database file, created with the schema if it doesn't exist
+        :param busy_timeout: seconds a write waits for another connection's write to finish
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            import sqlite3
+            # Autocommit mode, transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         cached_statements=64)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints, WAL keeps the database consistent on a crash
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._migrate_trips_table(connection)
+            self._local.connection = connection
+        return connection
+
+    @classmethod
+    def _migrate_trips_table(cls, connection):
+        """
+        Moves trips from the table of one row per trip with to_belarus_date and to_spain_date to legs
+        """
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trips'").fetchone():
+                columns = ('user_id', 'trip_id', 'first_name', 'note', 'to_belarus_date', 'to_spain_date',
+                           'expires_at')
+                rows = []
+                for row in connection.execute(f"SELECT {', '.join(columns)} FROM trips"):
+                    trip = dict(zip(columns, row))
+                    trip['legs'] = legs_from_dates(trip)
+                    rows.extend(cls._rows(trip))
+                connection.executemany(INSERT_LEG, rows)
+                connection.execute("DROP TABLE trips")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _query(self, statement, parameters=()):
+        """
+        :return: generator of the result rows. The cursor reads rows as they are iterated,
+            so errors raised while reading them are wrapped too
+        """
+        import sqlite3
+        try:
+            yield from self._connection().execute(statement, parameters)
+        except sqlite3.Error as error:
+            raise StorageError(f"SQLite error: {error}") from error
+
+    def _execute_many(self, statement, rows):
+        import sqlite3
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN")
+            try:
+                count = connection.executemany(statement, rows).rowcount
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        except sqlite3.Error as error:
+            raise StorageError(f"SQLite error: {error}") from error
+        return count
+
+    @staticmethod
+    def _rows(trip):
+        legs = json.dumps(trip['legs'], separators=(",", ":"))
+        return [(int(trip['user_id']), trip['trip_id'], leg['route'], leg['date'], trip.get('first_name'),
+                 trip.get('note'), legs, trip.get('expires_at')) for leg in trip['legs']]
+
+    @staticmethod
+    def _leg(row):
+        leg = dict(zip(LEG_COLUMNS, row))
+        leg['legs'] = json.loads(leg['legs'])
+        return leg
+
+    @classmethod
+    def _trip(cls, row):
+        trip = cls._leg(row)
+        del trip['route'], trip['date']
+        return trip
+
+    @classmethod
+    def _trips(cls, cursor):
+        # Every leg row has the whole trip
+        trip_id = None
+        for row in cursor:
+            if row[1] != trip_id:
+                trip_id = row[1]
+                yield cls._trip(row)
+
+    def save_trip(self, trip):
+        return self._execute_many(INSERT_LEG, self._rows(trip))
+
+    def save_trips(self, trips):
+        return self._execute_many(INSERT_LEG, (row for trip in trips for row in self._rows(trip)))
+
+    def delete_trip(self, user_id, trip_id):
+        rows = list(self._query(DELETE_TRIP, (int(user_id), trip_id)))
+        return self._trip(rows[0]) if rows else None
+
+    def delete_trips(self, trips):
+        return self._execute_many("DELETE FROM legs WHERE user_id = ? AND trip_id = ?",
+                                  ((int(trip['user_id']), trip['trip_id']) for trip in trips))
+
+    def user_trips(self, user_id, include_expired=False):
+        if include_expired:
+            return self._trips(self._query(SELECT_ALL_USER_TRIPS, (int(user_id),)))
+        return self._trips(self._query(SELECT_USER_TRIPS, (int(user_id), int(time.time()))))
+
+    def legs_by_date(self, route, from_date, to_date, limit=None):
+        return map(self._leg, self._query(SELECT_BY_DATE, (route, str(from_date), str(to_date))))
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def leg_items(trip):
+    """
+    :param trip: trip data
+    :return: list of table items of the trip, one per leg, each with the whole trip
+    """
+    fields = {field: trip[field] for field in TRIP_FIELDS if field in trip}
+    return [{**fields, 'trip_id': f"{trip['trip_id']}#{leg['route']}", 'route': leg['route'],
+             LEG_DATE_KEY: leg['date'], ROUTE_MONTH_KEY: f"{leg['route']}#{leg['date'][:7]}"}
+            for leg in trip['legs']]
+
+
+def trip_from_item(item):
+    """
+    :param item: leg item made by leg_items
+    :return: trip data
+    """
+    trip = {field: item[field] for field in TRIP_FIELDS if field in item}
+    trip['trip_id'] = item['trip_id'].rsplit('#', 1)[0]
+    return trip
+
+
+def leg_from_item(item):
+    """
+    :param item: leg item made by leg_items
+    :return: leg as it's found by searches
+    """
+    return {**trip_from_item(item), 'route': item['route'], 'date': item[LEG_DATE_KEY]}
+
+
+class DynamoDBTripStore:
+    """
+    Trips in the DynamoDB table, one item per leg.
+    Date searches query the route index partitions of the months in the range, in parallel
+    """
+
+    def __init__(self):
+        # Calls go through the table client of carrier_bot.py with its retries, circuit breaker and deadline,
+        # carrier_bot.py imports this module first
+        import carrier_bot
+        self._bot = carrier_bot
+
+    @staticmethod
+    def _trips(items):
+        # Trips saved before legs are left to the migration
+        trip_id = None
+        for item in items:
+            if LEG_DATE_KEY in item and item['trip_id'].rsplit('#', 1)[0] != trip_id:
+                trip = trip_from_item(item)
+                trip_id = trip['trip_id']
+                yield trip
+
+    def save_trip(self, trip):
+        # Legs are written in one transaction, so a trip is never found with some of its legs missing
+        items = leg_items(trip)
+        self._bot.get_table().transact_write_items([{'Put': {'Item': item}} for item in items])
+        return len(items)
+
+    def save_trips(self, trips):
+        return self._bot.batch_write({'PutRequest': {'Item': item}} for trip in trips for item in leg_items(trip))
+
+    def delete_trip(self, user_id, trip_id):
+        from botocore.exceptions import ClientError
+        # Legs are found by their keys and deleted in one transaction. The legs must still exist,
+        # so a trip deleted concurrently is returned by one of the calls only
+        legs = list(self._bot.paginate_query(
+            KeyConditionExpression="user_id = :user_id AND begins_with(trip_id, :prefix)",
+            ExpressionAttributeValues={":user_id": int(user_id), ":prefix": f"{trip_id}#"}))
+        if not legs:
+            return None
+        try:
+            self._bot.get_table().transact_write_items(
+                [{'Delete': {'Key': {'user_id': leg['user_id'], 'trip_id': leg['trip_id']},
+                             'ConditionExpression': "attribute_exists(trip_id)"}} for leg in legs])
+        except ClientError as error:
+            reasons = error.response.get('CancellationReasons', [])
+            if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+                return None
+            raise
+        return trip_from_item(legs[0])
+
+    def delete_trips(self, trips):
+        batch_write = self._bot.batch_write
+        return batch_write({'DeleteRequest': {'Key': {'user_id': item['user_id'], 'trip_id': item['trip_id']}}}
+                           for trip in trips for item in leg_items(trip))
+
+    def user_trips(self, user_id, include_expired=False):
+        paginate_query = self._bot.paginate_query
+        if include_expired:
+            return self._trips(paginate_query(KeyConditionExpression="user_id = :user_id",
+                                              ExpressionAttributeValues={":user_id": int(user_id)}))
+        # Expired trips are filtered out by DynamoDB, as TTL deletes them only eventually
+        return self._trips(paginate_query(KeyConditionExpression="user_id = :user_id",
+                                          FilterExpression="#expires_at > :now",
+                                          ExpressionAttributeNames={"#expires_at": self._bot.EXPIRY_ATTRIBUTE},
+                                          ExpressionAttributeValues={":user_id": int(user_id),
+                                                                     ":now": int(time.time())}))
+
+    def legs_by_date(self, route, from_date, to_date, limit=None):
+        # Months are disjoint, so the legs are sorted by date month after month
+        months = [self._bot.query_route_month(route, month, from_date, to_date, limit)
+                  for month in self._bot.range_months(from_date, to_date)]
+        return map(leg_from_item, chain.from_iterable(months))
@@ -0,0 +1,79 @@
+"""
+Rate limiting of outbound Telegram messages.
+Bot API accepts about 30 messages per second from a bot and about one message per second to the same chat,
+bots going over that get 429 errors. Limits are kept as token buckets in the GCRA form: a bucket stores the time
+its next token is due, so reserving a token is a comparison and an addition, whatever the number of chats
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        """
+        :param rate: tokens per second
+        :param burst: number of tokens that can be taken at once after the bucket has been idle
+        :param clock: function returning current time in seconds
+        """
+        self.interval = 1 / rate
+        self.burst = burst
+        self._clock = clock
+        self._due = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, at=None):
+        """
+        Takes a token, which may only be available in the future
+        :param at: time the token is needed at, defaults to now
+        :return: seconds from "at" until the token can be used
+        """
+        with self._lock:
+            at = self._clock() if at is None else at
+            due = max(self._due, at)
+            self._due = due + self.interval
+            return max(0.0, due - (self.burst - 1) * self.interval - at)
+
+
+class SendThrottle:
+    """
+    Limits messages sent by the bot overall and to every chat
+    """
+    # Chats idle for longer than this are forgotten
+    CHAT_IDLE_SECONDS = 60
+
+    def __init__(self, rate, burst, chat_interval, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: messages per second over all chats
+        :param burst: number of messages that can be sent at once over all chats
+        :param chat_interval: minimum seconds between messages to the same chat
+        :param clock: function returning current time in seconds
+        :param sleep: function waiting for the given number of seconds
+        """
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(rate, burst, clock)
+        self._clock = clock
+        self._sleep = sleep
+        self._chat_due = {}
+        self._lock = threading.Lock()
+
+    def _reserve_chat(self, chat_id, now):
+        with self._lock:
+            if len(self._chat_due) > 10000:
+                self._chat_due = {chat: due for chat, due in self._chat_due.items()
+                                  if due > now - self.CHAT_IDLE_SECONDS}
+            due = max(self._chat_due.get(chat_id, 0.0), now)
+            self._chat_due[chat_id] = due + self.chat_interval
+            return due - now
+
+    def acquire(self, chat_id):
+        """
+        Waits until a message can be sent to the chat
+        :param chat_id: ID of the chat
+        :return: seconds waited
+        """
+        now = self._clock()
+        delay = self._reserve_chat(chat_id, now)
+        delay += self._bucket.reserve(now + delay)
+        if delay:
+            self._sleep(delay)
+        return delay
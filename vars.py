@@ -4,7 +4,17 @@ variables for carrier_bot.py
 START_COMMAND = '/start'
 ABOUT_COMMAND = '/about'
 HELP_COMMAND = '/help'
+SEARCH_PAGE_COMMAND = '/searchpage'
+SEARCH_WINDOW_COMMAND = '/searchwindow'
+SUBSCRIBE_COMMAND = '/subscribe'
+UNSUBSCRIBE_COMMAND = '/unsubscribe'
+# Date of a skipped step of the save trip wizard, it's never stored
 DUMMY_DATE = '1900-01-01'
+# Trips are made of legs along routes "<origin>-<destination>", countries are ISO 3166 codes
+ROUTE_TO_BELARUS = 'ES-BY'
+ROUTE_TO_SPAIN = 'BY-ES'
+# Destinations as they are shown in "Дата поездки <destination>: <date>"
+DESTINATION_TEXTS = {'BY': 'в Беларусь', 'ES': 'в Испанию'}
 
 GREETING_TEXT = ("Привет, Беларус\ка Испании!\n\n"
                  "Если ты готов\а помочь в передаче мелких вещей или документов во время своей поездки домой, "
@@ -65,6 +75,17 @@ GETMYTRIPS_INLINE_KEYBOARD = {
             ]
         ]
 }
+DELETE_ALL_TRIPS_BUTTON_TEXT = "Удалить все поездки"
+DELETE_ALL_TRIPS_CONFIRM_TEXT = "Вы уверены, что хотите удалить все свои поездки?"
+DELETE_ALL_TRIPS_CONFIRM_INLINE_KEYBOARD = {
+    "inline_keyboard":
+        [
+            [
+                {"text": "Да, удалить все", "callback_data": "/deletealltripsconfirm"},
+                {"text": "Отмена", "callback_data": "/getmytrips"}
+            ]
+        ]
+}
 SAVETRIP_STEP1_TEXT = ("Пожалуйста введите предполагаемую дату вашей поездки в Беларусь\n\n"
                       "Используйте формат DD-MM-YYYY (например: 17-03-2024)\n\n"
                       "Если поездка только из Беларуси, всё равно отправьте \"-\","
@@ -92,6 +113,10 @@ SAVE_SUCCESS_INLINE_KEYBOARD = {
 }
 INCORRECT_DATE_TEXT = ("Невалидный формат даты. Пожалуйста, "
                        "вводите дату в формате DD-MM-YYYY (например, 28-05-2024)")
+NO_TRIP_DATES_TEXT = ("Поездка должна быть хотя бы в одну сторону. Пожалуйста, "
+                      "введите дату поездки в Испанию в формате DD-MM-YYYY (например, 28-05-2024)")
+WIZARD_STATE_ERROR_TEXT = ("Не удалось прочитать данные сохраняемой поездки. "
+                           "Пожалуйста, начните сохранение поездки заново")
 INCORRECT_DATE_INLINE_KEYBOARD = {
     "inline_keyboard":
         [
@@ -113,6 +138,9 @@ SEARCH_INTRO_INLINE_KEYBOARD = {
             [
                 {"text": "В Беларусь", "callback_data": "/searchbelarusdate"},
                 {"text": "В Испанию", "callback_data": "/searchspaindate"}
+            ],
+            [
+                {"text": "В любую сторону", "callback_data": "/searchanydate"}
             ]
         ]
 }
@@ -120,8 +148,15 @@ SEARCH_BELARUS_TIME_TEXT = ("Введите интересующий вас ме
                             "в Беларусь в формате MM-YYYY (например, 03-2024)")
 SEARCH_SPAIN_TIME_TEXT = ("Введите интересующий вас месяц для передачи "
                           "в Испанию в формате MM-YYYY (например, 03-2024)")
+SEARCH_ANY_TIME_TEXT = ("Введите интересующий вас месяц для передачи "
+                        "в Беларусь или в Испанию в формате MM-YYYY (например, 03-2024)")
+SEARCH_WINDOW_FORMATS_TEXT = ("\n\nМожно также ввести период в формате DD-MM-YYYY..DD-MM-YYYY "
+                              "(например, 10-03-2024..20-03-2024) или дату и сколько дней до и после неё "
+                              "вас устроит (например, 15-03-2024 ±3)")
 INCORRECT_SEARCH_DATE_TEXT = ("Невалидный формат даты. Пожалуйста, "
-                              "вводите дату в формате MM-YYYY (например, 03-2024)")
+                              "вводите месяц в формате MM-YYYY (например, 03-2024), "
+                              "период в формате DD-MM-YYYY..DD-MM-YYYY (например, 10-03-2024..20-03-2024, "
+                              "не длиннее двух месяцев) или дату с отклонением в днях (например, 15-03-2024 ±3)")
 SEARCH_END_KEYBOARD = {
     "inline_keyboard":
         [
@@ -131,6 +166,12 @@ SEARCH_END_KEYBOARD = {
             ]
         ]
 }
+SEARCH_NEXT_PAGE_TEXT = "Следующая страница"
+SUBSCRIBE_BUTTON_TEXT = "Сообщить о новых поездках"
+UNSUBSCRIBE_BUTTON_TEXT = "Больше не сообщать"
+SUBSCRIBED_TEXT = "Готово! Я напишу вам, когда кто-нибудь соберётся в путь с {from_date} по {to_date}"
+UNSUBSCRIBED_TEXT = "Больше не буду сообщать о поездках с {from_date} по {to_date}"
+TRIP_ALERT_TEXT = "Новая поездка по вашей подписке:\n\n"
 GENERIC_ERROR_TEXT = ("Невозможно обработать сообщение.\n\n"
                      "К сожалению, я не ChatGPT, и не понимаю, "
                      "что именно вы имеете в виду. Пожалуйста следуйте инструкциям бота, "
@@ -0,0 +1,75 @@
+"""
+Compact codec for the save trip wizard state carried in prompt messages.
+State is packed into bytes and encoded with URL-safe base64 without padding:
+    version (1 byte) | mask of present fields (1 byte) | day ordinal of every present date (3 bytes each) | MAC
+MAC is a truncated HMAC-SHA256 of the preceding bytes, so tampered, truncated or foreign state is rejected
+"""
+import base64
+import hashlib
+import hmac
+from datetime import date
+
+VERSION = 1
+# Date fields in the order they are packed, the position is the bit in the mask
+DATE_FIELDS = ('to_belarus_date', 'to_spain_date')
+ORDINAL_SIZE = 3
+MAC_SIZE = 6
+
+
+class WizardStateCodec:
+    def __init__(self, secret):
+        """
+        :param secret: string the MAC key is derived from, e.g. the bot token
+        """
+        self._key = hashlib.sha256(b"wizard-state:" + secret.encode("utf-8")).digest()
+
+    def _mac(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def encode(self, state):
+        """
+        :param state: dict with optional DATE_FIELDS as YYYY-MM-DD strings, other keys are not supported
+        :return: URL-safe token
+        :raises ValueError: If state has unknown fields or invalid dates
+        """
+        unknown = state.keys() - set(DATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unsupported wizard state fields: {unknown}")
+        mask = 0
+        ordinals = b""
+        for bit, field in enumerate(DATE_FIELDS):
+            if field in state:
+                mask |= 1 << bit
+                ordinals += date.fromisoformat(state[field]).toordinal().to_bytes(ORDINAL_SIZE, "big")
+        payload = bytes((VERSION, mask)) + ordinals
+        return base64.urlsafe_b64encode(payload + self._mac(payload)).rstrip(b"=").decode("ascii")
+
+    def decode(self, token):
+        """
+        :param token: token made by encode()
+        :return: state dict, or None if the token is malformed, of unknown version or fails the integrity check
+        """
+        if not token:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            return None
+        if len(raw) < 2 + MAC_SIZE or raw[0] != VERSION:
+            return None
+        payload, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+        if not hmac.compare_digest(mac, self._mac(payload)):
+            return None
+        mask = payload[1]
+        fields = [field for bit, field in enumerate(DATE_FIELDS) if mask & (1 << bit)]
+        if mask >> len(DATE_FIELDS) or len(payload) != 2 + ORDINAL_SIZE * len(fields):
+            return None
+        state = {}
+        for index, field in enumerate(fields):
+            offset = 2 + index * ORDINAL_SIZE
+            ordinal = int.from_bytes(payload[offset:offset + ORDINAL_SIZE], "big")
+            try:
+                state[field] = date.fromordinal(ordinal).isoformat()
+            except ValueError:
+                return None
+        return state